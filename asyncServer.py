@@ -0,0 +1,231 @@
+# An asyncio based server that can be used instead of ThreadingHTTPServer. ThreadingHTTPServer
+# creates an OS thread for every connection, with no upper bound, so slow clients tie up lots of
+# threads and memory. Here each connection is just a coroutine, so idle keep-alive connections cost
+# almost nothing. The requests themselves are still handled by RequestHandler.do_GET(), but in a
+# bounded thread pool since handling a request can block on PIL, pydub, or scraping ebird. What the
+# handler writes is streamed to the connection as it is written, so large responses such as
+# uncompressed wav files are never held in memory as a whole.
+import asyncio
+import http.client
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from requestHandler import RequestHandler
+
+logger = logging.getLogger()
+
+# Largest request head, request line plus headers, that is accepted
+max_request_head_bytes = 64 * 1024
+
+
+class _Server:
+    """
+    Minimal stand-in for the socketserver server object that BaseHTTPRequestHandler expects
+    """
+
+    def __init__(self, server_address):
+        self.server_address = server_address
+
+
+class _TransportWriter:
+    """
+    The wfile for a RequestHandler that runs in the thread pool. Each write is passed to the event
+    loop and waits until the data has been drained to the connection, so a slow client slows down
+    the handler instead of the response piling up in memory.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self._writer = writer
+        self._loop = loop
+        self.bytes_written = 0
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        """
+        Writes the data to the connection, waiting until it has been drained
+        :raises ConnectionError: if the connection failed or the request already timed out
+        """
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+        return len(data)
+
+    async def _write(self, data: bytes):
+        # Runs on the event loop so it can't race with close() being called after a timeout
+        if self.closed:
+            raise ConnectionAbortedError('Response abandoned since the request timed out')
+        self.bytes_written += len(data)
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def close(self):
+        """
+        Makes further writes fail. Must be called from the event loop.
+        """
+        self.closed = True
+
+    def flush(self):
+        pass
+
+
+class AsyncHTTPServer:
+    """
+    HTTP/1.1 server with keep-alive, a bounded number of connections, and per request timeouts.
+    Routes are handled by RequestHandler.do_GET() running in a thread pool.
+    """
+
+    def __init__(self, host: str = '', port: int = 8080, max_connections: int = 1000,
+                 max_workers: int = 32, request_timeout_sec: float = 120, keep_alive_timeout_sec: float = 30):
+        """
+        :param host: host to listen on. '' means all interfaces
+        :param port: port to listen on
+        :param max_connections: max number of open connections. Additional connections are told that the
+        server is busy and are then closed.
+        :param max_workers: number of threads for handling requests
+        :param request_timeout_sec: max time for handling a single request
+        :param keep_alive_timeout_sec: how long an idle connection is kept open waiting for another request
+        """
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.request_timeout_sec = request_timeout_sec
+        self.keep_alive_timeout_sec = keep_alive_timeout_sec
+
+        self._server = _Server((host, port))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='request')
+        self._num_connections = 0
+
+    def serve_forever(self, sock=None):
+        """
+        Starts the server and then handles requests forever
+        :param sock: optional already bound and listening socket to use instead of host and port
+        """
+        asyncio.run(self._serve(sock))
+
+    async def _serve(self, sock=None):
+        if sock is not None:
+            server = await asyncio.start_server(self._handle_connection, sock=sock, limit=max_request_head_bytes)
+        else:
+            server = await asyncio.start_server(self._handle_connection, self.host or None, self.port,
+                                                limit=max_request_head_bytes)
+        logger.info(f'Async server listening on {self.host}:{self.port} with max_connections={self.max_connections}')
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handles a connection, which can consist of multiple requests when keep-alive is used
+        """
+        client_address = writer.get_extra_info('peername') or ('', 0)
+
+        # If already have too many connections then tell client to retry later
+        if self._num_connections >= self.max_connections:
+            logger.warning(f'Too many connections so rejecting connection from {client_address[0]}')
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\n'
+                         b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            await self._close(writer)
+            return
+
+        self._num_connections += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                # Wait for the next request. If the client is idle for too long then close the connection.
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keep_alive_timeout_sec)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    break
+
+                keep_alive = await self._handle_request(head, client_address, writer)
+        finally:
+            self._num_connections -= 1
+            await self._close(writer)
+
+    async def _handle_request(self, head: bytes, client_address, writer: asyncio.StreamWriter) -> bool:
+        """
+        Handles a single request by running RequestHandler.do_GET() in the thread pool
+        :param head: the request line and headers
+        :param client_address: address of the client
+        :param writer: for writing the response
+        :return: True if the connection should be kept open for another request
+        """
+        loop = asyncio.get_running_loop()
+        handler = self._create_handler(head, client_address, _TransportWriter(writer, loop))
+        if handler is None:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+            return False
+
+        if handler.command != 'GET':
+            writer.write(b'HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+            return False
+
+        # Do the possibly blocking work of handling the request in the thread pool. The response is
+        # written to the connection by the handler as it goes.
+        try:
+            await asyncio.wait_for(loop.run_in_executor(self._executor, handler.do_GET), self.request_timeout_sec)
+        except asyncio.TimeoutError:
+            # The thread can't be stopped. It keeps running until it is done or until it next writes,
+            # which then fails. If nothing was written yet then at least the client gets a response.
+            handler.wfile.close()
+            logger.error(f'Request {handler.path} timed out after {self.request_timeout_sec} seconds')
+            if handler.wfile.bytes_written == 0:
+                writer.write(b'HTTP/1.1 504 Gateway Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+            return False
+        except ConnectionError:
+            return False
+
+        return not handler.close_connection
+
+    def _create_handler(self, head: bytes, client_address, wfile: _TransportWriter):
+        """
+        Creates a RequestHandler for the request without running the usual socketserver based
+        request handling. The response is written to wfile, which streams it to the connection.
+        :param head: the request line and headers
+        :param client_address: address of the client
+        :param wfile: the _TransportWriter for the connection
+        :return: the RequestHandler, or None if the request could not be parsed
+        """
+        request_line, _, header_bytes = head.partition(b'\r\n')
+        try:
+            request_line = request_line.decode('iso-8859-1')
+            command, path, request_version = request_line.split()
+            headers = http.client.parse_headers(BytesIO(header_bytes))
+        except (ValueError, http.client.HTTPException):
+            return None
+
+        handler = RequestHandler.__new__(RequestHandler)
+        handler.server = self._server
+        handler.client_address = client_address
+        handler.connection = None
+        handler.rfile = BytesIO()
+        handler.wfile = wfile
+        handler.raw_requestline = request_line
+        handler.requestline = request_line
+        handler.command = command
+        handler.path = path
+        handler.request_version = request_version
+        handler.headers = headers
+        handler.protocol_version = 'HTTP/1.1'
+
+        # Determine if connection should be kept open after the response, per HTTP/1.0 and 1.1 rules
+        connection_header = headers.get('Connection', '').lower()
+        if request_version == 'HTTP/1.1':
+            handler.close_connection = connection_header == 'close'
+        else:
+            handler.close_connection = connection_header != 'keep-alive'
+
+        return handler
+
+    @staticmethod
+    async def _close(writer: asyncio.StreamWriter):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
@@ -2,13 +2,14 @@ import gzip
 import io
 from http.server import BaseHTTPRequestHandler
 from io import BytesIO
-import requests
 import logging
 from pydub import AudioSegment, silence
 from pydub.effects import normalize
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 import cache
+import upstream
+from workerPool import WorkerPool
 
 # Note: To convert from mp3 to wav need to load both pydub and ffmpeg using
 # (see https://github.com/jiaaro/pydub?tab=readme-ov-file#installation):
@@ -30,6 +31,20 @@ _audio_cache = {}
 
 logger = logging.getLogger()
 
+# Configuration of the transcoder pool. The mp3 to wav conversion is CPU heavy so it is done in separate
+# processes. Only transcoder_workers conversions run at once and at most transcoder_max_queued more can
+# wait. Beyond that the request is immediately rejected with a "busy, retry" response.
+transcoder_workers = 2
+transcoder_max_queued = 6
+transcoder_timeout_sec = 120
+
+# Suffix of the cached gzipped wav files, and of the uncompressed versions that are served
+# to clients that don't accept gzip or that request a byte range
+audio_cache_suffix = '.wav.gz'
+uncompressed_audio_cache_suffix = '.wav'
+
+_transcoder_pool = WorkerPool('audio transcoder', transcoder_workers, transcoder_max_queued)
+
 
 def get_wav_file(handler: BaseHTTPRequestHandler):
     """
@@ -40,37 +55,162 @@ def get_wav_file(handler: BaseHTTPRequestHandler):
     :param handler: The http request handler, so that can get the query string and other info
     :return: bytes that contains the wav data. The data is always gzipped to reduce the size of the large files.
     """
+    url, species, max_clip_msec = _parse_wav_query(handler)
+    return get_wav_file_for_url(url, species, max_clip_msec, handler.client_address[0])
 
-    # Constants
-    max_clip_voice_msec = 14000  # For when voice intro ends and actual bird sounds start
-    min_bird_sound_msec = 7000   # Minimum amount of bird song expected after taking out silence
 
+def get_uncompressed_wav_filename(handler: BaseHTTPRequestHandler, missing: bool = False) -> str:
+    """
+    Like get_wav_file() but makes sure that an uncompressed version of the wav file is in the cache
+    and returns its file name. This way the file can be served directly from disk using sendfile,
+    including for byte range requests, without having to uncompress the gzipped data in memory
+    for each request.
+    :param handler: The http request handler, so that can get the query string and other info
+    :param missing: True if a previously returned file name turned out to no longer exist, so that
+    the file is created again
+    :return: full file name of the uncompressed wav file in the cache
+    """
+    url, species, max_clip_msec = _parse_wav_query(handler)
+    cache_file_name = cache_file_name_for_url(url)
+    if missing:
+        cache.resync(cache_file_name, uncompressed_audio_cache_suffix, species)
+
+    if not cache.file_exists(cache_file_name, uncompressed_audio_cache_suffix, species):
+        cache.single_flight(cache.get_full_filename(cache_file_name, uncompressed_audio_cache_suffix, species),
+                            lambda: _create_uncompressed_wav_file(url, species, max_clip_msec,
+                                                                  handler.client_address[0]))
+
+    return cache.get_full_filename(cache_file_name, uncompressed_audio_cache_suffix, species)
+
+
+def _create_uncompressed_wav_file(url: str, species: str, max_clip_msec: int, client: str):
+    """
+    Stores an uncompressed version of the wav data for the url in the cache. Creates the
+    gzipped wav data first if needed.
+    :param url: link to the mp3
+    :param species: species name, used for caching
+    :param max_clip_msec: maximum length of the resulting clip
+    :param client: address of the client, for logging
+    """
+    cache_file_name = cache_file_name_for_url(url)
+
+    # Another request might have just finished creating the file
+    if cache.file_exists(cache_file_name, uncompressed_audio_cache_suffix, species):
+        return
+
+    compressed_wav_data = get_wav_file_for_url(url, species, max_clip_msec, client)
+    cache.write_to_cache(gzip.decompress(compressed_wav_data), cache_file_name, uncompressed_audio_cache_suffix,
+                         species)
+    logger.info(f'Stored uncompressed audio for url {url}')
+
+
+def _parse_wav_query(handler: BaseHTTPRequestHandler):
+    """
+    Gets the parameters for a /wavFile request from the query string
+    :param handler: The http request handler, so that can get the query string
+    :return: tuple of url, species, and max_clip_msec
+    """
     parsed_url = urlparse(handler.path)
     parsed_qs = parse_qs(parsed_url.query, keep_blank_values=True)
     species = parsed_qs['s'][0]
     url = parsed_qs['url'][0]
-    cache_file_name = 'audio_' + cache.file_identifier(url)
-    cache_suffix = '.wav.gz'
-
-    # Get from cache if can
-    if cache.file_exists(cache_file_name, cache_suffix, species):
-        logger.info(f'{handler.client_address[0]} /wavFile command. From cache getting for url={url} species={species}')
-        return cache.read_from_cache(cache_file_name, cache_suffix, species)
-
-    logger.info(f'{handler.client_address[0]} /wavFile command. Creating file for url={url} species={species}')
 
     # Determine max length of clip to be returned
     max_clip_msec_param = parsed_qs.get('max_msec')
     if max_clip_msec_param is None or len(max_clip_msec_param) == 0:
         max_clip_msec = 30000  # Default value
     else:
-        max_clip_msec = max_clip_msec_param[0]
+        max_clip_msec = int(max_clip_msec_param[0])
+
+    return url, species, max_clip_msec
+
+
+def cache_file_name_for_url(url: str) -> str:
+    """
+    Returns the name of the cache file, without suffix, for the wav data for the url.
+    Audio for cornell catalog items get names like audio_ML928372.
+    :param url: link to the mp3
+    :return: name of the cache file
+    """
+    return 'audio_' + cache.file_identifier(url)
+
+
+def get_wav_file_for_url(url: str, species: str, max_clip_msec: int = 30000, client: str = ''):
+    """
+    Gets the wav data for the mp3 at the url, using the cache if possible. If several requests
+    for the same uncached url come in at the same time then only one of them actually creates
+    the wav data and the others share the result.
+    :param url: link to the mp3
+    :param species: species name, used for caching
+    :param max_clip_msec: maximum length of the resulting clip
+    :param client: address of the client, for logging
+    :return: bytes that contains the gzipped wav data
+    """
+    cache_file_name = cache_file_name_for_url(url)
+    cache_suffix = audio_cache_suffix
+
+    # Get from cache if can
+    if cache.file_exists(cache_file_name, cache_suffix, species):
+        logger.info(f'{client} /wavFile command. From cache getting for url={url} species={species}')
+        return cache.read_from_cache(cache_file_name, cache_suffix, species)
+
+    # Not in cache so create it. But only do so once even if multiple requests for it at the same time
+    return cache.single_flight(
+        cache.get_full_filename(cache_file_name, cache_suffix, species),
+        lambda: _create_wav_file(url, species, max_clip_msec, cache_file_name, cache_suffix, client))
+
+
+def _create_wav_file(url: str, species: str, max_clip_msec: int, cache_file_name: str, cache_suffix: str,
+                     client: str):
+    """
+    Gets the mp3 data for the url, converts it to trimmed and normalized wav data, and stores the
+    gzipped result in the cache.
+    :param url: link to the mp3
+    :param species: species name, used for caching
+    :param max_clip_msec: maximum length of the resulting clip
+    :param cache_file_name: name of the cache file for the audio
+    :param cache_suffix: suffix of the cache file for the audio
+    :param client: address of the client, for logging
+    :return: bytes that contains the gzipped wav data
+    """
+    # Another request might have just finished creating the file so check cache again
+    if cache.file_exists(cache_file_name, cache_suffix, species):
+        logger.info(f'{client} /wavFile command. Was just cached so getting for url={url} species={species}')
+        return cache.read_from_cache(cache_file_name, cache_suffix, species)
+
+    logger.info(f'{client} /wavFile command. Creating file for url={url} species={species}')
+
+    # Get the mp3 data. This is just I/O so it is done in the request thread
+    mp3 = upstream.get(url)
+
+    # Do the CPU heavy transcoding in a worker process so that the GIL doesn't slow down other requests.
+    # If too many transcodings are already queued up then this raises PoolBusyError right away.
+    compressed_bytes = _transcoder_pool.run(transcode_mp3_to_compressed_wav, mp3.content, url, max_clip_msec,
+                                            timeout=transcoder_timeout_sec)
+
+    # Store audio in cache
+    cache.write_to_cache(compressed_bytes, cache_file_name, cache_suffix, species)
+
+    logger.info(f'Stored audio in file {cache.get_full_filename(cache_file_name, cache_suffix, species)} for url {url}')
+
+    return compressed_bytes
 
-    # Get the mp3 data
-    mp3 = requests.get(url)
+
+def transcode_mp3_to_compressed_wav(mp3_data: bytes, url: str, max_clip_msec: int) -> bytes:
+    """
+    Converts mp3 data to a trimmed and normalized wav and gzips it. Runs in a worker process of
+    the transcoder pool so must be a module level function and all params must be picklable.
+    :param mp3_data: the raw mp3 data
+    :param url: where the mp3 came from. Stored as a tag in the wav
+    :param max_clip_msec: maximum length of the resulting clip
+    :return: bytes that contains the gzipped wav data
+    """
+    # Constants
+    max_clip_voice_msec = 14000  # For when voice intro ends and actual bird sounds start
+    min_bird_sound_msec = 7000   # Minimum amount of bird song expected after taking out silence
 
     # Process the sound. Just use first ~44 seconds so that processing doesn't get bogged down on really long clips
-    sound = AudioSegment.from_mp3(BytesIO(mp3.content))[:max_clip_voice_msec + max_clip_msec]
+    sound = AudioSegment.from_mp3(BytesIO(mp3_data))[:max_clip_voice_msec + max_clip_msec]
 
     # Try to get rid of any voice introduction to the clip. The voice intros appear to be consistently
     # separated by half second or so of silence. Found that had to reduce the silence_thresh to -74.0 even
@@ -129,12 +269,7 @@ def get_wav_file(handler: BaseHTTPRequestHandler):
     buffer = io.BytesIO()
     sound.export(buffer, format="wav", tags=tags, bitrate='48k')
 
-    # Store audio in cache
+    # Compress the wav data since it is large
     buffer.seek(0)
     buffer_bytes = buffer.read()
-    compressed_bytes = gzip.compress(buffer_bytes)
-    cache.write_to_cache(compressed_bytes, cache_file_name, cache_suffix, species)
-
-    logger.info(f'Stored audio in file {cache.get_full_filename(cache_file_name, cache_suffix, species)} for url {url}')
-
-    return compressed_bytes
+    return gzip.compress(buffer_bytes)
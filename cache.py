@@ -1,10 +1,133 @@
 # For caching objects in files so that handling requests is much quicker
+import atexit
+import contextlib
+import fnmatch
+import functools
+import glob
 import hashlib
 import os
 import logging
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import compression
+from cacheIndex import CacheIndex
+
+# File locks are used to coordinate multiple processes. Not available on all platforms.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger()
 
+# Directory where cache stored. Thought might use tempfile.gettempdir() but that directory would
+# change each time the app is run and would therefore not cache info across restarts. Therefore just
+# using "/usr/local/imagerCache" even though that is not necessarily portable.
+cache_directory = '/usr/local/imagerCache/'
+
+# Names of the files and directories in the cache directory that are not cache entries, such as
+# the index. Each is added using reserve_name() where it is defined so that the list doesn't get
+# out of date. Used by cacheMigrate.py so that it leaves them alone.
+_reserved_names: set[str] = set()
+
+
+def reserve_name(full_name: str) -> str:
+    """
+    Records that a file or directory in the cache directory is not a cache entry
+    :param full_name: full name of the file or directory, such as cache_directory + 'locks/'
+    :return: the full_name, so that can be used when defining it
+    """
+    _reserved_names.add(os.path.basename(full_name.rstrip('/')))
+    return full_name
+
+
+def reserved_names() -> set[str]:
+    """
+    Returns the names of the files and directories in the cache directory that are not cache entries
+    """
+    return set(_reserved_names)
+
+
+# The files and directories in the cache directory. All are set by use_cache_directory().
+# Cache files are stored in sharded subdirectories of objects_directory, and the index of
+# them, which is loaded into memory, is stored in the index_filename SQLite database.
+objects_directory: str
+index_filename: str
+_index: CacheIndex
+# Corrupt files are moved to the quarantine directory
+quarantine_directory: str
+# Directory of the lock files used for coordinating processes
+lock_directory: str
+# Updated when the cache is erased, and when files are removed, so that other processes notice
+generation_filename: str
+index_generation_filename: str
+# Checkpoints of the warm-up jobs
+warmup_directory: str
+# The startup snapshot written by startupSnapshot.py. Not part of the index so it is never evicted.
+startup_snapshot_filename: str
+
+
+def index() -> CacheIndex:
+    """
+    Returns the index of the cache files
+    """
+    return _index
+
+
+def use_cache_directory(directory: str):
+    """
+    Sets the cache directory and all the files and directories within it, including the index.
+    Called with the default cache_directory when this module is loaded, and can then be called
+    by tools such as cacheMigrate.py that work on a cache other than the default one.
+    :param directory: the cache directory
+    """
+    global cache_directory, objects_directory, index_filename, _index, quarantine_directory, lock_directory, \
+        generation_filename, index_generation_filename, warmup_directory, startup_snapshot_filename
+
+    cache_directory = os.path.join(directory, '')
+    objects_directory = reserve_name(cache_directory + 'objects/')
+    index_filename = reserve_name(cache_directory + 'index.sqlite')
+    quarantine_directory = reserve_name(cache_directory + 'quarantine/')
+    lock_directory = reserve_name(cache_directory + 'locks/')
+    generation_filename = reserve_name(cache_directory + 'generation')
+    index_generation_filename = reserve_name(cache_directory + 'indexGeneration')
+    warmup_directory = reserve_name(cache_directory + 'warmup/')
+    startup_snapshot_filename = reserve_name(cache_directory + 'startupSnapshot.bin')
+
+    # Log files are in the logs directory, as specified by loggingConfig.logging_dir
+    reserve_name(cache_directory + 'logs/')
+
+    _index = CacheIndex(index_filename)
+
+
+use_cache_directory(cache_directory)
+
+# If fsync_writes is set then cache files are flushed to disk before they are renamed into place.
+# Safer if the host loses power, but slower.
+fsync_writes = False
+
+# Files that this process has already checked. True if the contents were checked for being complete,
+# False if just the size was checked against the index. Guarded by _validated_files_lock.
+_validated_files: dict[str, bool] = {}
+_validated_files_lock = threading.Lock()
+
+# Limits for the in memory tier of the cache. Popular data is kept in memory, in least recently used
+# order, so that it doesn't need to be read from disk each time. Each namespace, determined by the
+# file suffix, has its own limit and all of them together are limited by memory_cache_max_bytes.
+memory_cache_max_bytes = 96 * 1024 * 1024
+memory_cache_namespace_max_bytes = {
+    'json': 24 * 1024 * 1024,
+    'png': 8 * 1024 * 1024,
+    'wav.gz': 64 * 1024 * 1024,
+    'other': 4 * 1024 * 1024,
+}
+
 
 def stable_hash_str(key: str) -> str:
     """
@@ -43,26 +166,210 @@ def proper_filename(filename):
     return filename.replace(" ", "_").replace("'", "")
 
 
+def cache_key(name, suffix='', subdir=''):
+    """
+    Returns the key that identifies a cached file in the index. It is the relative path that the
+    file had in the original, unsharded, layout of the cache, such as "Wood_Duck/image_ML12345.png"
+    or "speciesDataCache.json". Human readable so that the index can easily be examined.
+    :param name: of the object being stored. Can be a string or a hash of  URL
+    :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
+    :param subdir: subdirectory. Useful if want to add species. The specified name
+    will be processed into a proper file name (e.g. no blanks nor single quotes)
+    :return: the key
+    """
+    if subdir:
+        return proper_filename(subdir) + '/' + name + suffix
+    return name + suffix
+
+
+def path_for_key(key: str) -> str:
+    """
+    Returns the full filename for a cache key. Files are sharded into directories based on a hash of
+    the key so that no directory gets too large, no matter how many species or images are cached.
+    The suffix, such as .png or .wav.gz, is kept so that the type of a file is still obvious.
+    :param key: the cache key, as returned by cache_key()
+    :return: the full filename of the file in the cache
+    """
+    key_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    basename = key[key.rfind('/') + 1:]
+    extension = basename[basename.find('.'):] if '.' in basename else ''
+    return f'{objects_directory}{key_hash[0:2]}/{key_hash[2:4]}/{key_hash}{extension}'
+
+
 def get_full_filename(name, suffix='', subdir=''):
     """
-    Returns the full filename for the cached file. Will have suffix appended.
+    Returns the full filename for the cached file. Will have suffix appended. Does not create
+    the directory, which is only done when the file is actually written, so is cheap to call.
     :param name: of the object being stored. Can be a string or a hash of  URL
     :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
     :param subdir: subdirectory. Useful if want to add species. The specified name
     will be processed into a proper file name (e.g. no blanks nor single quotes)
     :return: the full filename of the file in the cache
     """
-    # Determine directory where cache stored. Thought might use tempfile.gettempdir() but that directory would
-    # change each time the app is run and would therefore not cache info across restarts. Therefore just
-    # using "/usr/local/imagerCache" even though that is not necessarily portable.
-    directory = '/usr/local/imagerCache/'
-    full_directory = directory + proper_filename(subdir) + "/"
+    return path_for_key(cache_key(name, suffix, subdir))
+
+
+def _namespace(full_filename: str) -> str:
+    """
+    Returns the namespace of the in memory cache that the file belongs to
+    :param full_filename: full name of the cache file
+    :return: 'json', 'png', 'wav.gz', or 'other'
+    """
+    for namespace in ('json', 'png', 'wav.gz'):
+        if full_filename.endswith('.' + namespace):
+            return namespace
+
+    # Compressed versions of json files, like speciesDataCache.json.gz, are also json
+    for encoding_suffix in compression.encoding_suffixes.values():
+        if full_filename.endswith('.json' + encoding_suffix):
+            return 'json'
+
+    return 'other'
+
+
+class _MemoryTier:
+    """
+    Bounded in memory least recently used cache of file contents, layered over the file cache.
+    Keyed by the full filename of the cache file. The size is limited both in total and per
+    namespace. Keeps hit and miss counts per namespace so that can tell how useful it is.
+    """
+
+    def __init__(self, max_bytes: int, namespace_max_bytes: dict[str, int]):
+        self.max_bytes = max_bytes
+        self.namespace_max_bytes = namespace_max_bytes
+
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._total_bytes = 0
+        self._namespace_bytes = {namespace: 0 for namespace in namespace_max_bytes}
+        self._hits = {namespace: 0 for namespace in namespace_max_bytes}
+        self._misses = {namespace: 0 for namespace in namespace_max_bytes}
+        self._lock = threading.Lock()
+
+    def contains(self, key: str) -> bool:
+        """
+        Returns true if data for the key is in memory. Doesn't count as a hit or miss.
+        """
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str):
+        """
+        Returns the data for the key, or None if it is not in memory
+        """
+        namespace = _namespace(key)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self._misses[namespace] += 1
+                return None
+
+            self._hits[namespace] += 1
+            self._entries.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes):
+        """
+        Stores the data for the key, evicting the least recently used entries if needed to stay
+        within the limits. Data that is too large for the namespace is not stored at all.
+        """
+        namespace = _namespace(key)
+        namespace_max_bytes = self.namespace_max_bytes[namespace]
+        if len(data) > namespace_max_bytes // 4:
+            return
 
-    # Make sure the directory exists
-    os.makedirs(full_directory, exist_ok=True)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = data
+            self._total_bytes += len(data)
+            self._namespace_bytes[namespace] += len(data)
 
-    filename = full_directory + name + suffix
-    return filename
+            # Evict least recently used entries of the namespace until it is within its limit
+            for lru_key in list(self._entries):
+                if self._namespace_bytes[namespace] <= namespace_max_bytes:
+                    break
+                if _namespace(lru_key) == namespace:
+                    self._remove(lru_key)
+
+            # Evict least recently used entries of any namespace until within the total limit
+            while self._total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        """
+        Removes the entry for the key. Lock must already be held.
+        """
+        data = self._entries.pop(key, None)
+        if data is not None:
+            self._total_bytes -= len(data)
+            self._namespace_bytes[_namespace(key)] -= len(data)
+
+    def remove(self, key: str):
+        """
+        Removes the entry for the key, if there is one
+        """
+        with self._lock:
+            self._remove(key)
+
+    def remove_matching(self, predicate):
+        """
+        Removes all entries whose key matches the predicate
+        :param predicate: function that takes a key and returns true if entry is to be removed
+        :return: number of entries removed
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of entries, bytes used, hits and misses, both per namespace and in total
+        """
+        with self._lock:
+            namespaces = {}
+            for namespace in self.namespace_max_bytes:
+                namespaces[namespace] = {
+                    'entries': sum(1 for key in self._entries if _namespace(key) == namespace),
+                    'bytes': self._namespace_bytes[namespace],
+                    'maxBytes': self.namespace_max_bytes[namespace],
+                    'hits': self._hits[namespace],
+                    'misses': self._misses[namespace]}
+            return {'entries': len(self._entries),
+                    'bytes': self._total_bytes,
+                    'maxBytes': self.max_bytes,
+                    'hits': sum(self._hits.values()),
+                    'misses': sum(self._misses.values()),
+                    'namespaces': namespaces}
+
+
+_memory_tier = _MemoryTier(memory_cache_max_bytes, memory_cache_namespace_max_bytes)
+
+
+def memory_cache_stats() -> dict:
+    """
+    Returns statistics for the in memory tier of the cache, including hit and miss counts
+    :return: dictionary of the statistics
+    """
+    return _memory_tier.stats()
+
+
+def all_entries() -> list:
+    """
+    Returns the index entries for all of the files in the cache, including ones written by
+    other processes that share the cache
+    :return: list of cacheIndex.CacheEntry
+    """
+    return _index.entries_from_db()
+
+
+def disk_cache_stats() -> dict:
+    """
+    Returns the number of files and bytes in the file cache, per kind of file. Determined from
+    the index so no file system calls are needed.
+    :return: dictionary of the statistics
+    """
+    return _index.stats()
 
 
 def write_to_cache(data, filename, suffix='', subdir=''):
@@ -77,23 +384,365 @@ def write_to_cache(data, filename, suffix='', subdir=''):
     if isinstance(data, str):
         data = bytes(data, 'utf-8')
 
-    full_filename = get_full_filename(filename, suffix, subdir)
-    file = open(full_filename, 'wb')
-    file.write(data)
+    key = cache_key(filename, suffix, subdir)
+    _store(key, data)
+
+    # Any compressed or uncompressed versions of the file are now out of date
+    _remove_derived_versions(key)
+
+
+def _store(key: str, data: bytes):
+    """
+    Writes the data to the file for the key, records it in the index, and keeps it in memory
+    :param key: the cache key
+    :param data: the bytes to store
+    """
+    full_filename = path_for_key(key)
+    atomic_write(full_filename, data)
+    stat = os.stat(full_filename)
+    _index.record(key, full_filename, stat.st_size, stat.st_mtime_ns)
+
+    # Also keep it in memory since it will likely be requested again soon
+    _memory_tier.put(full_filename, data)
+
+
+def atomic_write(full_filename: str, data: bytes):
+    """
+    Writes the file so that readers, in this process or in other processes, never see a partially
+    written file. The data is written to a temporary file in the same directory, optionally fsynced,
+    and then atomically renamed to the final name. If the process crashes while writing then only
+    the temporary file is left behind and the cache file simply doesn't exist yet.
+    :param full_filename: full name of the cache file
+    :param data: the bytes to write
+    """
+    directory, basename = os.path.split(full_filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.' + basename + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            if fsync_writes:
+                file.flush()
+                os.fsync(file.fileno())
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, full_filename)
+    except BaseException:
+        try:
+            os.remove(tmp_filename)
+        except FileNotFoundError:
+            pass
+        raise
+
+    with _validated_files_lock:
+        _validated_files[full_filename] = True
+
+
+# When checking that a gzip file is complete it is decompressed in chunks of at most this many
+# bytes, which are thrown away, so that a large wav file is never fully decompressed into memory
+gzip_check_chunk_bytes = 256 * 1024
+
+
+def _is_complete_gzip(data: bytes) -> bool:
+    """
+    Returns true if the gzip stream is complete. A truncated stream doesn't reach the end of the
+    compressed data. Both the input and the output are handled in bounded chunks, and the output
+    is discarded, so memory use doesn't depend on the size of the file.
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    view = memoryview(data)
+    try:
+        for offset in range(0, len(view), gzip_check_chunk_bytes):
+            pending = view[offset:offset + gzip_check_chunk_bytes]
+            while pending and not decompressor.eof:
+                decompressor.decompress(pending, gzip_check_chunk_bytes)
+                pending = decompressor.unconsumed_tail
+            if decompressor.eof:
+                return True
+
+        # All of the input has been consumed but output might still be buffered
+        while not decompressor.eof:
+            if not decompressor.decompress(b'', gzip_check_chunk_bytes):
+                return False
+    except zlib.error:
+        return False
+    return True
+
+
+def _is_complete(full_filename: str, data: bytes) -> bool:
+    """
+    Does a quick check of whether cached data is complete, based on the type of file. Files written
+    by older versions, or while the server crashed, might have been truncated.
+    :param full_filename: full name of the cache file, used to determine the type of data
+    :param data: the contents of the file
+    :return: True if the data appears to be complete
+    """
+    if full_filename.endswith('.png'):
+        return data.startswith(b'\x89PNG\r\n\x1a\n') and data.endswith(b'IEND\xaeB`\x82')
+
+    if full_filename.endswith('.gz'):
+        return _is_complete_gzip(data)
+
+    if full_filename.endswith('.br'):
+        if compression.brotli is None:
+            return True
+        try:
+            compression.brotli.decompress(data)
+        except compression.brotli.error:
+            return False
+        return True
+
+    if full_filename.endswith('.wav'):
+        # RIFF header specifies the size of the rest of the file
+        return (len(data) >= 8 and data.startswith(b'RIFF') and
+                int.from_bytes(data[4:8], 'little') + 8 <= len(data))
+
+    if full_filename.endswith('.json'):
+        stripped = data.rstrip()
+        return stripped.endswith(b'}') or stripped.endswith(b']')
+
+    return True
+
+
+def _quarantine(key: str, full_filename: str):
+    """
+    Moves a corrupt cache file into the quarantine directory so that it is no longer used and will
+    be recreated, but can still be looked at to determine what went wrong
+    :param key: the cache key of the file
+    :param full_filename: full name of the corrupt cache file
+    """
+    os.makedirs(quarantine_directory, exist_ok=True)
+    quarantine_filename = f'{quarantine_directory}{int(time.time())}_{key.replace("/", "__")}'
+    try:
+        os.replace(full_filename, quarantine_filename)
+        logger.error(f'Cache file {key} was truncated or corrupt so moved it to {quarantine_filename}')
+    except FileNotFoundError:
+        # Another thread or process already quarantined it
+        pass
+
+    _index.remove(key)
+    _memory_tier.remove(full_filename)
+    with _validated_files_lock:
+        _validated_files.pop(full_filename, None)
+
+
+class CorruptCacheFileError(Exception):
+    """
+    Raised when a cache file that is being read turns out to be truncated or corrupt. The file
+    has already been quarantined so retrying the request will recreate it.
+    """
+    pass
+
+
+def _read_and_validate(key: str, full_filename: str) -> bytes:
+    """
+    Reads a cache file from disk. The first time a file is read by this process it is checked to make
+    sure it is complete. If it is not then it is quarantined.
+    :param key: the cache key of the file
+    :param full_filename: full name of the cache file
+    :return: the data, or None if the file was corrupt and has been quarantined
+    """
+    file = open(full_filename, 'rb')
+    data = file.read()
     file.close()
 
+    with _validated_files_lock:
+        already_validated = _validated_files.get(full_filename, False)
+    if not already_validated:
+        if not _is_complete(full_filename, data):
+            _quarantine(key, full_filename)
+            return None
+        with _validated_files_lock:
+            _validated_files[full_filename] = True
+
+    _memory_tier.put(full_filename, data)
+    return data
+
+
+def remove_file(key: str):
+    """
+    Removes a cache file, from disk, from memory, and from the index
+    :param key: the cache key of the file
+    :return: number of bytes removed from disk, or None if the file didn't exist, such as when another
+    process already removed it
+    """
+    full_filename = path_for_key(key)
+    _memory_tier.remove(full_filename)
+    with _validated_files_lock:
+        _validated_files.pop(full_filename, None)
+
+    entry = _index.get(key)
+    _index.remove(key)
+    try:
+        # Might have been written by another process after this one loaded its index
+        size = entry.size if entry is not None else os.stat(full_filename).st_size
+        os.remove(full_filename)
+    except FileNotFoundError:
+        return None
+    return size
+
+
+def _encoded_keys(key: str) -> list[str]:
+    """
+    Returns the cache keys of the compressed versions of a cache file. Only json files are served
+    compressed, so for other files, such as an uncompressed .wav whose gzipped source is .wav.gz,
+    there are none.
+    :param key: the cache key of the uncompressed file
+    """
+    if not key.endswith('.json'):
+        return []
+    return [key + encoding_suffix for encoding_suffix in compression.encoding_suffixes.values()]
+
+
+def _derived_keys(key: str) -> list[str]:
+    """
+    Returns the cache keys of the files that are created from a cache file: its compressed versions,
+    and for a gzipped file such as audio_ML1.wav.gz its uncompressed version audio_ML1.wav
+    :param key: the cache key of the file
+    """
+    derived_keys = _encoded_keys(key)
+    gzip_suffix = compression.encoding_suffixes['gzip']
+    if key.endswith(gzip_suffix) and not key.endswith('.json' + gzip_suffix):
+        derived_keys.append(key[:-len(gzip_suffix)])
+    return derived_keys
+
+
+def _remove_derived_versions(key: str):
+    """
+    Removes the files that were created from a cache file, both from memory and from disk
+    :param key: the cache key of the file
+    """
+    for derived_key in _derived_keys(key):
+        remove_file(derived_key)
+
+
+def _resync_with_disk(key: str):
+    """
+    For when another process has changed a cache file. Drops what this process has in memory for the
+    file, so that it will be read and validated again, and updates the index from the file on disk.
+    :param key: the cache key
+    """
+    full_filename = path_for_key(key)
+    _memory_tier.remove(full_filename)
+    with _validated_files_lock:
+        _validated_files.pop(full_filename, None)
+    try:
+        stat = os.stat(full_filename)
+        _index.record(key, full_filename, stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        _index.remove(key)
+
+
+def resync(filename, suffix='', subdir=''):
+    """
+    For when a cache file turns out to be different on disk than expected, such as removed by eviction
+    or by another process after it was found to exist. Updates what this process knows about the file.
+    :param filename: name of the cache file
+    :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
+    :param subdir: subdirectory. Useful if want to add species
+    """
+    _resync_with_disk(cache_key(filename, suffix, subdir))
+
+
+def read_encoded_from_cache(filename, encoding, suffix='', subdir=''):
+    """
+    Returns the cached data compressed using the specified content encoding. The compressed version
+    is stored as a separate cache file, such as speciesDataCache.json.gz, so that it only needs to be
+    compressed once instead of for every request.
+    :param filename: name of the cache file
+    :param encoding: the content encoding, 'gzip' or 'br'
+    :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
+    :param subdir: subdirectory. Useful if want to add species
+    :return: the compressed data
+    """
+    encoding_suffix = compression.encoding_suffixes[encoding]
+
+    # If already have compressed version then use it
+    if file_exists(filename, suffix + encoding_suffix, subdir):
+        return read_from_cache(filename, suffix + encoding_suffix, subdir)
+
+    # Create and store the compressed version
+    key = cache_key(filename, suffix, subdir)
+    logger.info(f'Creating {encoding} version of cache file {key}')
+    encoded_data = compression.compress(read_from_cache(filename, suffix, subdir), encoding)
+    _store(key + encoding_suffix, encoded_data)
+
+    return encoded_data
+
+
+def _index_entry(key: str):
+    """
+    Returns the index entry for the key. When multiple processes share the cache another process
+    might have just written the file, so then if it is not in the index the file system is checked.
+    Otherwise a missing file is determined just from the index.
+    :param key: the cache key
+    :return: the CacheEntry, or None if there is no such cache file
+    """
+    entry = _index.get(key)
+    if entry is not None or not use_cross_process_locks:
+        return entry
+
+    full_filename = path_for_key(key)
+    try:
+        stat = os.stat(full_filename)
+    except FileNotFoundError:
+        return None
+    _index.record(key, full_filename, stat.st_size, stat.st_mtime_ns)
+    return _index.get(key)
+
 
 def file_exists(filename, suffix='', subdir=''):
     """
-    Returns true if file exists
+    Returns true if file exists. Determined from the index, so no file system calls are needed
+    except for a stat the first time that a file is used by this process.
     :param filename: if URL should use str(hash(url))
     :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
     :param subdir: subdirectory. Useful if want to add species
     :return: true if file exists
     """
-    exists = os.path.isfile(get_full_filename(filename, suffix, subdir))
+    key = cache_key(filename, suffix, subdir)
+    entry = _index_entry(key)
+    if entry is None:
+        return False
+
+    full_filename = entry.path
+    if _memory_tier.contains(full_filename):
+        return True
 
-    return exists
+    # The first time a file is seen by this process make sure that its size is still the one in
+    # the index. A file that was truncated is quarantined and treated as not existing so that it
+    # will be recreated. The contents are checked when the file is read, or by validate_files().
+    with _validated_files_lock:
+        already_validated = full_filename in _validated_files
+    if not already_validated:
+        try:
+            stat = os.stat(full_filename)
+        except FileNotFoundError:
+            # File was removed without the index being updated
+            _index.remove(key)
+            return False
+        if stat.st_size != entry.size:
+            if stat.st_mtime_ns == entry.mtime_ns:
+                _quarantine(key, full_filename)
+                return False
+            # Replaced by another process since this process loaded the index
+            _resync_with_disk(key)
+        with _validated_files_lock:
+            _validated_files.setdefault(full_filename, False)
+
+    return True
+
+
+def file_stat(filename, suffix='', subdir=''):
+    """
+    Returns the size and modification time of the cache file, from the index. Useful for creating
+    validators like ETags without having to read the file.
+    :param filename: if URL should use str(hash(url))
+    :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
+    :param subdir: subdirectory. Useful if want to add species
+    :return: the CacheEntry, which provides st_size, st_mtime, and st_mtime_ns like an
+    os.stat_result, or None if the file doesn't exist
+    """
+    return _index_entry(cache_key(filename, suffix, subdir))
 
 
 def read_from_cache(filename, suffix='', subdir=''):
@@ -106,43 +755,551 @@ def read_from_cache(filename, suffix='', subdir=''):
     :param subdir: subdirectory. Useful if want to add species
     :return: the str data stored in the file
     """
-    full_filename = get_full_filename(filename, suffix, subdir)
-    file = open(full_filename, 'rb')
-    data = file.read()
-    file.close()
+    key = cache_key(filename, suffix, subdir)
+    _index.touch(key)
+
+    # Use in memory tier if can
+    full_filename = path_for_key(key)
+    data = _memory_tier.get(full_filename)
+    if data is not None:
+        return data
+
+    data = _read_and_validate(key, full_filename)
+    if data is None:
+        raise CorruptCacheFileError(f'Cache file {key} was corrupt')
     return data
 
 
-def fill_species_cache():
-    """"
-    Gets list of species and for each one determines the data for the species and caches it
-    into a json file for the species. Pauses 2 seconds between each species so that don't
-    bog everything down.
+# Pause between the files checked by validate_files() so that it doesn't compete with requests for the disk
+validation_pause_sec = 0.05
+
+
+def validate_files() -> int:
+    """
+    Checks that the contents of each cache file that this process hasn't checked yet are complete,
+    and quarantines the ones that are not. file_exists() only checks the size, so this catches files
+    that were truncated by older versions or by a crash, including ones that are never read into
+    memory, such as uncompressed wav files that are served with sendfile. When multiple processes
+    share the cache only one of them does the check.
+    :return: number of files that were quarantined
+    """
+    quarantined = 0
+    with cross_process_lock('cacheValidation', blocking=False) as acquired:
+        if not acquired:
+            return 0
+        for entry in _index.entries():
+            with _validated_files_lock:
+                if _validated_files.get(entry.path, False):
+                    continue
+            try:
+                with open(entry.path, 'rb') as file:
+                    data = file.read()
+            except FileNotFoundError:
+                continue
+
+            if _is_complete(entry.path, data):
+                with _validated_files_lock:
+                    _validated_files[entry.path] = True
+            else:
+                _quarantine(entry.key, entry.path)
+                quarantined += 1
+            time.sleep(validation_pause_sec)
+
+    logger.info(f'Validated the cache files and quarantined {quarantined} of them')
+    return quarantined
+
+
+def validate_files_in_background():
+    """
+    Runs validate_files() in a background thread, such as when the server starts
+    """
+    def run():
+        try:
+            validate_files()
+        except Exception:
+            logger.exception('Exception while validating the cache files')
+
+    threading.Thread(target=run, name='cacheValidation', daemon=True).start()
+
+
+# The last access times in the index are only written periodically so write them when exiting
+atexit.register(lambda: _index.flush())
+
+
+# Set to True when multiple server processes share the cache, such as in pre-fork mode. Then
+# computations for a cache key are also coordinated between the processes using file locks.
+use_cross_process_locks = False
+
+
+@contextlib.contextmanager
+def cross_process_lock(key: str, blocking: bool = True):
+    """
+    Context manager that holds an exclusive file lock for the key so that only one process at a
+    time does the work for it. If file locks are not available on the platform then does nothing.
+    :param key: identifies the cached item, such as the full filename of the cache file
+    :param blocking: if False then doesn't wait if another process holds the lock
+    :return: yields True if the lock was acquired, False if not blocking and another process has it
+    """
+    if fcntl is None:
+        yield True
+        return
+
+    os.makedirs(lock_directory, exist_ok=True)
+    fd = os.open(lock_directory + stable_hash_str(key) + '.lock', os.O_CREAT | os.O_RDWR, 0o666)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+# For keeping the in memory data of multiple server processes coherent. When the cache is erased
+# the generation file is updated. Each process checks the generation file, at most once every
+# generation_check_interval_sec, and clears its in memory data if another process changed it.
+# When files are just removed from the cache, such as by eviction, the index generation file is
+# updated instead and the other processes then only need to reload the index. The files are
+# generation_filename and index_generation_filename.
+generation_check_interval_sec = 1.0
+_last_generation_check = 0.0
+_last_generation_mtimes: dict[str, int] = {}
+_last_generation_check_done = False
+_generation_lock = threading.Lock()
+
+
+def _generation_mtime_ns(filename: str):
+    """
+    Returns modification time of the generation file, or None if it doesn't exist
+    """
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def bump_generation(filename: str = None):
+    """
+    Updates the generation file so that other processes know to clear their in memory data
+    :param filename: the generation file to update. If None then generation_filename.
+    """
+    filename = filename or generation_filename
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as file:
+        file.write(str(time.time()))
+    with _generation_lock:
+        _last_generation_mtimes[filename] = _generation_mtime_ns(filename)
+
+
+def index_changed():
+    """
+    Lets any other server processes know that files were removed from the cache so that they
+    reload the index. Only needed when multiple server processes share the cache.
+    """
+    if use_cross_process_locks:
+        bump_generation(index_generation_filename)
+
+
+def sync_with_other_processes():
+    """
+    Clears the in memory tier and the memos if another process has erased the cache since the
+    last check, and reloads the index if another process removed files. Cheap enough to call
+    for every request since the generation files are only checked once every
+    generation_check_interval_sec.
+    """
+    global _last_generation_check, _last_generation_check_done
+
+    now = time.monotonic()
+    changed = set()
+    with _generation_lock:
+        if now - _last_generation_check < generation_check_interval_sec:
+            return
+        _last_generation_check = now
+
+        for filename in (generation_filename, index_generation_filename):
+            mtime_ns = _generation_mtime_ns(filename)
+            if _last_generation_check_done and mtime_ns != _last_generation_mtimes.get(filename):
+                changed.add(filename)
+            _last_generation_mtimes[filename] = mtime_ns
+        _last_generation_check_done = True
+
+    if generation_filename in changed:
+        logger.info('Cache was erased by another process so clearing in memory data')
+        _memory_tier.remove_matching(lambda key: True)
+        invalidate_memos()
+    if changed:
+        _index.load()
+
+
+class _InFlight:
+    """
+    Bookkeeping for a single computation that is currently in progress. Requests that arrive while
+    the computation is running wait on the event and then share the result or the exception.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+# Registry of computations in progress, keyed by cache key. Guarded by _in_flight_lock.
+_in_flight: dict[str, _InFlight] = {}
+_in_flight_lock = threading.Lock()
+
+
+def single_flight(key: str, compute, cross_process: bool = True):
+    """
+    Makes sure that only a single thread computes the value for the specified cache key at a time.
+    The first caller for a key runs compute(). Callers that arrive while that is still running
+    don't do the work again. Instead they wait for the first caller to finish and then return
+    the same result, or raise the same exception. Very useful right after the cache has been
+    erased or the server restarted, when many clients ask for the same uncached data at once.
+    Note: compute() should check the cache itself since a caller can arrive just after a previous
+    computation finished and was removed from the registry. This is also how other processes
+    waiting on the cross process lock end up using the result instead of computing it again.
+    :param key: identifies the cached item, such as the full filename of the cache file
+    :param compute: function without parameters that creates, caches, and returns the value
+    :param cross_process: if False then the computation is only coordinated between the threads of
+    this process, such as when the key is not for a cache file
+    :return: the value returned by compute()
+    """
+    with _in_flight_lock:
+        in_flight = _in_flight.get(key)
+        is_leader = in_flight is None
+        if is_leader:
+            in_flight = _InFlight()
+            _in_flight[key] = in_flight
+
+    if not is_leader:
+        # Another thread is already doing the work so just wait for it
+        logger.info(f'Waiting for in progress computation of {key}')
+        in_flight.done.wait()
+        if in_flight.exception is not None:
+            raise in_flight.exception
+        return in_flight.result
+
+    try:
+        # If multiple server processes share the cache then also make sure that only one
+        # process at a time does the work. The others then find the result in the cache.
+        if use_cross_process_locks and cross_process:
+            with cross_process_lock(key):
+                in_flight.result = compute()
+        else:
+            in_flight.result = compute()
+        return in_flight.result
+    except BaseException as e:
+        in_flight.exception = e
+        raise
+    finally:
+        # Done so remove from registry and wake up any waiting threads
+        with _in_flight_lock:
+            del _in_flight[key]
+        in_flight.done.set()
+
+
+# Memoized results of functions, keyed by (function name, args). Guarded by _memos_lock. The
+# generation is incremented whenever memos are invalidated so that a computation that started
+# before the invalidation doesn't store its possibly stale result afterwards.
+_memos: dict[tuple, object] = {}
+_memos_lock = threading.Lock()
+_memos_generation = 0
+
+
+def memoized(func=None, *, cache_file=None):
+    """
+    Decorator that keeps the results of a function in memory so that it is only computed once.
+    Thread safe, and if multiple threads call the function with the same args at the same time
+    then it is only computed once, via single_flight(). A result of None, or one wrapped by
+    not_memoized(), is not memoized so that failures are retried. The memos can be cleared using invalidate_memos().
+    Args must be hashable. For methods the args include self.
+    Can be used as @memoized, or as @memoized(cache_file=...) for functions that create a cache file.
+    Only for those is the computation also coordinated between processes, using the cross process
+    lock of the cache file, so that there is just one lock file per cache file and none for the
+    memos of functions that only use data that another memoized function already read or created.
+    :param func: the function to be memoized
+    :param cache_file: optional function that is passed the args and returns the (name, suffix, subdir)
+    of the cache file that the function creates, or None if no file is to be created for those args
+    :return: the memoizing wrapper
+    """
+    if func is None:
+        return lambda f: memoized(f, cache_file=cache_file)
+
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = (name,) + args
+        with _memos_lock:
+            if key in _memos:
+                return _memos[key]
+
+        file = cache_file(*args) if cache_file is not None and use_cross_process_locks else None
+        if file is None:
+            return single_flight(f'memo {key}', lambda: _compute_memo(key, func, args), cross_process=False)
+
+        def compute_with_file_lock():
+            with cross_process_lock(get_full_filename(*file)):
+                return _compute_memo(key, func, args)
+
+        return single_flight(f'memo {key}', compute_with_file_lock, cross_process=False)
+
+    return wrapper
+
+
+class _NotMemoized:
     """
-    from ebird import ebird
-    import time
+    Wraps a result that a memoized function returns but that should not be memoized
+    """
+    __slots__ = ('value',)
 
-    logger.info("Caching all species...")
-    species_list = ebird.get_species_name_list()
-    for species_name in species_list:
-        logger.debug(f"Caching species: {species_name}")
-        ebird.get_species_info(species_name)
+    def __init__(self, value):
+        self.value = value
 
-        # Don't bog down server
-        time.sleep(2.0)
 
-    logger.info("Dont caching all species")
+def not_memoized(value):
+    """
+    For a memoized function to return a value that should not be memoized, such as a partial
+    result, so that the function is called again next time
+    :param value: the value to be returned to the caller
+    :return: wrapped value, which the memoized decorator unwraps
+    """
+    return _NotMemoized(value)
 
 
-def erase_cache():
+def _compute_memo(key: tuple, func, args: tuple):
+    """
+    Computes the value for a memo and stores it, unless the memos were invalidated in the meantime
     """
-    Does system call to remove all the server side cache files. This way fresh
+    with _memos_lock:
+        if key in _memos:
+            return _memos[key]
+        generation = _memos_generation
+
+    result = func(*args)
+    if isinstance(result, _NotMemoized):
+        return result.value
+
+    if result is not None:
+        with _memos_lock:
+            if generation == _memos_generation:
+                _memos[key] = result
+
+    return result
+
+
+def invalidate_memos(name: str = None, args: tuple = None) -> int:
+    """
+    Clears memoized results so that they will be recomputed the next time they are needed
+    :param name: qualified name of the function, such as 'EBird.get_species_info', whose results
+    are to be cleared. If None then all memos are cleared.
+    :param args: if specified then only the result for these args is cleared. For methods the
+    args include self.
+    :return: number of memos cleared
+    """
+    global _memos_generation
+
+    with _memos_lock:
+        _memos_generation += 1
+        if name is not None and args is not None:
+            keys = [key for key in [(name,) + args] if key in _memos]
+        else:
+            keys = [key for key in _memos if name is None or key[0] == name]
+        for key in keys:
+            del _memos[key]
+
+    logger.info(f'Invalidated {len(keys)} memos for {"all functions" if name is None else name}')
+    return len(keys)
+
+
+# For stale-while-revalidate. When a cache file is older than its time to live it is still used,
+# but it is regenerated in the background and then atomically swapped in. This way clients
+# never have to wait for data to be scraped again. The refreshes are done by a small thread
+# pool, and if a refresh fails it is not retried until refresh_retry_sec has passed.
+refresh_workers = 2
+refresh_retry_sec = 600.0
+_refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='cacheRefresh')
+_refreshing: set[str] = set()
+_refresh_failures: dict[str, float] = {}
+_refresh_lock = threading.Lock()
+
+
+def is_stale(filename, suffix='', subdir='', ttl_sec: float = None) -> bool:
+    """
+    Returns true if the cache file exists but is older than its time to live. Determined from
+    the index so is cheap enough to call for every request.
+    :param filename: name of the cache file
+    :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
+    :param subdir: subdirectory. Useful if want to add species
+    :param ttl_sec: time to live of the file. If None then the file never becomes stale.
+    :return: true if the file is stale
+    """
+    if ttl_sec is None:
+        return False
+    entry = _index.get(cache_key(filename, suffix, subdir))
+    return entry is not None and time.time() - entry.st_mtime > ttl_sec
+
+
+def refresh_if_stale(filename, suffix='', subdir='', ttl_sec: float = None, regenerate=None, on_refreshed=None):
+    """
+    If the cache file is stale then starts regenerating it in the background. The stale file
+    continues to be used until the new one has been written.
+    :param filename: name of the cache file
+    :param suffix: blank if specified in name. Otherwise .wav, .png, or .json, etc
+    :param subdir: subdirectory. Useful if want to add species
+    :param ttl_sec: time to live of the file. If None then the file never becomes stale.
+    :param regenerate: function that returns the new data for the file, as str or bytes. Can return
+    None if the data could not be determined, in which case the stale file continues to be used.
+    :param on_refreshed: optional function called after the new file has been written, such as for
+    invalidating memos that were created from the old file
+    :return: true if a refresh was started
+    """
+    if not is_stale(filename, suffix, subdir, ttl_sec):
+        return False
+
+    key = cache_key(filename, suffix, subdir)
+    with _refresh_lock:
+        if key in _refreshing or time.monotonic() - _refresh_failures.get(key, -refresh_retry_sec) < refresh_retry_sec:
+            return False
+        _refreshing.add(key)
+
+    logger.info(f'Cache file {key} is older than {ttl_sec} seconds so refreshing it in the background')
+    _refresh_executor.submit(_refresh, key, filename, suffix, subdir, ttl_sec, regenerate, on_refreshed)
+    return True
+
+
+def _refresh(key: str, filename, suffix, subdir, ttl_sec: float, regenerate, on_refreshed):
+    """
+    Regenerates a stale cache file. Runs in the refresh thread pool.
+    """
+    try:
+        # When multiple processes share the cache only one of them regenerates the file. The others
+        # wait and then find that the file on disk is now fresh, so they just start using it.
+        with cross_process_lock('refresh ' + key) if use_cross_process_locks else contextlib.nullcontext():
+            stat = os.stat(path_for_key(key))
+            if time.time() - stat.st_mtime <= ttl_sec:
+                # The other process also removed the derived versions, which this process might
+                # still have in memory and in its index
+                logger.info(f'Cache file {key} was already refreshed by another process')
+                for changed_key in [key] + _derived_keys(key):
+                    _resync_with_disk(changed_key)
+            else:
+                data = regenerate()
+                if data is None:
+                    raise ValueError('no data was generated')
+                write_to_cache(data, filename, suffix, subdir)
+                logger.info(f'Refreshed cache file {key}')
+
+        if on_refreshed is not None:
+            on_refreshed()
+        with _refresh_lock:
+            _refresh_failures.pop(key, None)
+    except Exception as e:
+        logger.error(f'Could not refresh cache file {key} so will continue to use the stale one. {e}')
+        with _refresh_lock:
+            _refresh_failures[key] = time.monotonic()
+    finally:
+        with _refresh_lock:
+            _refreshing.discard(key)
+
+
+def invalidate(pattern) -> dict:
+    """
+    Removes the cache files whose keys match the glob pattern. The files are removed from disk,
+    from the in memory tier, and from the index, and all memos are cleared since they might have
+    been created from the files. Other server processes are told to clear their in memory data too.
+    Keys are like "Wood_Duck/speciesDataCache.json" or "groupsCache.json".
+    :param pattern: glob pattern, such as "Wood_Duck/*" or "*Cache.json*", or list of them in which
+    case the files matching any of them are removed
+    :return: dictionary with the number of files and bytes removed
+    """
+    # A single matcher for all of the patterns so that the index only needs to be gone through once
+    patterns = [pattern] if isinstance(pattern, str) else pattern
+    matcher = re.compile('|'.join(fnmatch.translate(p) for p in patterns)) if patterns else None
+    files = 0
+    freed_bytes = 0
+
+    # The database, instead of the in memory index, since other processes might have written files
+    # after this process loaded its index
+    for entry in _index.entries_from_db() if matcher is not None else []:
+        if matcher.match(entry.key):
+            removed_bytes = remove_file(entry.key)
+
+            # Another process might have removed it already
+            if removed_bytes is not None:
+                files += 1
+                freed_bytes += removed_bytes
+
+    invalidate_memos()
+
+    # Let any other server processes know that they need to clear their in memory data too
+    bump_generation()
+
+    logger.info(f'Invalidated {files} cache files, {freed_bytes} bytes, matching {pattern}')
+    return {'pattern': pattern, 'files': files, 'bytes': freed_bytes}
+
+
+def _species_pattern(species_name: str, include_media: bool) -> str:
+    """
+    Returns the glob pattern for the cache keys of a species
+    :param species_name: name of the species
+    :param include_media: if True then the images and audio for the species are matched too
+    """
+    subdir = glob.escape(proper_filename(species_name))
+    return f'{subdir}/*' if include_media else f'{subdir}/*Cache.json*'
+
+
+def invalidate_species(species_name: str, include_media: bool = False) -> dict:
+    """
+    Removes the cached data for a species so that it will be scraped again
+    :param species_name: name of the species
+    :param include_media: if True then the images and audio for the species are removed too
+    :return: dictionary with the number of files and bytes removed
+    """
+    return invalidate(_species_pattern(species_name, include_media))
+
+
+def invalidate_group(group_name: str, species_names: list[str], include_media: bool = False) -> dict:
+    """
+    Removes the cached data for all of the species in a group, in a single pass over the index
+    :param group_name: name of the group, for the result
+    :param species_names: names of the species in the group
+    :param include_media: if True then the images and audio for the species are removed too
+    :return: dictionary with the number of species, files, and bytes removed
+    """
+    result = invalidate([_species_pattern(species_name, include_media) for species_name in species_names])
+    return {'group': group_name, 'species': len(species_names), 'files': result['files'], 'bytes': result['bytes']}
+
+
+def invalidate_taxonomy() -> dict:
+    """
+    Removes the cached taxonomy, along with the groups and lists that are created from it and
+    the startup snapshot, so that they will be loaded from ebird again
+    :return: dictionary with the number of files and bytes removed
+    """
+    import startupSnapshot
+
+    startupSnapshot.discard()
+    result = invalidate(['ebirdTaxonomyCache.marshal', 'allEbirdSpeciesTaxonomyDictionaryCache.json*',
+                         'groupsCache.json*', 'groupNamesListCache.json*'])
+    return {'files': result['files'], 'bytes': result['bytes']}
+
+
+def erase_cache() -> dict:
+    """
+    Removes all the server side cached JSON files, and the taxonomy and startup snapshots. This way fresh
     data can be generated and used. Important for if update the
     supplementalSpeciesConfig.json file. Does not erase any of the wav or
     image files, since those do not change and they are much more costly to
     generate.
+    :return: dictionary with the number of files and bytes removed
     """
+    import startupSnapshot
+
     logger.info("Erasing cached JSON files from the imager cache")
-    dir_name = get_full_filename('')
-    os.system(f'rm {dir_name}*Cache.json')
-    os.system(f'rm {dir_name}*/*Cache.json')
+    startupSnapshot.discard()
+    return invalidate(['*Cache.json*', '*Cache.marshal'])
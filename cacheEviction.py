@@ -0,0 +1,241 @@
+# Keeps the file cache within a disk budget. A background thread periodically checks how much
+# disk space the cache uses, from the cache index, and evicts files when the total or the quota
+# for a kind of file is exceeded. Which files are evicted is determined by the eviction policy:
+#   lru  - least recently used
+#   lfu  - least frequently used, with least recently used as the tie breaker
+#   gdsf - Greedy Dual Size Frequency. Prefers evicting large files that are rarely used, and
+#          ages files so that ones that were popular long ago are eventually evicted too.
+# Files for pinned species, and global files such as the taxonomy, are never evicted.
+import bisect
+import logging
+import threading
+import time
+
+import cache
+
+logger = logging.getLogger()
+
+# Total disk space that the cache files can use
+disk_budget_bytes = 8 * 1024 * 1024 * 1024
+
+# Disk space for each kind of file. The wav quota includes both the gzipped and uncompressed wav files.
+kind_quota_bytes = {
+    'json': 512 * 1024 * 1024,
+    'png': 2 * 1024 * 1024 * 1024,
+    'wav': 6 * 1024 * 1024 * 1024,
+}
+
+# When over budget files are evicted until usage is down to this fraction of the budget, so
+# that eviction doesn't need to happen again right away
+low_water_fraction = 0.9
+
+# 'lru', 'lfu', or 'gdsf'
+eviction_policy = 'gdsf'
+
+# How often the eviction thread checks the disk usage
+eviction_interval_sec = 300.0
+
+# Species whose files are never evicted. In addition the pinned_top_species most popular
+# species, determined by the number of times their files have been read, are pinned.
+pinned_species: set[str] = set()
+pinned_top_species = 25
+
+# Max number of eviction passes for which the GDSF inflation value is remembered
+_max_inflation_history = 1000
+
+
+def _quota_group(kind: str) -> str:
+    """
+    Returns the name of the quota that the kind of file counts against
+    :param kind: kind of file, as determined by cacheIndex.entry_kind()
+    :return: 'json', 'png', 'wav', or 'other'
+    """
+    return kind.split('.')[0]
+
+
+def _species_dir(key: str):
+    """
+    Returns the species directory part of the cache key, or None if the key is for a global file
+    """
+    slash = key.find('/')
+    return key[:slash] if slash != -1 else None
+
+
+class CacheEvictor:
+    """
+    Evicts files from the cache when it is over budget. Can be run in the background by start(),
+    or a single pass can be done by calling evict().
+    """
+
+    def __init__(self):
+        # For GDSF each file has a priority of L + frequency * cost / size, where L is the inflation
+        # value at the time that the file was last accessed. L is raised to the priority of the last
+        # evicted file at each eviction pass, so this is the history of (time, L) so that the L for
+        # when a file was last accessed can be determined. Starts over at 0 when restarted.
+        self._inflation_history: list[tuple[float, float]] = []
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # Statistics
+        self.passes = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.last_pass_time = None
+
+    def start(self):
+        """
+        Starts the background eviction thread. Does nothing if already started.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='cacheEviction', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(eviction_interval_sec)
+            try:
+                self.evict()
+            except Exception:
+                logger.exception('Exception while evicting files from the cache')
+
+    def evict(self) -> tuple[int, int]:
+        """
+        Does a single eviction pass. When multiple processes share the cache only one of them
+        does the pass.
+        :return: tuple of number of files and number of bytes evicted
+        """
+        with cache.cross_process_lock('cacheEviction', blocking=False) as acquired:
+            if not acquired:
+                # Another process is already evicting
+                return 0, 0
+            with self._lock:
+                return self._evict()
+
+    def _evict(self) -> tuple[int, int]:
+        now = time.time()
+        entries = cache.all_entries()
+        pinned = self._pinned_species_dirs(entries)
+        used_bytes = sum(entry.size for entry in entries)
+
+        # Determine current usage, and which files can be evicted
+        usage = {}
+        total = 0
+        candidates = {}
+        for entry in entries:
+            group = _quota_group(entry.kind)
+            usage[group] = usage.get(group, 0) + entry.size
+            total += entry.size
+            species_dir = _species_dir(entry.key)
+            if species_dir is not None and species_dir not in pinned:
+                candidates.setdefault(group, []).append(entry)
+
+        victims = []
+
+        # Evict from the kinds that are over their quota
+        for group, quota in kind_quota_bytes.items():
+            if usage.get(group, 0) > quota:
+                selected = self._select(candidates.get(group, []), usage[group] - int(quota * low_water_fraction))
+                freed = sum(entry.size for entry in selected)
+                usage[group] -= freed
+                total -= freed
+                victims.extend(selected)
+
+        # If still over the total budget then evict from all kinds
+        if total > disk_budget_bytes:
+            already_selected = {entry.key for entry in victims}
+            remaining = [entry for group_entries in candidates.values() for entry in group_entries
+                         if entry.key not in already_selected]
+            victims.extend(self._select(remaining, total - int(disk_budget_bytes * low_water_fraction)))
+
+        if not victims:
+            return 0, 0
+
+        # Age the files for GDSF by raising the inflation value to the priority of the last evicted file
+        self._inflation_history.append((now, max(self._priority(entry) for entry in victims)))
+        del self._inflation_history[:-_max_inflation_history]
+
+        evicted_bytes = 0
+        for entry in victims:
+            evicted_bytes += cache.remove_file(entry.key) or 0
+        cache.index_changed()
+
+        self.passes += 1
+        self.evicted_files += len(victims)
+        self.evicted_bytes += evicted_bytes
+        self.last_pass_time = now
+        logger.info(f'Evicted {len(victims)} files, {evicted_bytes} bytes, from the cache using the '
+                    f'{eviction_policy} policy. Cache now uses about {used_bytes - evicted_bytes} bytes.')
+        return len(victims), evicted_bytes
+
+    def _select(self, candidates: list, bytes_to_free: int) -> list:
+        """
+        Selects the files to evict, in order of the eviction policy
+        :param candidates: the CacheEntry objects that can be evicted
+        :param bytes_to_free: how much space needs to be freed
+        :return: list of the CacheEntry objects to be evicted
+        """
+        if eviction_policy == 'lru':
+            ordered = sorted(candidates, key=lambda entry: entry.last_access)
+        elif eviction_policy == 'lfu':
+            ordered = sorted(candidates, key=lambda entry: (entry.hits, entry.last_access))
+        elif eviction_policy == 'gdsf':
+            ordered = sorted(candidates, key=self._priority)
+        else:
+            raise ValueError(f'Unknown eviction policy {eviction_policy}')
+
+        selected = []
+        freed = 0
+        for entry in ordered:
+            if freed >= bytes_to_free:
+                break
+            selected.append(entry)
+            freed += entry.size
+
+        if freed < bytes_to_free:
+            logger.warning(f'Could only free {freed} of the {bytes_to_free} bytes needed since the '
+                           f'rest of the files are pinned')
+        return selected
+
+    def _priority(self, entry) -> float:
+        """
+        Returns the GDSF priority of the file. Files with the lowest priority are evicted first.
+        The cost of recreating a file is taken to be the same for all files.
+        """
+        index = bisect.bisect_right(self._inflation_history, (entry.last_access, float('inf')))
+        inflation = self._inflation_history[index - 1][1] if index > 0 else 0.0
+        return inflation + (entry.hits + 1) / max(entry.size, 1)
+
+    @staticmethod
+    def _pinned_species_dirs(entries: list) -> set[str]:
+        """
+        Returns the species directories that are pinned, both the ones configured in
+        pinned_species and the pinned_top_species most popular ones
+        :param entries: all of the CacheEntry objects
+        :return: set of the species directory names
+        """
+        hits_per_species = {}
+        for entry in entries:
+            species_dir = _species_dir(entry.key)
+            if species_dir is not None:
+                hits_per_species[species_dir] = hits_per_species.get(species_dir, 0) + entry.hits
+
+        most_popular = [species_dir for species_dir in
+                        sorted(hits_per_species, key=hits_per_species.get, reverse=True)[:pinned_top_species]
+                        if hits_per_species[species_dir] > 0]
+        return set(most_popular) | {cache.proper_filename(species) for species in pinned_species}
+
+    def stats(self) -> dict:
+        """
+        Returns statistics about the eviction passes done by this process
+        :return: dictionary of the statistics
+        """
+        return {'policy': eviction_policy, 'budget_bytes': disk_budget_bytes, 'passes': self.passes,
+                'evicted_files': self.evicted_files, 'evicted_bytes': self.evicted_bytes,
+                'last_pass_time': self.last_pass_time}
+
+
+# The evictor for this process
+evictor = CacheEvictor()
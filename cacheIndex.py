@@ -0,0 +1,239 @@
+# Index of what is in the file cache. Every cache file is recorded, along with its size,
+# modification time, last access time, and kind, in a small SQLite database in the cache
+# directory. The whole index is loaded into a dictionary so that existence checks and stats
+# are just a dictionary lookup instead of file system calls. SQLite is used because it is part
+# of Python, is safe for multiple processes to update, and survives restarts.
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger()
+
+# How often the last access times, which are only kept in memory when a file is read, are
+# written to the database. Writing them for every read would be far too expensive.
+access_flush_interval_sec = 30.0
+
+
+def entry_kind(key: str) -> str:
+    """
+    Returns the kind of a cache entry, based on its suffix. Useful for per kind statistics and limits.
+    :param key: key of the cache entry
+    :return: 'json', 'png', 'wav.gz', 'wav', or 'other'
+    """
+    if '.json' in key:
+        return 'json'
+    for kind in ('png', 'wav.gz', 'wav'):
+        if key.endswith('.' + kind):
+            return kind
+    return 'other'
+
+
+class CacheEntry:
+    """
+    Information about a single cache file. Provides st_size, st_mtime, and st_mtime_ns so that
+    it can be used in place of an os.stat_result.
+    """
+    __slots__ = ('key', 'path', 'size', 'mtime_ns', 'last_access', 'kind', 'hits')
+
+    def __init__(self, key: str, path: str, size: int, mtime_ns: int, last_access: float, kind: str,
+                 hits: int = 0):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.last_access = last_access
+        self.kind = kind
+
+        # Number of times the file has been read. Used by the frequency based eviction policies.
+        self.hits = hits
+
+    @property
+    def st_size(self) -> int:
+        return self.size
+
+    @property
+    def st_mtime(self) -> float:
+        return self.mtime_ns / 1e9
+
+    @property
+    def st_mtime_ns(self) -> int:
+        return self.mtime_ns
+
+
+class CacheIndex:
+    """
+    The cache index. The dictionary is the authority within a process and the SQLite database
+    is how the index is persisted and shared with other processes.
+    """
+
+    def __init__(self, db_filename: str):
+        """
+        :param db_filename: full name of the SQLite database file
+        """
+        self.db_filename = db_filename
+        self._entries: dict[str, CacheEntry] = {}
+        self._lock = threading.RLock()
+        self._loaded = False
+
+        # Keys whose last access time changed since last written to the database, along with the number
+        # of hits since then. Just the additional hits are written so that the hits of all of the
+        # processes that share the cache are counted.
+        self._accessed: dict[str, int] = {}
+        self._last_access_flush = time.monotonic()
+
+        # The connection can't be shared with a forked process so remember which process it is for
+        self._connection = None
+        self._connection_pid = None
+
+    def _db(self) -> sqlite3.Connection:
+        """
+        Returns the database connection for this process, creating the database if needed.
+        Must be called with the lock held.
+        """
+        if self._connection is None or self._connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_filename), exist_ok=True)
+            self._connection = sqlite3.connect(self.db_filename, timeout=30, check_same_thread=False,
+                                               isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                                     'key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, '
+                                     'mtime_ns INTEGER NOT NULL, last_access REAL NOT NULL, kind TEXT NOT NULL, '
+                                     'hits INTEGER NOT NULL DEFAULT 0)')
+
+            # Indexes created before the hits column was added need to be upgraded
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(entries)')]
+            if 'hits' not in columns:
+                self._connection.execute('ALTER TABLE entries ADD COLUMN hits INTEGER NOT NULL DEFAULT 0')
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def load(self):
+        """
+        (Re)loads the whole index from the database into memory. Called automatically the first
+        time the index is used, and when another process has changed the cache. Access times
+        that haven't yet been written to the database are written first so they are not lost.
+        """
+        with self._lock:
+            self.flush()
+            rows = self._read_rows()
+            self._entries = {row[0]: CacheEntry(*row) for row in rows}
+            self._loaded = True
+        logger.info(f'Loaded cache index with {len(rows)} entries from {self.db_filename}')
+
+    def _read_rows(self) -> list[tuple]:
+        """
+        Reads all of the entries from the database. Must be called with the lock held.
+        """
+        return self._db().execute('SELECT key, path, size, mtime_ns, last_access, kind, hits FROM entries').fetchall()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def get(self, key: str):
+        """
+        Returns the entry for the key
+        :param key: key of the cache entry
+        :return: the CacheEntry, or None if not in the index
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return self._entries.get(key)
+
+    def record(self, key: str, path: str, size: int, mtime_ns: int):
+        """
+        Adds or updates the entry for a cache file that was just written
+        :param key: key of the cache entry
+        :param path: full file name of the cache file
+        :param size: size of the file in bytes
+        :param mtime_ns: modification time of the file
+        """
+        entry = CacheEntry(key, path, size, mtime_ns, time.time(), entry_kind(key))
+        with self._lock:
+            self._ensure_loaded()
+
+            # If the file is being replaced then it is still just as popular
+            old_entry = self._entries.get(key)
+            if old_entry is not None:
+                entry.hits = old_entry.hits
+
+            self._entries[key] = entry
+            self._accessed.pop(key, None)
+            self._db().execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (entry.key, entry.path, entry.size, entry.mtime_ns, entry.last_access, entry.kind,
+                                entry.hits))
+
+    def remove(self, key: str):
+        """
+        Removes the entry for the key, if there is one
+        :param key: key of the cache entry
+        """
+        with self._lock:
+            self._ensure_loaded()
+            self._entries.pop(key, None)
+            self._accessed.pop(key, None)
+            self._db().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def touch(self, key: str):
+        """
+        Records that the entry was just accessed. Only updates memory. The access times and hit
+        counts are written to the database at most once every access_flush_interval_sec.
+        :param key: key of the cache entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.last_access = time.time()
+            entry.hits += 1
+            self._accessed[key] = self._accessed.get(key, 0) + 1
+            if time.monotonic() - self._last_access_flush > access_flush_interval_sec:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes the last access times and hit counts that have changed to the database
+        """
+        with self._lock:
+            updates = [(self._entries[key].last_access, new_hits, key)
+                       for key, new_hits in self._accessed.items() if key in self._entries]
+            self._accessed.clear()
+            self._last_access_flush = time.monotonic()
+            if updates:
+                self._db().executemany('UPDATE entries SET last_access = MAX(last_access, ?), hits = hits + ? '
+                                       'WHERE key = ?', updates)
+
+    def entries(self) -> list[CacheEntry]:
+        """
+        Returns a snapshot of all of the entries
+        :return: list of CacheEntry
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._entries.values())
+
+    def entries_from_db(self) -> list[CacheEntry]:
+        """
+        Returns all of the entries as currently stored in the database, after writing the access
+        times for this process. Other processes that share the cache might have added entries or
+        updated access times, so this is the most complete view of the cache.
+        :return: list of CacheEntry
+        """
+        with self._lock:
+            self.flush()
+            return [CacheEntry(*row) for row in self._read_rows()]
+
+    def stats(self) -> dict:
+        """
+        Returns the number of entries and total bytes, per kind
+        :return: dictionary keyed by kind
+        """
+        stats = {}
+        for entry in self.entries():
+            kind_stats = stats.setdefault(entry.kind, {'entries': 0, 'bytes': 0})
+            kind_stats['entries'] += 1
+            kind_stats['bytes'] += entry.size
+        return stats
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+
+# Migrates a cache that uses the original layout, where files are in a directory per species such
+# as /usr/local/imagerCache/Wood_Duck/image_ML12345.png, to the sharded layout with an index. The
+# files are moved, not copied, so no extra disk space is needed. Safe to run again if it was
+# interrupted since files that were already moved are no longer in the old location. Should be
+# run while the server is stopped.
+#
+# Usage:
+#   python3 cacheMigrate.py [--cache-dir /usr/local/imagerCache/] [--dry-run]
+import argparse
+import os
+
+import cache
+
+
+def old_cache_files(cache_directory: str):
+    """
+    Generator of the files in the cache that use the original layout
+    :param cache_directory: the cache directory
+    :return: yields tuple of the full file name and the cache key
+    """
+    not_cached_names = cache.reserved_names()
+    for name in sorted(os.listdir(cache_directory)):
+        if name in not_cached_names or name.startswith(os.path.basename(cache.index_filename)):
+            continue
+
+        full_name = os.path.join(cache_directory, name)
+        if os.path.isdir(full_name):
+            # A species directory
+            for filename in sorted(os.listdir(full_name)):
+                file_full_name = os.path.join(full_name, filename)
+                if os.path.isfile(file_full_name) and not filename.endswith('.tmp'):
+                    yield file_full_name, name + '/' + filename
+        elif not name.endswith('.tmp'):
+            yield full_name, name
+
+
+def migrate(dry_run: bool = False) -> tuple[int, int]:
+    """
+    Moves the files from the original layout to the sharded layout and records them in the index
+    :param dry_run: if True then only reports what would be done
+    :return: tuple of the number of files and number of bytes migrated
+    """
+    num_files = 0
+    num_bytes = 0
+    for full_name, key in old_cache_files(cache.cache_directory):
+        new_name = cache.path_for_key(key)
+        stat = os.stat(full_name)
+        print(f'{key} -> {new_name[len(cache.cache_directory):]}')
+        num_files += 1
+        num_bytes += stat.st_size
+        if dry_run:
+            continue
+
+        os.makedirs(os.path.dirname(new_name), exist_ok=True)
+        os.replace(full_name, new_name)
+        cache.index().record(key, new_name, stat.st_size, stat.st_mtime_ns)
+
+    # Remove the species directories, which are now empty
+    if not dry_run:
+        for name in os.listdir(cache.cache_directory):
+            full_name = os.path.join(cache.cache_directory, name)
+            if name not in cache.reserved_names() and os.path.isdir(full_name) and not os.listdir(full_name):
+                os.rmdir(full_name)
+
+    return num_files, num_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrates the imager cache to the sharded layout with an index')
+    parser.add_argument('--cache-dir', default=cache.cache_directory,
+                        help=f'the cache directory. Default {cache.cache_directory}')
+    parser.add_argument('--dry-run', action='store_true', help='only list the files that would be migrated')
+    args = parser.parse_args()
+
+    # Use the specified cache directory for both the files and the index
+    cache.use_cache_directory(args.cache_dir)
+
+    num_files, num_bytes = migrate(args.dry_run)
+    print(f'{"Would migrate" if args.dry_run else "Migrated"} {num_files} files, {num_bytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
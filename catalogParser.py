@@ -0,0 +1,220 @@
+# Extracts the image and audio info from the ebird media catalog pages. The pages are large but
+# only the first few entries of the ResultsList are used, so instead of parsing the whole page
+# the <li> entries of the ResultsList are located by scanning the text, and each one is parsed
+# on its own only when it is needed. Once enough entries have been collected the rest of the
+# page is never parsed. The entries are parsed using BeautifulSoup with the lxml parser if it
+# is installed, since it is much faster, or else with the built in html.parser.
+import logging
+import re
+
+from bs4 import BeautifulSoup
+
+# lxml is optional. To install: "pip3 install lxml"
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+logger = logging.getLogger()
+
+# 'auto' uses lxml if it is installed and html.parser otherwise. Can also be set to 'lxml' or 'html.parser'.
+parser_backend = 'auto'
+
+# Max number of entries used for a species. If used more then would rarely have cache hits. And they
+# are supposedly listed in order of ratings. Better to just use the 10 best.
+max_entries = 10
+
+_results_list_re = re.compile(r'<ol\b[^>]*\bclass\s*=\s*["\'][^"\']*\bResultsList\b[^"\']*["\'][^>]*>', re.IGNORECASE)
+_list_tag_re = re.compile(r'<(/?)(li|ol|ul)\b[^>]*>', re.IGNORECASE)
+
+
+class MissingResultsListError(Exception):
+    """
+    Raised if a catalog page has no ResultsList, such as when ebird returned an error page or
+    changed the layout, so that the page is not taken to mean that the species has no media
+    """
+    pass
+
+
+def backend() -> str:
+    """
+    Returns the BeautifulSoup parser that is used
+    :return: 'lxml' or 'html.parser'
+    """
+    if parser_backend == 'auto':
+        return 'lxml' if lxml is not None else 'html.parser'
+    return parser_backend
+
+
+def results_list_items(html: str):
+    """
+    Generator of the <li> entries of the ResultsList of a catalog page. Each entry is parsed only
+    when it is requested, so if the caller stops early then the rest of the page is not parsed.
+    Handles nested lists and <li> elements without a closing tag.
+    :param html: the catalog page
+    :return: yields the parsed <li> elements
+    :raises MissingResultsListError: if the page does not have a ResultsList
+    """
+    match = _results_list_re.search(html)
+    if match is None:
+        raise MissingResultsListError('Catalog page does not have a ResultsList')
+
+    features = backend()
+    list_depth = 1
+    item_start = None
+    for tag in _list_tag_re.finditer(html, match.end()):
+        closing = tag.group(1) == '/'
+        name = tag.group(2).lower()
+        if name == 'li':
+            if list_depth != 1:
+                # An item of a nested list
+                continue
+            if not closing:
+                # A new item implicitly closes the previous one
+                if item_start is not None:
+                    yield _parse_item(html[item_start:tag.start()], features)
+                item_start = tag.start()
+            elif item_start is not None:
+                yield _parse_item(html[item_start:tag.end()], features)
+                item_start = None
+        elif not closing:
+            list_depth += 1
+        else:
+            list_depth -= 1
+            if list_depth == 0:
+                # End of the ResultsList
+                if item_start is not None:
+                    yield _parse_item(html[item_start:tag.start()], features)
+                return
+
+
+def _parse_item(fragment: str, features: str):
+    """
+    Parses the html of a single <li> entry
+    :return: the <li> element
+    """
+    return BeautifulSoup(fragment, features).find('li')
+
+
+def _rating(li) -> str:
+    """
+    Returns the rating of the entry, such as '4'
+    """
+    meta_element = li.find('div', class_='ResultsList-meta')
+    rating_stars_element = meta_element.find('div', class_='RatingStars')
+    ratings_text = rating_stars_element.find('span').text
+    return ratings_text.replace('rating', '').strip()
+
+
+def _author_date_loc(li, abbreviate_loc) -> tuple[str, str, str]:
+    """
+    Returns the author, date, and abbreviated location of the entry
+    """
+    meta_element = li.find('div', class_='ResultsList-meta')
+
+    # Usually author name is in a <a> element but sometimes it is in a <span>
+    user_date_loc_element = meta_element.find('div', class_='userDateLoc')
+    author_element = user_date_loc_element.find(['a', 'span'])
+    author = author_element.text
+
+    # Usually date is in a <time> element but sometimes it is in a span (if it is unknown for example0
+    date_element = author_element.find_next(['time', 'span'])
+    date = date_element.text
+
+    # Since sometimes author is also in an span need to use date_element.find_next() to
+    # dependably get the location span
+    loc_element = date_element.find_next('span')
+    loc = abbreviate_loc(loc_element.text)
+
+    return author, date, loc
+
+
+def parse_audio_list(html: str, abbreviate_loc=lambda loc: loc) -> list[dict]:
+    """
+    Extracts the info for the best audio files from an audio catalog page
+    :param html: the catalog page
+    :param abbreviate_loc: function for abbreviating the location
+    :return: list of objects containing audio info
+    :raises MissingResultsListError: if the page does not have a ResultsList
+    """
+    audio_info_list = []
+    for li in results_list_items(html):
+        header = li.find('div', class_='ResultsList-header')
+        # Get the URL of the mp3 file. It is the first immediate child of header that is a <a>
+        first_a = header.find('a', recursive=False)
+        full_catalog_number = first_a.text.replace('"', '')  # Will be something like "ML483235"
+        catalog_number = full_catalog_number.replace('ML', '')
+        audio_url = f'https://cdn.download.ams.birds.cornell.edu/api/v2/asset/{catalog_number}/mp3'
+
+        tag_span = header.find('span', class_='ResultsList-label')
+        tag_label_text = tag_span.text if tag_span is not None else None
+        tag_content_text = tag_span.find_next_sibling('span').text if tag_span is not None else None
+
+        # If poor rating then done since they are in order, as long as get at least two
+        rating = _rating(li)
+        if len(audio_info_list) > 0 and (not rating.isdigit() or int(rating) < 3):
+            break
+
+        author, date, loc = _author_date_loc(li, abbreviate_loc)
+        audio_info_list.append({'catalog': full_catalog_number,
+                                'author': author,
+                                'date': date,
+                                'loc': loc,
+                                'audioUrl': audio_url,
+                                'rating': rating,
+                                'tagLabel': tag_label_text,
+                                'tagContent': tag_content_text})
+
+        if len(audio_info_list) >= max_entries:
+            break
+
+    return audio_info_list
+
+
+def parse_image_list(html: str, abbreviate_loc=lambda loc: loc) -> list[dict]:
+    """
+    Extracts the info for the best images from a photo catalog page
+    :param html: the catalog page
+    :param abbreviate_loc: function for abbreviating the location
+    :return: list of objects containing image info
+    :raises MissingResultsListError: if the page does not have a ResultsList
+    """
+    image_info_list = []
+    for li in results_list_items(html):
+        # Get the catalog info
+        header = li.find('div', class_='ResultsList-header')
+        first_a = header.find('a', recursive=False)
+        full_catalog_number = first_a.text.replace('"', '')  # Will be something like "ML483235"
+
+        media = li.find('div', class_='ResultsList-media')
+        image = media.find('img')
+        image_url = image.attrs['src']
+
+        # If poor rating then done since they are in order, as long as get at least two
+        rating = _rating(li)
+        if len(image_info_list) >= 2 and (not rating.isdigit() or int(rating) < 3):
+            break
+
+        author, date, loc = _author_date_loc(li, abbreviate_loc)
+
+        # Get the tags like 'Behavior'
+        tags_div = li.find('div', class_='ResultsList-tags')
+        tags_list = tags_div.find_all('div')
+        found_tags = []
+        for div in tags_list:
+            label = div.find('span', class_='ResultsList-label')
+            content = label.find_next('span')
+            found_tags.append({'label': label.text, 'content': content.text})
+
+        image_info_list.append({'catalog': full_catalog_number,
+                                'author': author,
+                                'date': date,
+                                'loc': loc,
+                                'imageUrl': image_url,
+                                'rating': rating,
+                                'tags': found_tags})
+
+        if len(image_info_list) >= max_entries:
+            break
+
+    return image_info_list
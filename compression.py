@@ -0,0 +1,68 @@
+# For compressing responses using the content encodings that the client accepts
+import gzip
+import logging
+
+# Brotli compresses text better than gzip but is an optional library. If it is not
+# installed then only gzip is used. To install: "pip3 install brotli"
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger()
+
+# File suffix used for the compressed version of a file, for each supported content encoding
+encoding_suffixes = {'gzip': '.gz', 'br': '.br'}
+
+
+def supported_encodings() -> list[str]:
+    """
+    Returns the content encodings that can be used, in order of preference
+    :return: list of encodings, such as ['br', 'gzip']
+    """
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def negotiate_encoding(accept_encoding: str):
+    """
+    Determines which content encoding to use based on the Accept-Encoding header of the request.
+    Encodings that the client gives a q value of 0 are not used.
+    :param accept_encoding: value of the Accept-Encoding header. Can be None.
+    :return: the encoding to use, such as 'br' or 'gzip', or None if should not compress
+    """
+    if accept_encoding is None:
+        return None
+
+    accepted = set()
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        q_value = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q_value = float(param[2:])
+                except ValueError:
+                    q_value = 0.0
+        if q_value > 0:
+            accepted.add(name)
+
+    for encoding in supported_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compresses the data using the specified content encoding
+    :param data: the data to be compressed
+    :param encoding: 'gzip' or 'br'
+    :return: the compressed data
+    """
+    if encoding == 'gzip':
+        return gzip.compress(data, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data)
+    raise ValueError(f'Unsupported content encoding {encoding}')
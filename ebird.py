@@ -2,13 +2,17 @@ import collections
 import json
 import json.decoder
 import logging
-from typing import Any
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from urllib.parse import urlparse
 
-import requests
 from bs4 import BeautifulSoup
 
 import cache
+import catalogParser
+import startupSnapshot
+import taxonomyStore
+import upstream
 from queryGoogle import query_google_images_api
 
 # Note: need this hack because BeautifulSoup doesn't work with Python 3.10+
@@ -18,14 +22,37 @@ collections.Callable = collections.abc.Callable
 
 logger = logging.getLogger()
 
+# Name of the cache file, in the species subdirectory, for the data returned by get_species_info()
+species_data_cache_file_name = 'speciesDataCache.json'
+groups_cache_file_name = 'groupsCache.json'
+# The taxonomy is cached as a binary TaxonomyStore snapshot since it loads much faster than JSON
+taxonomy_cache_file_name = 'ebirdTaxonomyCache.marshal'
+
+# Config for species that are not in the Macaulay track list, and for overriding their groups
+supplemental_file_name = 'data/supplementalSpeciesConfig.json'
+
+# How long the cached data is used before it is refreshed by scraping ebird again. Once older than
+# this the data is still served, but is refreshed in the background. None means never refresh.
+species_data_ttl_sec = 7 * 24 * 60 * 60
+groups_ttl_sec = 30 * 24 * 60 * 60
+taxonomy_ttl_sec = 30 * 24 * 60 * 60
+
+# Max time for scraping the image and audio info for a species, which is done concurrently
+species_scrape_deadline_sec = 20.0
+_scrape_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='scrape')
+
+# JSON that is returned to clients is written compactly, without indentation or extra spaces
+compact_separators = (',', ':')
+
 
 class EBird:
 
     def __init__(self):
         """
-        Initializes the logger and loads in the key data at startup so that requests are fast
+        The key data is not loaded here, so that importing this module never needs the network.
+        It is loaded lazily, from the startup snapshot if there is one.
         """
-        self.__get_groups_dictionary()
+        pass
 
     def __get_species_code(self, species_name):
         """
@@ -37,12 +64,11 @@ class EBird:
         # Determine the species code, which is needed for scraping the ebird site
         taxonomy_dict = self.__get_taxonomy_dictionary()
         unified_species_name = self.__unified_name(species_name)
-        if unified_species_name not in taxonomy_dict:
+        species_code = taxonomy_dict.species_code(unified_species_name)
+        if species_code is None:
             logger.warning(f'Species={species_name} not found in ebird.get_species_info()')
-            return None
-        species_data = taxonomy_dict[unified_species_name]
 
-        return species_data['speciesCode']
+        return species_code
 
     def __abbreviate_loc(self, loc_str: str):
         """
@@ -140,11 +166,12 @@ class EBird:
                 .replace(", Thailand", ", THA")
                 )
 
-    def __get_audio_data_list_for_species(self, species_name):
+    def __get_audio_data_list_for_species(self, species_name, deadline=None):
         """
         Scrapes ebird site to get info on best audio files for the specified species. Not cached since whoever
         calls this method caches it.
         :param species_name: Which species want info for
+        :param deadline: optional time.monotonic() time by which the page must have been received
         :return: list of objects containing image info for species
         """
         logger.info(f'Determining audio data, including, urls for species={species_name}...')
@@ -157,77 +184,23 @@ class EBird:
 
         # Make request to the website
         logger.info(f'Requesting audio info for species={species_name} from url={url}')
-        req = requests.get(url)
+        req = upstream.get(url, deadline=deadline)
         logger.debug(f'Finished receiving audio info for species {species_name}')
 
-        # Parse the returned html
+        # Parse the returned html. Only the entries that are used are parsed.
         logger.debug(f'Parsing audio info html for species {species_name}...')
-        soup = BeautifulSoup(req.text, 'html.parser')
-
-        audio_info_list = []
-
-        # Get the results list
-        ol = soup.find('ol', class_="ResultsList")
-        li_elements = ol.find_all('li')
-        for li in li_elements:
-            header = li.find('div', class_='ResultsList-header')
-            # Get the URL of the mp3 file. It is the first immediate child of header that is a <a>
-            first_a = header.find('a', recursive=False)
-            full_catalog_number = first_a.text.replace('"', '')  # Will be something like "ML483235"
-            catalog_number = full_catalog_number.replace('ML', '')
-            audio_url = f'https://cdn.download.ams.birds.cornell.edu/api/v2/asset/{catalog_number}/mp3'
-
-            tag_span = header.find('span', class_='ResultsList-label')
-            tag_label_text = tag_span.text if tag_span is not None else None
-            tag_content_text = tag_span.find_next_sibling('span').text if tag_span is not None else None
-
-            # Get the rating
-            meta_element = li.find('div', class_='ResultsList-meta')
-            rating_stars_element = meta_element.find('div', class_='RatingStars')
-            ratings_text = rating_stars_element.find('span').text
-            rating = ratings_text.replace('rating', '').strip()
-
-            # If poor rating then done since they are in order, as long as get at least two
-            if len(audio_info_list) > 0 and (not rating.isdigit() or int(rating) < 3):
-                break
-
-            # Usually author name is in a <a> element but sometimes it is in a <span>
-            user_date_loc_element = meta_element.find('div', class_='userDateLoc')
-            author_element = user_date_loc_element.find(['a', 'span'])
-            author = author_element.text
-
-            # Usually date is in a <time> element but sometimes it is in a span (if it is unknown for example0
-            date_element = author_element.find_next(['time', 'span'])
-            date = date_element.text
-
-            # Since sometimes author is also in an span need to use date_element.find_next() to
-            # dependably get the location span
-            loc_element = date_element.find_next('span')
-            loc = self.__abbreviate_loc(loc_element.text)
-
-            audio_info_list.append({'catalog': full_catalog_number,
-                                    'author': author,
-                                    'date': date,
-                                    'loc': loc,
-                                    'audioUrl': audio_url,
-                                    'rating': rating,
-                                    'tagLabel': tag_label_text,
-                                    'tagContent': tag_content_text})
-
-            # Just use 10 best. If used more then would rarely have cache hits. And they
-            # are supposedly listed in order of ratings. Better to just use the 10 best.
-            if len(audio_info_list) >= 10:
-                break
+        audio_info_list = catalogParser.parse_audio_list(req.text, self.__abbreviate_loc)
 
         logger.debug(f'Done processing audio data for species {species_name}')
 
         return audio_info_list
 
-    def __get_image_data_list_for_species(self, species_name):
+    def __get_image_data_list_for_species(self, species_name, deadline=None):
         """
         Scrapes ebird site to get info on best images for the specified species. Not cached since whoever
         calls this method caches it.
         :param species_name: Which species want info for
+        :param deadline: optional time.monotonic() time by which the page must have been received
         :return: list of objects containing image info for species
         """
         logger.info(f'Determining image data, including urls, for species={species_name}...')
@@ -240,73 +213,12 @@ class EBird:
 
         # Make request to the website
         logger.info(f'Requesting image info for species={species_name} from url={url}')
-        req = requests.get(url)
+        req = upstream.get(url, deadline=deadline)
         logger.debug(f'Finished receiving image info for species {species_name}')
 
-        # Parse the returned html
+        # Parse the returned html. Only the entries that are used are parsed.
         logger.debug(f'Parsing image info html for species {species_name}...')
-        soup = BeautifulSoup(req.text, 'html.parser')
-
-        image_info_list = []
-
-        # Get the results list
-        ol = soup.find('ol', class_="ResultsList")
-        li_elements = ol.find_all('li')
-        for li in li_elements:
-            # Get the catalog info
-            header = li.find('div', class_='ResultsList-header')
-            first_a = header.find('a', recursive=False)
-            full_catalog_number = first_a.text.replace('"', '')  # Will be something like "ML483235"
-
-            media = li.find('div', class_='ResultsList-media')
-            image = media.find('img')
-            image_url = image.attrs['src']
-
-            # Get the rating
-            meta_element = li.find('div', class_='ResultsList-meta')
-            rating_stars_element = meta_element.find('div', class_='RatingStars')
-            ratings_text = rating_stars_element.find('span').text
-            rating = ratings_text.replace('rating', '').strip()
-
-            # If poor rating then done since they are in order, as long as get at least two
-            if len(image_info_list) >= 2 and (not rating.isdigit() or int(rating) < 3):
-                break
-
-            # Usually author name is in a <a> element but sometimes it is in a <span>
-            user_date_loc_element = meta_element.find('div', class_='userDateLoc')
-            author_element = user_date_loc_element.find(['a', 'span'])
-            author = author_element.text
-
-            # Usually date is in a <time> element but sometimes it is in a span (if it is unknown for example0
-            date_element = author_element.find_next(['time', 'span'])
-            date = date_element.text
-
-            # Since sometimes author is also in an span need to use date_element.find_next() to
-            # dependably get the location span
-            loc_element = date_element.find_next('span')
-            loc = self.__abbreviate_loc(loc_element.text)
-
-            # Get the tags like 'Behavior'
-            tags_div = li.find('div', class_='ResultsList-tags')
-            tags_list = tags_div.find_all('div')
-            found_tags = []
-            for div in tags_list:
-                label = div.find('span', class_='ResultsList-label')
-                content = label.find_next('span')
-                found_tags.append({'label': label.text, 'content': content.text})
-
-            image_info_list.append({'catalog': full_catalog_number,
-                                    'author': author,
-                                    'date': date,
-                                    'loc': loc,
-                                    'imageUrl': image_url,
-                                    'rating': rating,
-                                    'tags': found_tags})
-
-            # Just use 10 best. If used more then would rarely have cache hits. And they
-            # are supposedly listed in order of ratings. Better to just use the 10 best.
-            if len(image_info_list) >= 10:
-                break
+        image_info_list = catalogParser.parse_image_list(req.text, self.__abbreviate_loc)
 
         logger.debug(f'Done processing image info for species {species_name}')
 
@@ -341,7 +253,7 @@ class EBird:
 
         # Make request to the website
         logger.info(f'Getting species data from url={url}')
-        req = requests.get(url)
+        req = upstream.get(url)
 
         # Parse the returned html
         soup = BeautifulSoup(req.text, 'html.parser')
@@ -412,76 +324,63 @@ class EBird:
 
         return species_dict
 
-    __taxonomy_dictionary_cache = None
-
+    @cache.memoized(cache_file=lambda self: (taxonomy_cache_file_name, '', ''))
     def __get_taxonomy_dictionary(self):
         """
-        Gets as a dictionary the taxonomy of all bird species (~30k!) from the ebird site. Includes ebird
+        Gets the taxonomy of all bird species (~30k!) from the ebird site. Includes ebird
         taxonomy name, which is needed for looking up best images and audio clips on ebird. Caches
-        the dictionary so don't need to keep hitting the ebird site.
-        :return: taxonomy of all bird species. A dictionary keyed by unified species name and containing basic
-        info about the species. unified_species_name = self.__unified_name(species_name)
+        the taxonomy as a snapshot so don't need to keep hitting the ebird site.
+        :return: taxonomy of all bird species. A TaxonomyStore, which can be used like a read only
+        dictionary keyed by unified species name and containing basic info about the species.
+        unified_species_name = self.__unified_name(species_name)
+        Memoized so only read from file cache or generated once.
         """
-        # Try getting from memory cache first
-        if self.__taxonomy_dictionary_cache is not None:
-            logger.info(f'Using taxonomy dictionary from memory cache')
-            return self.__taxonomy_dictionary_cache
+        # Try getting from the startup snapshot, and then from the file cache
+        store = startupSnapshot.taxonomy()
+        if store is not None:
+            return store
 
-        # Try getting from file cache
-        cache_file_name = "allEbirdSpeciesTaxonomyDictionaryCache.json"
+        cache_file_name = taxonomy_cache_file_name
         if cache.file_exists(cache_file_name):
-            logger.info(f'Using taxonomy dictionary from file cache')
-            json_data = cache.read_from_cache(cache_file_name)
-            return json.loads(json_data)
-
-        # Load in the full taxonomy from ebird site
-        logger.info(f'Generating taxonomy dictionary because was not cached')
-        url = "https://api.ebird.org/v2/ref/taxonomy/ebird?fmt=json "
-        headers = {'x-ebirdapitoken': 'jfekjedvescr'}
-        response = requests.get(url, headers=headers)
-        full_taxonomy = json.loads(response.content)
-
-        taxonomy_dict: dict[Any, dict[str, Any]] = {}
-        for full_species in full_taxonomy:
-            # If species missing any important data then skip it
-            if ('comName' not in full_species or
-                    'speciesCode' not in full_species or
-                    'sciName' not in full_species or
-                    'familyComName' not in full_species):
-                continue
-
-            species_name = full_species['comName']
-            unified_species_name = self.__unified_name(species_name)
-
-            species = {
-                "speciesName": species_name,
-                "speciesCode": full_species['speciesCode'],
-                "sciName": full_species['sciName'],
-                "groupName": full_species['familyComName']}
-            taxonomy_dict[unified_species_name] = species
+            logger.info(f'Using taxonomy from file cache')
+            store = taxonomyStore.TaxonomyStore.from_snapshot(cache.read_from_cache(cache_file_name))
+            if store is not None:
+                return store
 
-        # Write the full_taxonomy json to cache file in nice format by dumping object into json string
-        cache.write_to_cache(json.dumps(taxonomy_dict, indent=4), cache_file_name)
+        logger.info(f'Generating taxonomy because was not cached')
+        store = self.__generate_taxonomy_dictionary()
 
-        # Store in memory cache
-        self.__taxonomy_dictionary_cache = taxonomy_dict
+        # Write the snapshot of the taxonomy to the cache file
+        cache.write_to_cache(store.to_snapshot(), cache_file_name)
 
-        return taxonomy_dict
+        return store
 
-    __supplemental_species_config_cache = None
+    def __generate_taxonomy_dictionary(self):
+        """
+        Loads in the full taxonomy from the ebird site and converts it to a TaxonomyStore. The
+        response is stream parsed so that the whole ~30k entry JSON array is never in memory at once.
+        Not cached since the calling methods cache it.
+        :return: taxonomy of all bird species, keyed by unified species name
+        """
+        # Stream in the full taxonomy from ebird site
+        url = "https://api.ebird.org/v2/ref/taxonomy/ebird?fmt=json "
+        headers = {'x-ebirdapitoken': 'jfekjedvescr'}
+        with upstream.stream(url, headers=headers) as response:
+            return taxonomyStore.parse_taxonomy(response.iter_content(64 * 1024), self.__unified_name)
 
+    @cache.memoized
     def __supplemental_species_config(self):
         """
-        Reads in supplemental species config file supplementalSpeciesConfig.json
+        Reads in supplemental species config file supplementalSpeciesConfig.json.
+        Memoized so only read once.
         :return: data for the supplemental species
         """
-        if self.__supplemental_species_config_cache is not None:
-            logger.info(f'Using cached supplemental species config info')
-            return self.__supplemental_species_config_cache
+        supplemental_species_dict = startupSnapshot.supplemental_config()
+        if supplemental_species_dict is not None:
+            return supplemental_species_dict
 
         # Read in supplemental data and convert JSON to a python object
         logger.info(f'Generating supplemental species config info')
-        supplemental_file_name = 'data/supplementalSpeciesConfig.json'
         try:
             with open(supplemental_file_name, 'rb') as file:
                 json_data = file.read()
@@ -499,9 +398,6 @@ class EBird:
         for species in supplemental_species:
             supplemental_species_dict[species['speciesName']] = species
 
-        # Cache result
-        __supplemental_species_config_cache = supplemental_species_dict
-
         return supplemental_species_dict
 
     def __add_species_to_group(self, species_name, group_name, groups):
@@ -512,27 +408,39 @@ class EBird:
             species_list_for_group = groups[group_name]
             species_list_for_group.append(species_name)
 
-    __groups_dictionary_cache = None
-
+    @cache.memoized(cache_file=lambda self: (groups_cache_file_name, '', ''))
     def __get_groups_dictionary(self):
         """
         Provides the group list for the species specified in the species_list. Each group is a list of
         species names within that group. The groups will NOT be in alphabetical order.
+        Memoized so only read from file cache or generated once.
         :return: dictionary of all groups. Keyed by group name and containing values of list of all
         species names for that group
         """
-        # Return memory cached value if exists
-        if self.__groups_dictionary_cache is not None:
-            logger.info(f'Using memory cached groups dictionary')
-            return self.__groups_dictionary_cache
+        # Use the startup snapshot or the file cache if they exist
+        groups = startupSnapshot.groups()
+        if groups is not None:
+            return groups
 
-        # Use file cache if it exists
-        cache_file_name = 'groupsCache.json'
+        cache_file_name = groups_cache_file_name
         if cache.file_exists(cache_file_name):
             logger.info(f'Using file cached groups dictionary')
             json_data = cache.read_from_cache(cache_file_name)
             return json.loads(json_data)
 
+        groups = self.__generate_groups_dictionary()
+
+        # Write groups to cache
+        cache.write_to_cache(json.dumps(groups, indent=4), cache_file_name)
+
+        return groups
+
+    def __generate_groups_dictionary(self):
+        """
+        Determines the groups dictionary from the species list, the taxonomy, and the supplemental
+        species config. Not cached since the calling methods cache it.
+        :return: dictionary of all groups, keyed by group name
+        """
         logger.info("Generating the groups dictionary...")
 
         # The return value. groups is a dictionary keyed on group name and containing list of species names
@@ -561,18 +469,14 @@ class EBird:
         for species in supplemental_species.values():
             self.__add_species_to_group(species['speciesName'], species['groupName'], groups)
 
-        # Write groups to cache
-        cache.write_to_cache(json.dumps(groups, indent=4), cache_file_name)
-
-        # Store in memory cache
-        self.__groups_dictionary_cache = groups
-
         return groups
 
+    @cache.memoized(cache_file=lambda self: ('speciesTracksListCache.json', '', ''))
     def __get_sorted_species_list(self):
         """
         Returns list of all species in alphabetical order. For each species there is a list of the
-        track audio calls, but those particular track calls might not be used. Caches the data.
+        track audio calls, but those particular track calls might not be used. Caches the data,
+        and is memoized.
         :return: list of all data, ordered alphabetically by species
         """
         # Try getting from cache first
@@ -597,11 +501,16 @@ class EBird:
 
         return all_species_list
 
+    @cache.memoized
     def get_species_name_list(self):
         """
-        Returns list of species names in alphabetical order
+        Returns list of species names in alphabetical order. Memoized.
         :return: list of species names
         """
+        species_list = startupSnapshot.species_names()
+        if species_list is not None:
+            return species_list
+
         all_data_list = self.__get_sorted_species_list()
         species_list = []
         for species in all_data_list:
@@ -611,18 +520,12 @@ class EBird:
 
         return sorted(species_list)
 
-    # Memory cache for get_species_list_json()
-    __species_names_list_cache = None
-
+    @cache.memoized(cache_file=lambda self: ('speciesNamesListCache.json', '', ''))
     def get_species_list_json(self):
         """
-        Returns JSON string of list of species names in alphabetical order.
+        Returns JSON string of list of species names in alphabetical order. Memoized.
         :return: species list as JSON string
         """
-        # If in memory cache return it
-        if self.__species_names_list_cache is not None:
-            return self.__species_names_list_cache
-
         # Try getting from file cache first
         cache_file_name = "speciesNamesListCache.json"
         if cache.file_exists(cache_file_name):
@@ -635,29 +538,20 @@ class EBird:
         species_list = self.get_species_name_list()
 
         # Convert to JSON
-        json_data = json.dumps(species_list, indent=4)
+        json_data = json.dumps(species_list, separators=compact_separators)
 
         # Write to cache
         cache.write_to_cache(json_data, cache_file_name)
 
-        # Write to memory cache
-        __species_names_list_cache = json_data
-
         # Return the results in JSON
         return json_data
 
-    __group_names_list_cache = None
-
+    @cache.memoized(cache_file=lambda self: ('groupNamesListCache.json', '', ''))
     def get_group_list_json(self):
         """
-        Returns JSON str of list of group names alphabetized
+        Returns JSON str of list of group names alphabetized. Memoized.
         :return: JSON str of group names
         """
-        # If in memory cache return it
-        if self.__group_names_list_cache is not None:
-            logger.info(f'Getting the group name list from memory cache')
-            return self.__group_names_list_cache
-
         # Try getting from cache first
         cache_file_name = "groupNamesListCache.json"
         if cache.file_exists(cache_file_name):
@@ -675,30 +569,137 @@ class EBird:
             group_names.append(group_name)
 
         # Convert sorted group names to a json str
-        json_data = json.dumps(sorted(group_names), indent=2)
+        json_data = json.dumps(sorted(group_names), separators=compact_separators)
 
         # Write to cache
         cache.write_to_cache(json_data, cache_file_name)
 
-        # Write to memory cache
-        __group_names_list_cache = json_data
-
         # Return the results in JSON
         return json_data
 
     def get_species_info(self, species_name):
         """
         Returns info for the specified species, including list of image info, list of audio info, and some other
-        data.
+        data. Memoized. If the cached data is older than species_data_ttl_sec then it is still returned,
+        but is refreshed in the background.
+        :param species_name:
+        :return: json str containing info for species
+        """
+        cache.refresh_if_stale(species_data_cache_file_name, subdir=species_name, ttl_sec=species_data_ttl_sec,
+                               regenerate=lambda: self.__complete_species_info(species_name),
+                               on_refreshed=lambda: cache.invalidate_memos('EBird.__get_species_info',
+                                                                           (self, species_name)))
+        return self.__get_species_info(species_name)
+
+    def refresh_stale_data(self):
+        """
+        Starts refreshing the taxonomy and groups data in the background if they are older than
+        their time to live. Cheap, so can be called for every request.
+        """
+        cache.refresh_if_stale(taxonomy_cache_file_name, ttl_sec=taxonomy_ttl_sec,
+                               regenerate=lambda: self.__generate_taxonomy_dictionary().to_snapshot(),
+                               on_refreshed=self.__taxonomy_refreshed)
+        cache.refresh_if_stale(groups_cache_file_name, ttl_sec=groups_ttl_sec,
+                               regenerate=lambda: json.dumps(self.__generate_groups_dictionary(), indent=4),
+                               on_refreshed=self.__groups_refreshed)
+
+    def __taxonomy_refreshed(self):
+        """
+        Called after the taxonomy file has been refreshed. The startup snapshot contains the old
+        taxonomy so it is discarded right away, so that the memos are recreated from the new file,
+        and is then rebuilt.
+        """
+        startupSnapshot.discard()
+        cache.invalidate_memos('EBird.__get_taxonomy_dictionary')
+        startupSnapshot.rebuild_in_background()
+
+    def __groups_refreshed(self):
+        """
+        Called after the groups file has been refreshed. The group names list is created from the
+        groups so it is removed so that it will be recreated, and since the groups are used for
+        many of the memoized results, including the prepared list responses, all memos are cleared.
+        The startup snapshot contains the old groups so it is discarded right away, so that the
+        memos are recreated from the new file, and is then rebuilt.
+        """
+        startupSnapshot.discard()
+        cache.remove_file(cache.cache_key('groupNamesListCache.json'))
+        cache.invalidate_memos()
+        startupSnapshot.rebuild_in_background()
+
+    def startup_snapshot_sections(self) -> dict[str, bytes]:
+        """
+        Returns the data for the startup snapshot. Taken from the cache files if they exist and
+        otherwise generated, so should be called after the old snapshot has been discarded.
+        :return: data of each section, keyed by section name
+        """
+        return {'taxonomy': self.__get_taxonomy_dictionary().to_snapshot(),
+                'groups': json.dumps(self.__get_groups_dictionary(), separators=compact_separators).encode('utf-8'),
+                'speciesNames': json.dumps(self.get_species_name_list(), separators=compact_separators).encode('utf-8'),
+                'supplemental': json.dumps(self.__supplemental_species_config(),
+                                           separators=compact_separators).encode('utf-8')}
+
+    def __species_data_cache_file(self, species_name):
+        """
+        Returns the cache file for the species data, which is what is locked when multiple processes
+        share the cache. None if the species is not known, so that species names from clients
+        that don't exist don't end up creating lock files.
+        :param species_name:
+        :return: (name, suffix, subdir) of the cache file, or None
+        """
+        if (species_name not in self.__supplemental_species_config() and
+                self.__unified_name(species_name) not in self.__get_taxonomy_dictionary()):
+            return None
+        return species_data_cache_file_name, '', species_name
+
+    @cache.memoized(cache_file=lambda self, species_name: self.__species_data_cache_file(species_name))
+    def __get_species_info(self, species_name):
+        """
+        Returns info for the specified species from the file cache, or generates it if not cached.
+        Memoized.
         :param species_name:
         :return: json str containing info for species
         """
         # Return info from cache if available
-        cache_file_name = 'speciesDataCache.json'
+        cache_file_name = species_data_cache_file_name
         if cache.file_exists(cache_file_name, subdir=species_name):
             logger.info(f'Using file cached data for species={species_name} file={cache_file_name}')
             return cache.read_from_cache(cache_file_name, subdir=species_name)
 
+        result = self.__generate_species_info(species_name)
+        if result is None:
+            return None
+
+        # A partial result is returned but not cached, so that the next request tries again
+        json_data, partial = result
+        if partial:
+            return cache.not_memoized(json_data)
+
+        # Write to cache
+        cache.write_to_cache(json_data, cache_file_name, subdir=species_name)
+
+        return json_data
+
+    def __complete_species_info(self, species_name):
+        """
+        For refreshing the cached species info. Partial results are not used since the stale
+        but complete cached info is better.
+        :param species_name:
+        :return: json str containing info for species, or None if it could not be fully determined
+        """
+        result = self.__generate_species_info(species_name)
+        if result is None or result[1]:
+            return None
+        return result[0]
+
+    def __generate_species_info(self, species_name):
+        """
+        Determines the info for the species by scraping ebird, or by using the supplemental species
+        config. Not cached since the calling methods cache it.
+        :param species_name:
+        :return: tuple of json str containing info for species and whether it is only a partial result
+        because the image or the audio info could not be determined in time. None if the species is
+        not known.
+        """
         logger.info(f'Generating data for species={species_name}...')
 
         # First, see if info for this species is in the supplemental file. This
@@ -728,45 +729,60 @@ class EBird:
             if unified_species_name not in taxonomy_dict:
                 logger.warning(f'Species={species_name} not found in ebird.get_species_info()')
                 return None
-            species_data = taxonomy_dict[unified_species_name]
-
-            # Add info for images and audio
-            image_data_list = self.__get_image_data_list_for_species(species_name)
-            species_data['imageDataList'] = image_data_list
-
-            audio_data_list = self.__get_audio_data_list_for_species(species_name)
-            species_data['audioDataList'] = audio_data_list
+            # Copy the taxonomy entry since it is shared and the image and audio info is added to it
+            species_data = dict(taxonomy_dict[unified_species_name])
+
+            # Add info for images and audio. The two pages are fetched and parsed at the same time,
+            # with a single deadline. If one of them doesn't finish in time, or fails, then the
+            # result is partial and is flagged as such. The deadline is also passed to the requests
+            # so that they give up, and free up the scrape threads, once it has passed.
+            deadline = time.monotonic() + species_scrape_deadline_sec
+            futures = {'imageDataList': _scrape_executor.submit(self.__get_image_data_list_for_species,
+                                                                species_name, deadline),
+                       'audioDataList': _scrape_executor.submit(self.__get_audio_data_list_for_species,
+                                                                species_name, deadline)}
+            wait(futures.values(), timeout=species_scrape_deadline_sec)
+            missing = []
+            for name, future in futures.items():
+                if future.done() and future.exception() is None:
+                    species_data[name] = future.result()
+                else:
+                    reason = 'timed out' if not future.done() else f'failed with {future.exception()!r}'
+                    logger.error(f'Getting {name} for species={species_name} {reason}, so result is partial')
+                    species_data[name] = []
+                    missing.append(name)
+            if missing:
+                species_data['partial'] = True
+                species_data['missing'] = missing
 
         # Convert the species data into json
-        json_data = json.dumps(species_data, indent=2)
-
-        # Write to cache
-        cache.write_to_cache(json_data, cache_file_name, subdir=species_name)
-
-        return json_data
+        return json.dumps(species_data, separators=compact_separators), species_data.get('partial', False)
 
+    @cache.memoized
     def get_species_for_group_json(self, group_name):
         """
-        Returns json consisting of list of species for the specified group
+        Returns json consisting of list of species for the specified group. Memoized.
         :param group_name:
         :return: list of species for group
         """
         groups_dict = self.__get_groups_dictionary()
 
         if group_name not in groups_dict:
-            return f'Error: group {group_name} does not exist'
+            # Not memoized since the group name comes from the client and could be anything
+            return cache.not_memoized(f'Error: group {group_name} does not exist')
 
         species_list = groups_dict[group_name]
-        json_data = json.dumps(species_list, indent=2)
+        json_data = json.dumps(species_list, separators=compact_separators)
         return json_data
 
+    @cache.memoized
     def get_species_by_group_json(self):
         """
-        Returns json consisting of list of species for each group
+        Returns json consisting of list of species for each group. Memoized.
         :return: list of species by group
         """
         groups_dict = self.__get_groups_dictionary()
-        return json.dumps(groups_dict, indent=2)
+        return json.dumps(groups_dict, separators=compact_separators)
 
 
 # Global instantiation
@@ -1,16 +1,53 @@
-import tempfile
 from http.server import BaseHTTPRequestHandler
 from io import BytesIO
 from urllib.parse import urlparse, parse_qs
 
-import requests
 from PIL import Image, ImageOps, ImageEnhance
 from PIL.Image import Quantize
 import logging
 import cache
+import upstream
+from workerPool import WorkerPool
 
 logger = logging.getLogger()
 
+# Configuration of the image pool. Processing large images is CPU and memory heavy so by default it
+# is done in separate processes, each limited to image_worker_memory_mb of memory. image_executor_kind
+# can be set to 'thread' for platforms where worker processes are not appropriate. Images with more
+# than max_image_pixels pixels are rejected before they are decoded.
+image_executor_kind = 'process'
+image_workers = 2
+image_max_queued = 8
+image_worker_memory_mb = 512
+image_timeout_sec = 60
+max_image_pixels = 40_000_000
+
+# If fast_decode is set then images are decoded at reduced resolution, using draft mode for jpegs,
+# and shrunk to working_height pixels high before the rest of the Norns pipeline is run. The final
+# image is just 64 pixels high so this is plenty. The imageQualityCheck.py script can be used to
+# compare the results to those of decoding the full image.
+fast_decode = True
+working_height = 256
+
+# If stream_downloads is set then images are downloaded in chunks so that the download can be stopped
+# as soon as the header shows that the image is too large. max_image_bytes limits the size of the download.
+stream_downloads = True
+max_image_bytes = 30_000_000
+max_header_bytes = 256 * 1024
+
+# Suffix of the cached processed images
+image_cache_suffix = '.png'
+
+_image_pool = WorkerPool('image processing', image_workers, image_max_queued,
+                         kind=image_executor_kind, memory_limit_mb=image_worker_memory_mb)
+
+
+class ImageTooLargeError(Exception):
+    """
+    Raised if an image has more pixels than allowed, so that huge originals cannot use up all the memory
+    """
+    pass
+
 
 def process_image_for_norns(img: Image, debug: bool = False) -> Image:
     """
@@ -52,6 +89,41 @@ def process_image_for_norns(img: Image, debug: bool = False) -> Image:
     return shrunk_img
 
 
+def reduce_for_norns(img: Image, height: int = None) -> Image:
+    """
+    Reduces a just opened, not yet decoded, image to a small working height before the Norns
+    pipeline is run. The final image is only 64 pixels high so there is no need to decode the
+    full resolution image and then convert, enhance, and quantize every one of its pixels.
+    For a jpeg, draft mode is used so that the decoder itself scales the image down by 1/2, 1/4,
+    or 1/8 and outputs grayscale. Then the image is resized to the working height using a
+    reducing_gap so that the resize is fast but still smooth.
+    :param img: the image, as returned by Image.open(), so that draft mode can still be used
+    :param height: the working height. Should be well above 64 so that the cropping and quantizing
+    done later still work on enough detail. Defaults to working_height.
+    :return: the reduced grayscale image. If image was already small then just converted to grayscale.
+    """
+    if height is None:
+        height = working_height
+
+    if img.height > height:
+        requested_size = (max(1, round(img.width * height / img.height)), height)
+
+        # For jpegs have the decoder do the downscaling and grayscale conversion. For other
+        # formats draft() simply does nothing.
+        img.draft('L', requested_size)
+
+    # Converting to grayscale first means that resizing only has to process a single band. And
+    # palette images would otherwise only be resized using nearest neighbor.
+    if img.mode != 'L':
+        img = img.convert('L')
+
+    if img.height > height:
+        new_size = (max(1, round(img.width * height / img.height)), height)
+        img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    return img
+
+
 def shrink_to_norns_size(img: Image) -> Image:
     """
     Reduces image to proper size for the Norns, which is 128x64
@@ -185,67 +257,178 @@ def grayscale(img: Image, debug: bool = False) -> Image:
     return sixteen_color_img
 
 
-def load_and_process_image_for_url(url: str, species: str, debug: bool = False) -> Image:
+def cache_file_name_for_url(url: str) -> str:
+    """
+    Returns the name of the cache file, without suffix, for the processed image for the url.
+    Images for cornell catalog items get names like image_ML928372.
+    :param url: link to the original image
+    :return: name of the cache file
+    """
+    return 'image_' + cache.file_identifier(url)
+
+
+def load_and_process_image_for_url(url: str, species: str, debug: bool = False) -> bytes:
     """
     Gets image for the url and processes it. Uses a cache so don't have to process
-    same images again.
+    same images again. If several requests for the same uncached url come in at the
+    same time then only one of them actually processes the image and the others
+    share the result.
 
     :param url: link to image to load
     :param species: Specifies species for caching.
     :param debug: True if should put out additional debugging info
-    :return: the image processed to work on Norns device
+    :return: PNG data of the image processed to work on Norns device
     """
-    # Get from cache if can
-    cache_file_name = 'image_' + cache.file_identifier(url)
-    cache_suffix = '.png'
+    # Get from cache if can. The cached file is already the PNG that is to be returned
+    # so simply return its bytes instead of decoding and then re-encoding it.
+    cache_file_name = cache_file_name_for_url(url)
+    cache_suffix = image_cache_suffix
     if cache.file_exists(cache_file_name, cache_suffix, species):
-        # The image is in the cache as a file. But don't want to just return the
-        # data in the file. Instead, need to return an Image. Therefore create
-        # an image using the cache file name.
         logger.info(f'Getting cached image for url={url}')
-        return Image.open(cache.get_full_filename(cache_file_name, cache_suffix, species))
+        return cache.read_from_cache(cache_file_name, cache_suffix, species)
+
+    # Not in cache so process it. But only do so once even if multiple requests for it at the same time
+    return cache.single_flight(cache.get_full_filename(cache_file_name, cache_suffix, species),
+                               lambda: _create_image_for_url(url, species, cache_file_name, cache_suffix, debug))
+
 
-    # Wasn't in cache so get image via the web.
-    # Load image and store it into a tmp file. Had to use requests lib and
-    # set the headers to look like a browser to get access to certain images
-    # where server apparently doesn't want to provide them to a python script.
+def _create_image_for_url(url: str, species: str, cache_file_name: str, cache_suffix: str,
+                          debug: bool = False) -> bytes:
+    """
+    Loads the image for the url, processes it for the Norns, and stores the result in the cache.
+    :param url: link to image to load
+    :param species: Specifies species for caching.
+    :param cache_file_name: name of the cache file for the image
+    :param cache_suffix: suffix of the cache file for the image
+    :param debug: True if should put out additional debugging info
+    :return: PNG data of the image processed to work on Norns device
+    """
+    # Another request might have just finished creating the image so check cache again
+    if cache.file_exists(cache_file_name, cache_suffix, species):
+        logger.info(f'Image was just cached by another request so using it for url={url}')
+        return cache.read_from_cache(cache_file_name, cache_suffix, species)
+
+    # Wasn't in cache so get image via the web
     logger.info(f'Processing image from url={url}')
+    image_data = download_image_data(url)
+
+    # Do the CPU heavy image processing in a worker so that the GIL doesn't slow down other requests.
+    # But if debugging then process in this thread so that the interim images can be shown.
+    if debug:
+        png_bytes = process_image_data_for_norns(image_data, max_image_pixels, fast_decode, debug)
+    else:
+        png_bytes = _image_pool.run(process_image_data_for_norns, image_data, max_image_pixels, fast_decode,
+                                    timeout=image_timeout_sec)
+
+    # Write the PNG to cache
+    cache.write_to_cache(png_bytes, cache_file_name, cache_suffix, species)
+
+    logger.info(f'Stored image in file {cache.get_full_filename(cache_file_name, cache_suffix, species)} for url {url}')
+
+    return png_bytes
+
+
+def download_image_data(url: str) -> bytes:
+    """
+    Downloads the raw data for an image. Had to use requests lib and set the headers to look like
+    a browser to get access to certain images where server apparently doesn't want to provide
+    them to a python script.
+    If stream_downloads is set then the image is streamed. As soon as the image header has been
+    received the size of the image is checked, and if the image is too large then the download
+    is stopped right away instead of fetching the rest of a huge file. Note that the full data is
+    still needed for a normal image since even a draft mode decode of a jpeg has to read all of
+    the compressed image data.
+    :param url: link to image to load
+    :return: the raw image data
+    """
     headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 '
                              '(KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'}
-    response = requests.get(url, headers=headers)
-    # Store image into tmp file so that it can be processed
-    with tempfile.TemporaryFile() as tmp_file:
-        # Store data into file
-        tmp_file.write(response.content)
+    if not stream_downloads:
+        return upstream.get(url, headers=headers).content
+
+    with upstream.stream(url, headers=headers) as response:
+        chunks = []
+        num_bytes = 0
+        header_checked = False
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            chunks.append(chunk)
+            num_bytes += len(chunk)
+            if num_bytes > max_image_bytes:
+                raise ImageTooLargeError(f'Image at url={url} is more than the max of {max_image_bytes} bytes')
+
+            # Once there is enough data for the header check the size of the image. Only try for
+            # the first part of the data since the header is always near the beginning.
+            if not header_checked and num_bytes <= max_header_bytes:
+                size = _image_size_from_header(b''.join(chunks))
+                if size is not None:
+                    header_checked = True
+                    (width, height) = size
+                    if width * height > max_image_pixels:
+                        raise ImageTooLargeError(f'Image at url={url} is {width}x{height} which is more '
+                                                 f'than the max of {max_image_pixels} pixels')
+
+        return b''.join(chunks)
+
+
+def _image_size_from_header(partial_data: bytes):
+    """
+    Determines the size of an image from the beginning of the image data
+    :param partial_data: the first part of the image data
+    :return: (width, height) if the header was complete enough to determine it, otherwise None
+    """
+    try:
+        with Image.open(BytesIO(partial_data)) as img:
+            return img.size
+    except Exception:
+        # Header not completely received yet
+        return None
 
-        # Load image from the file into an Image object so that it can be manipulated
-        tmp_file.seek(0)
-        img = Image.open(tmp_file)
 
-        # Convert image so suitable for Norns special display
-        processed_image = process_image_for_norns(img, debug)
+def process_image_data_for_norns(image_data: bytes, max_pixels: int, reduce_first: bool = True,
+                                 debug: bool = False) -> bytes:
+    """
+    Processes raw image data, such as a jpeg, so that it is suitable for the Norns and returns it as
+    PNG data. Runs in a worker of the image pool so must be a module level function and all params
+    must be picklable.
+    :param image_data: the raw data of the original image
+    :param max_pixels: max number of pixels of the original image. Larger images are rejected so that
+    they cannot use up all the memory.
+    :param reduce_first: true if should decode at reduced resolution and shrink to the working height
+    before processing. See reduce_for_norns().
+    :param debug: true if should display the interim images
+    :return: the processed image as PNG data
+    """
+    # Decode directly from the downloaded data. A BytesIO created from bytes shares the
+    # buffer instead of copying it, and there is no need to go through a temp file.
+    # Opening only reads the header so can check the size before decoding the whole image.
+    img = Image.open(BytesIO(image_data))
+    if img.width * img.height > max_pixels:
+        raise ImageTooLargeError(f'Image is {img.width}x{img.height} which is more than '
+                                 f'the max of {max_pixels} pixels')
+
+    # Shrink the image before processing it so that not processing lots of pixels that are not needed
+    if reduce_first:
+        img = reduce_for_norns(img)
+
+    # Convert image so suitable for Norns special display
+    processed_image = process_image_for_norns(img, debug)
 
     # For debugging show each image returned
     if debug:
         processed_image.show("returned image")
 
-    # Convert Image to bytes and write to cache
+    # Convert Image to PNG bytes
     img_bytes = BytesIO()
     processed_image.save(img_bytes, 'PNG')
-    img_bytes.seek(0)
-    cache.write_to_cache(img_bytes.read(), cache_file_name, cache_suffix, species)
-
-    logger.info(f'Stored image in file {cache.get_full_filename(cache_file_name, cache_suffix, species)} for url {url}')
-
-    return processed_image
+    return img_bytes.getvalue()
 
 
-def load_and_process_image(handler: BaseHTTPRequestHandler) -> Image:
+def load_and_process_image(handler: BaseHTTPRequestHandler) -> bytes:
     """
     Calls load_and_process_image_for_url using url specified by the query string. Uses cache via
     load_and_process_image_for_url()
     :param handler: The BaseHTTPRequestHandler which provides 'url' and the 's' query string params
-    :return: the image
+    :return: the PNG data of the image
     """
     parsed_url = urlparse(handler.path)
     parsed_qs = parse_qs(parsed_url.query, keep_blank_values=True)
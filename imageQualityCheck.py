@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+# Compares the Norns PNGs created using the fast reduced resolution decoding with the ones created
+# by decoding the full resolution image. This way can confirm that the images still look the same
+# on the Norns after changing how images are decoded or reduced.
+#
+# Usage:
+#   python3 imageQualityCheck.py [--out dir] [--max-diff 2.0] image_file_or_url ...
+# If --out is specified then for each image the two versions are written side by side into a PNG
+# in that directory so that they can be compared visually.
+import argparse
+import sys
+from io import BytesIO
+
+from PIL import Image
+
+import imageProcessor
+import upstream
+
+
+def load_image_data(file_or_url: str) -> bytes:
+    """
+    Returns the raw data for the specified image file or URL
+    :param file_or_url: name of image file, or an http(s) url
+    :return: the raw image data
+    """
+    if file_or_url.startswith('http://') or file_or_url.startswith('https://'):
+        headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 '
+                                 '(KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'}
+        return upstream.get(file_or_url, headers=headers).content
+
+    with open(file_or_url, 'rb') as file:
+        return file.read()
+
+
+def gray_levels(png_data: bytes) -> Image:
+    """
+    Converts the PNG data, which is a palette image, into an 'L' image so that the actual
+    gray levels can be compared
+    """
+    return Image.open(BytesIO(png_data)).convert('L')
+
+
+def compare(full_png: bytes, fast_png: bytes) -> dict:
+    """
+    Compares the PNG created by decoding the full image with the PNG created using the fast decoding.
+    Since cropping can result in the images being a pixel different in width the fast image is
+    resized to the size of the full image if needed.
+    :param full_png: PNG created from the full resolution image
+    :param fast_png: PNG created using fast decoding
+    :return: dictionary with the sizes, mean absolute difference in gray level (0-255), and
+    fraction of pixels that differ by more than one of the 16 Norns gray levels
+    """
+    full_img = gray_levels(full_png)
+    fast_img = gray_levels(fast_png)
+    fast_size = fast_img.size
+    if fast_img.size != full_img.size:
+        fast_img = fast_img.resize(full_img.size, Image.Resampling.NEAREST)
+
+    full_pixels = full_img.getdata()
+    fast_pixels = fast_img.getdata()
+    one_gray_level = 256 // 16
+    total_diff = 0
+    num_different = 0
+    for full_pixel, fast_pixel in zip(full_pixels, fast_pixels):
+        diff = abs(full_pixel - fast_pixel)
+        total_diff += diff
+        if diff > one_gray_level:
+            num_different += 1
+
+    num_pixels = full_img.width * full_img.height
+    return {'fullSize': full_img.size,
+            'fastSize': fast_size,
+            'meanDiff': total_diff / num_pixels,
+            'fractionDifferent': num_different / num_pixels}
+
+
+def write_side_by_side(full_png: bytes, fast_png: bytes, filename: str):
+    """
+    Writes a PNG with the full decoding result on the left and the fast decoding result on the right
+    """
+    full_img = gray_levels(full_png)
+    fast_img = gray_levels(fast_png)
+    combined = Image.new('L', (full_img.width + fast_img.width + 4, max(full_img.height, fast_img.height)), 128)
+    combined.paste(full_img, (0, 0))
+    combined.paste(fast_img, (full_img.width + 4, 0))
+    combined.save(filename, 'PNG')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares fast reduced resolution image processing with '
+                                                 'processing of the full resolution image')
+    parser.add_argument('images', nargs='+', help='image files or urls to compare')
+    parser.add_argument('--out', help='directory to write side by side comparison PNGs to')
+    parser.add_argument('--max-diff', type=float, default=2.0,
+                        help='max acceptable mean gray level difference (0-255). Default 2.0')
+    args = parser.parse_args()
+
+    num_failed = 0
+    for index, file_or_url in enumerate(args.images):
+        image_data = load_image_data(file_or_url)
+        full_png = imageProcessor.process_image_data_for_norns(image_data, imageProcessor.max_image_pixels,
+                                                               reduce_first=False)
+        fast_png = imageProcessor.process_image_data_for_norns(image_data, imageProcessor.max_image_pixels,
+                                                               reduce_first=True)
+        result = compare(full_png, fast_png)
+
+        ok = result['meanDiff'] <= args.max_diff
+        if not ok:
+            num_failed += 1
+        print(f'{"OK  " if ok else "DIFF"} {file_or_url} full={result["fullSize"]} fast={result["fastSize"]} '
+              f'meanDiff={result["meanDiff"]:.2f} fractionDifferent={result["fractionDifferent"]:.3f}')
+
+        if args.out:
+            write_side_by_side(full_png, fast_png, f'{args.out}/comparison_{index}.png')
+
+    print(f'{len(args.images) - num_failed} of {len(args.images)} images within max diff of {args.max_diff}')
+    return 1 if num_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
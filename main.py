@@ -1,6 +1,11 @@
 #! /usr/bin/env python
 
+import argparse
 from http.server import ThreadingHTTPServer
+import cache
+import cacheEviction
+import preparedResponse
+import startupSnapshot
 from requestHandler import RequestHandler
 
 
@@ -12,13 +17,87 @@ from requestHandler import RequestHandler
 # NOTE: had to install webscraper "pip install html-table-parser-python3"
 
 
-def start_webserver():
+def parse_args():
+    """
+    Parses the command line arguments. All are optional so that can still simply run "python3 main.py"
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description='Imager webserver for the Taweeet Norns application')
+    parser.add_argument('--mode', choices=['threading', 'async'], default='threading',
+                        help='threading uses a thread per connection. async uses asyncio so that idle '
+                             'connections cost almost nothing. Default threading')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on. Default 8080')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of pre-forked worker processes that share the listening socket and the '
+                             'cache. Useful on multi-core hosts. Default 1, which means no pre-forking')
+    parser.add_argument('--max-connections', type=int, default=1000,
+                        help='async mode: max number of open connections. Default 1000')
+    parser.add_argument('--workers', type=int, default=32,
+                        help='async mode: number of threads for handling requests. Default 32')
+    parser.add_argument('--request-timeout', type=float, default=120,
+                        help='async mode: max seconds for handling a request. Default 120')
+    return parser.parse_args()
+
+
+def create_server(args):
+    """
+    Creates the server for the mode specified by the command line arguments
+    :param args: the parsed command line arguments
+    :return: the server, which provides serve_forever()
+    """
+    if args.mode == 'async':
+        from asyncServer import AsyncHTTPServer
+        return AsyncHTTPServer(port=args.port, max_connections=args.max_connections,
+                               max_workers=args.workers, request_timeout_sec=args.request_timeout)
+
+    # Don't bind since in pre-fork mode the socket is provided by the parent process
+    return ThreadingHTTPServer(('', args.port), RequestHandler, bind_and_activate=args.processes <= 1)
+
+
+def serve_on_socket(args, sock):
+    """
+    For pre-fork mode. Serves requests forever on the listening socket inherited from the parent process.
+    :param args: the parsed command line arguments
+    :param sock: the listening socket
+    """
+    server = create_server(args)
+    cacheEviction.evictor.start()
+    cache.validate_files_in_background()
+    if not startupSnapshot.exists():
+        # Only one of the worker processes actually rebuilds it
+        startupSnapshot.rebuild_in_background()
+    if args.mode == 'async':
+        server.serve_forever(sock)
+    else:
+        server.socket.close()
+        server.socket = sock
+        server.serve_forever()
+
+
+def start_webserver(args):
     """Starts the webserver and then just waits forever"""
-    server = ThreadingHTTPServer(('', 8080), RequestHandler)
+    # Build the list responses up front so that the first requests are fast. In pre-fork
+    # mode this is done before forking so that all the workers share them. Only done if there
+    # is a startup snapshot, since otherwise the data might first need to be gotten from ebird
+    # and the server should not have to wait for the network before it starts listening.
+    have_snapshot = startupSnapshot.exists()
+    if have_snapshot:
+        preparedResponse.prepare_list_responses()
+
+    if args.processes > 1:
+        from preforkServer import PreforkServer
+        server = PreforkServer(args.port, args.processes, lambda sock: serve_on_socket(args, sock))
+    else:
+        server = create_server(args)
+        cacheEviction.evictor.start()
+        cache.validate_files_in_background()
+        if not have_snapshot:
+            startupSnapshot.rebuild_in_background(on_done=preparedResponse.prepare_list_responses)
 
     # Respond to requests until process is killed
     server.serve_forever()
 
 
 # Actually start the webserver
-start_webserver()
+if __name__ == '__main__':
+    start_webserver(parse_args())
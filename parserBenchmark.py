@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+# Benchmarks parsing of the ebird media catalog pages so that the parse time per species can be
+# tracked over time. Uses catalog pages saved as fixture files so that the results don't depend
+# on the network. For each fixture the time of the whole page parse that was originally used is
+# shown along with the time of the catalogParser parse, for each available parser backend.
+#
+# Usage:
+#   python3 parserBenchmark.py --save "Wood Duck" ...    # saves catalog pages for the species as fixtures
+#   python3 parserBenchmark.py [--runs 5] [--record benchmarkHistory.csv]
+# Fixture files are named <speciesCode>_<photo|audio>.html and are in data/catalogFixtures by default.
+# The fixtures in the repo are synthetic pages, see data/catalogFixtures/README.md.
+# If --record is specified then the results are appended to that CSV file.
+import argparse
+import csv
+import glob
+import os
+import statistics
+import time
+
+from bs4 import BeautifulSoup
+
+import catalogParser
+
+default_fixture_directory = 'data/catalogFixtures'
+
+
+def save_fixtures(species_names: list[str], fixture_directory: str):
+    """
+    Gets the photo and audio catalog pages for the species from ebird and saves them as fixtures
+    :param species_names: names of the species
+    :param fixture_directory: where to save the pages
+    """
+    import upstream
+    from ebird import ebird
+
+    os.makedirs(fixture_directory, exist_ok=True)
+    for species_name in species_names:
+        species_code = ebird._EBird__get_species_code(species_name)
+        if species_code is None:
+            print(f'Species {species_name} not found so skipping it')
+            continue
+        for media_type in ('photo', 'audio'):
+            url = (f'https://media.ebird.org/catalog?taxonCode={species_code}'
+                   f'&mediaType={media_type}&sort=rating_rank_desc&view=list')
+            filename = os.path.join(fixture_directory, f'{species_code}_{media_type}.html')
+            with open(filename, 'w', encoding='utf-8') as file:
+                file.write(upstream.get(url).text)
+            print(f'Saved {filename}')
+
+
+def full_page_parse(html: str, features: str) -> int:
+    """
+    The original way of parsing, where the whole page is parsed before the entries are used
+    :return: number of entries in the ResultsList
+    """
+    soup = BeautifulSoup(html, features)
+    return len(soup.find('ol', class_='ResultsList').find_all('li'))
+
+
+def time_ms(fn, runs: int) -> float:
+    """
+    Returns the median time of running fn, in msec
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def available_backends() -> list[str]:
+    return ['lxml', 'html.parser'] if catalogParser.lxml is not None else ['html.parser']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks parsing of the ebird catalog pages')
+    parser.add_argument('--fixtures', default=default_fixture_directory,
+                        help=f'directory of the fixture pages. Default {default_fixture_directory}')
+    parser.add_argument('--save', nargs='+', metavar='SPECIES', help='save catalog pages for the species as fixtures')
+    parser.add_argument('--runs', type=int, default=5, help='number of times each page is parsed. Default 5')
+    parser.add_argument('--record', help='CSV file that the results are appended to')
+    args = parser.parse_args()
+
+    if args.save:
+        save_fixtures(args.save, args.fixtures)
+        return
+
+    filenames = sorted(glob.glob(os.path.join(args.fixtures, '*.html')))
+    if not filenames:
+        print(f'No fixture pages in {args.fixtures}. Use --save to create some.')
+        return
+
+    results = []
+    print(f'{"fixture":40} {"backend":12} {"full ms":>9} {"lazy ms":>9} {"entries":>8}')
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as file:
+            html = file.read()
+        parse = catalogParser.parse_audio_list if filename.endswith('_audio.html') else catalogParser.parse_image_list
+        for features in available_backends():
+            catalogParser.parser_backend = features
+            full_ms = time_ms(lambda: full_page_parse(html, features), args.runs)
+            lazy_ms = time_ms(lambda: parse(html), args.runs)
+            entries = len(parse(html))
+            name = os.path.basename(filename)
+            print(f'{name:40} {features:12} {full_ms:9.1f} {lazy_ms:9.1f} {entries:8}')
+            results.append([time.strftime('%Y-%m-%dT%H:%M:%S'), name, features, f'{full_ms:.2f}', f'{lazy_ms:.2f}',
+                            entries])
+
+    if args.record:
+        new_file = not os.path.exists(args.record)
+        with open(args.record, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(['time', 'fixture', 'backend', 'fullPageMsec', 'lazyMsec', 'entries'])
+            writer.writerows(results)
+        print(f'Appended results to {args.record}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Pre-fork serving. A single process is limited by the GIL so on a multi-core host multiple
+# worker processes are forked that all accept connections on the same listening socket. The
+# parent process just supervises the workers and restarts any that die. The workers share the
+# on-disk cache, and cache.use_cross_process_locks makes sure that they coordinate creating
+# cache files so that the same file is not created by multiple processes at once.
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import cache
+
+logger = logging.getLogger()
+
+# If a worker dies sooner than this after being started then wait a bit before restarting it
+# so that a worker that crashes right away doesn't cause a tight fork loop
+min_worker_lifetime_sec = 5.0
+restart_delay_sec = 2.0
+
+
+def create_listening_socket(port: int) -> socket.socket:
+    """
+    Creates the socket that all the workers accept connections on. The workers inherit it
+    when they are forked.
+    :param port: port to listen on
+    :return: the bound and listening socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+class PreforkServer:
+    """
+    Forks num_workers worker processes that each run serve_worker(sock) on the shared listening
+    socket. The parent restarts any worker that dies, and when the parent is terminated it
+    terminates the workers too.
+    """
+
+    def __init__(self, port: int, num_workers: int, serve_worker):
+        """
+        :param port: port to listen on
+        :param num_workers: number of worker processes
+        :param serve_worker: function that takes the listening socket and serves requests on it forever.
+        Called in each worker process.
+        """
+        self.port = port
+        self.num_workers = num_workers
+        self.serve_worker = serve_worker
+
+        # Keyed by pid, the time each worker was started
+        self._workers: dict[int, float] = {}
+        self._stopping = False
+
+    def serve_forever(self):
+        """
+        Starts the workers and then supervises them until terminated
+        """
+        # The workers all share the cache so they need to coordinate writing to it
+        cache.use_cross_process_locks = True
+
+        sock = create_listening_socket(self.port)
+        logger.info(f'Pre-fork server listening on port {self.port} with {self.num_workers} workers')
+
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+
+        for _ in range(self.num_workers):
+            self._start_worker(sock)
+
+        while not self._stopping:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+
+            logger.error(f'Worker process {pid} died with status {status} so restarting it')
+            if time.monotonic() - started < min_worker_lifetime_sec:
+                time.sleep(restart_delay_sec)
+            self._start_worker(sock)
+
+        sock.close()
+
+    def _start_worker(self, sock: socket.socket):
+        """
+        Forks a worker process that serves requests on the socket
+        """
+        pid = os.fork()
+        if pid == 0:
+            # In the worker. Use default signal handling so that terminating the worker simply stops it.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                logger.info(f'Worker process {os.getpid()} started')
+                self.serve_worker(sock)
+            except BaseException:
+                logger.exception(f'Worker process {os.getpid()} failed')
+                exit_code = 1
+            finally:
+                # Never return into the parent's supervising loop
+                os._exit(exit_code)
+
+        self._workers[pid] = time.monotonic()
+
+    def _handle_stop_signal(self, signum, frame):
+        """
+        Terminates all the workers and then exits
+        """
+        logger.info(f'Pre-fork server received signal {signum} so stopping the workers')
+        self._stopping = True
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
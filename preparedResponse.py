@@ -0,0 +1,110 @@
+# Precomputed responses for the list endpoints. The lists only change when the cache is
+# invalidated so the responses are built just once, as compact UTF-8 JSON along with
+# compressed versions and strong ETags. The handler then simply writes out the bytes.
+import hashlib
+import json
+import logging
+
+import cache
+import compression
+from ebird import ebird
+
+logger = logging.getLogger()
+
+
+class PreparedResponse:
+    """
+    A fully prepared response body, along with its compressed versions and ETags
+    """
+
+    def __init__(self, body: bytes, content_type: str = 'text/json'):
+        """
+        :param body: the uncompressed body of the response
+        :param content_type: for the Content-Type header
+        """
+        self.body = body
+        self.content_type = content_type
+
+        # Compressed version of the body for each supported content encoding
+        self.encoded_bodies = {encoding: compression.compress(body, encoding)
+                               for encoding in compression.supported_encodings()}
+
+        # Strong ETags, based on the content, so that they are the same across restarts. The
+        # compressed versions are different representations so they need different ETags.
+        content_hash = hashlib.sha1(body).hexdigest()
+        self.etag = f'"{content_hash}"'
+        self.encoded_etags = {encoding: f'"{content_hash}-{encoding}"'
+                              for encoding in compression.supported_encodings()}
+
+    @classmethod
+    def for_json(cls, obj):
+        """
+        Creates a PreparedResponse for the object as compact JSON
+        :param obj: the object to be converted to JSON
+        :return: the PreparedResponse
+        """
+        body = json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        return cls(body)
+
+
+@cache.memoized
+def _groups_dictionary() -> dict:
+    """
+    Returns the groups dictionary, keyed on group name and containing list of species names
+    """
+    return json.loads(ebird.get_species_by_group_json())
+
+
+@cache.memoized
+def all_species_list() -> PreparedResponse:
+    """
+    Returns the prepared response for /allSpeciesList
+    """
+    logger.info('Preparing response for the all species list')
+    return PreparedResponse.for_json(json.loads(ebird.get_species_list_json()))
+
+
+@cache.memoized
+def groups_list() -> PreparedResponse:
+    """
+    Returns the prepared response for /groupsList
+    """
+    logger.info('Preparing response for the groups list')
+    return PreparedResponse.for_json(json.loads(ebird.get_group_list_json()))
+
+
+@cache.memoized
+def species_by_group() -> PreparedResponse:
+    """
+    Returns the prepared response for /speciesByGroup
+    """
+    logger.info('Preparing response for the species by group list')
+    return PreparedResponse.for_json(_groups_dictionary())
+
+
+@cache.memoized
+def species_for_group(group_name: str):
+    """
+    Returns the prepared response for /speciesForGroup for the specified group
+    :param group_name: name of the group
+    :return: the PreparedResponse, or None if there is no such group
+    """
+    groups = _groups_dictionary()
+    if group_name not in groups:
+        return None
+
+    return PreparedResponse.for_json(groups[group_name])
+
+
+def prepare_list_responses():
+    """
+    Builds all of the list responses so that they are ready before the first request. Since they
+    are memoized they are rebuilt the next time they are needed after the cache is invalidated.
+    """
+    logger.info('Preparing the list responses...')
+    all_species_list()
+    groups_list()
+    species_by_group()
+    for group_name in _groups_dictionary():
+        species_for_group(group_name)
+    logger.info('Done preparing the list responses')
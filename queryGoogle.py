@@ -3,9 +3,11 @@ import random
 import logging
 from imageProcessor import load_and_process_image_for_url
 
-from urllib.request import urlopen
 from urllib.parse import quote, urlparse
-from urllib.error import HTTPError
+
+import requests
+
+import upstream
 
 logger = logging.getLogger()
 
@@ -34,8 +36,8 @@ def scrape_google_for_images(query_str):
 
     # Query google search
     logger.info(f'Scraping google search using url={url}')
-    response = urlopen(url)
-    response_as_str = response.read().decode(response.headers.get_content_charset())
+    response = upstream.get(url)
+    response_as_str = response.text
     logger.info(f'Scraping response was {len(response_as_str)} characters long')
 
     # Find all the urls of the images and add them to image_urls
@@ -67,8 +69,8 @@ def query_google_images_api(query_str):
 
     # Get the response of URL and convert response to json object containing just the important 'items' data
     logger.info(f'Querying Google Image API using={query_url}')
-    response = urlopen(query_url)
-    data_json1 = json.loads(response.read())
+    response = upstream.get(query_url)
+    data_json1 = json.loads(response.content)
 
     # If ever want to provide more than 10 results then ten_results_is_enough should be set to false.
     # Nice thing about doing just a single query is that are limited to 100 total queries per day.
@@ -77,8 +79,8 @@ def query_google_images_api(query_str):
         combined_json_items = data_json1['items']
     else:
         # Get next page of results so that can have total of 20 images to choose from
-        response = urlopen(query_url + '&start=11')
-        data_json2 = json.loads(response.read())
+        response = upstream.get(query_url + '&start=11')
+        data_json2 = json.loads(response.content)
 
         combined_json_items = data_json1['items'] + data_json2['items']
 
@@ -109,7 +111,7 @@ def get_url_list_for_image_search_query(query_str):
     logger.info(f'Searching for images using "{query_str}"')
     try:
         image_urls = query_google_images_api(query_str)
-    except HTTPError as err:
+    except requests.HTTPError as err:
         logger.warning(f'Got error using the Google API. Therefore trying scraping Google as backup. {err}')
         image_urls = scrape_google_for_images(query_str)
         if image_urls is None or len(image_urls) == 0:
@@ -130,7 +132,7 @@ def get_random_image_for_query(parsed_qs):
     :param parsed_qs: the query string info from the request. The 'q' param
     specifies the Google search to be done, like "image brown pelican flying".
     Should also contain 's' param to specify the species.
-    :return: processed image as a PNG made suitable for Norns device
+    :return: PNG data of the processed image made suitable for Norns device
     """
     # Determine the link for the image to use
     query_str = parsed_qs['q'][0]
@@ -1,16 +1,27 @@
-import gzip
+import hashlib
+import json
 import logging
+import os
+import socket
 import loggingConfig
 import traceback
+from email.utils import parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler
-from io import BytesIO
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
-from PIL import Image
+import audio
 import cache
-from audio import get_wav_file
-from ebird import ebird
-from imageProcessor import load_and_process_image
+import cacheEviction
+import compression
+import imageProcessor
+import preparedResponse
+import startupSnapshot
+from audio import get_wav_file, get_uncompressed_wav_filename, audio_cache_suffix
+from ebird import ebird, species_data_cache_file_name
+from imageProcessor import load_and_process_image, image_cache_suffix
+from preparedResponse import PreparedResponse
+from warmup import warmup_manager
+from workerPool import PoolBusyError
 
 # The root logger
 logger = logging.getLogger()
@@ -20,70 +31,188 @@ logger_bad_requests = loggingConfig.setup_logger("bad_requests", 'bad_requests.l
 logger_bad_requests.propagate = False
 
 
+# Processed media for cornell catalog items, like image_ML928372.png and audio_ML928372.wav.gz,
+# never changes so clients can keep it for a long time. Other media, identified by a hash of its
+# url, might be replaced so clients should check back after a day.
+immutable_media_cache_control = 'public, max-age=31536000, immutable'
+media_cache_control = 'public, max-age=86400'
+
+# Text responses smaller than this are not compressed since it wouldn't save enough to be worthwhile
+min_compress_bytes = 1024
+
+
+class _MediaValidators:
+    """
+    Validators for a cached media file, based on the size and modification time of the file
+    """
+
+    def __init__(self, cache_file_name: str, stat, last_modified: str):
+        """
+        :param cache_file_name: name of the cache file, such as image_ML928372
+        :param stat: os.stat_result for the cache file
+        :param last_modified: the modification time formatted for the Last-Modified header
+        """
+        self.mtime = stat.st_mtime
+        self.last_modified = last_modified
+        self.etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        self.gzip_etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}-gzip"'
+
+        immutable = cache_file_name.split('_', 1)[-1].startswith('ML')
+        self.cache_control = immutable_media_cache_control if immutable else media_cache_control
+
+
 class RequestHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         parsed_url = urlparse(self.path)
         parsed_qs = parse_qs(parsed_url.query, keep_blank_values=True)
 
         try:
+            # In case another server process erased the cache
+            cache.sync_with_other_processes()
+
+            # Refresh the taxonomy and groups in the background if they are too old
+            ebird.refresh_stale_data()
+
             match parsed_url.path:
                 case '/allSpeciesList':
                     logger.info(f'Handling request {self.path}')
 
                     # Returns in json a list of all species
-                    json = ebird.get_species_list_json()
-                    return self._json_response(json)
+                    return self._prepared_response(preparedResponse.all_species_list())
                 case '/groupsList':
                     logger.info(f'Handling request {self.path}')
 
-                    # Returns in json a list of all species
-                    json = ebird.get_group_list_json()
-                    return self._json_response(json)
+                    # Returns in json a list of all groups
+                    return self._prepared_response(preparedResponse.groups_list())
                 case '/speciesForGroup':
                     logger.info(f'Handling request {self.path}')
 
-                    json = ebird.get_species_for_group_json(parsed_qs['g'][0])
-                    return self._json_response(json)
+                    prepared = preparedResponse.species_for_group(parsed_qs['g'][0])
+                    if prepared is None:
+                        # No such group so return the error message
+                        json_data = ebird.get_species_for_group_json(parsed_qs['g'][0])
+                        return self._json_response(json_data)
+                    return self._prepared_response(prepared)
                 case '/speciesByGroup':
                     logger.info(f'Handling request {self.path}')
 
-                    json = ebird.get_species_by_group_json()
-                    return self._json_response(json)
+                    return self._prepared_response(preparedResponse.species_by_group())
                 case '/dataForSpecies':
                     logger.info(f'Handling request {self.path}')
 
                     # Returns in json a list of image urls for the species. The client app can
                     # then determine which one to use
-                    species_info = ebird.get_species_info(parsed_qs['s'][0])
-                    return self._json_response(species_info)
+                    species = parsed_qs['s'][0]
+                    species_info = ebird.get_species_info(species)
+                    return self._json_response(species_info, cache_ref=(species_data_cache_file_name, '', species))
                 case '/pngFile':
                     logger.info(f'Handling request {self.path}')
 
                     # Returns png file for the specified URL. Query string should specify 'url' and 's' for species.
-                    image = load_and_process_image(self)
-                    return self._image_response(image)
+                    # If client already has the current version then don't even need to load it.
+                    cache_file_name = imageProcessor.cache_file_name_for_url(parsed_qs['url'][0])
+                    validators = self._media_validators(cache_file_name, image_cache_suffix, parsed_qs['s'][0])
+                    if validators is not None and self._is_not_modified(validators.etag, validators.mtime):
+                        return self._not_modified_response(validators.etag, validators)
+
+                    png_data = load_and_process_image(self)
+                    if validators is None:
+                        # Image was just created so now can determine the validators
+                        validators = self._media_validators(cache_file_name, image_cache_suffix, parsed_qs['s'][0])
+                    return self._image_response(png_data, validators)
                 case '/wavFile':
                     logger.info(f'Handling request {self.path}')
 
-                    # Loads wav file for specified and species, specified in query string by 'url' and 's'
-                    wav_file_data = get_wav_file(self)
-                    return self._wav_response(wav_file_data)
+                    # Loads wav file for specified and species, specified in query string by 'url' and 's'.
+                    # If client already has the current version then don't even need to load it.
+                    cache_file_name = audio.cache_file_name_for_url(parsed_qs['url'][0])
+                    validators = self._media_validators(cache_file_name, audio_cache_suffix, parsed_qs['s'][0])
+                    if validators is not None:
+                        etag = self._wav_etag(validators)
+                        if self._is_not_modified(etag, validators.mtime):
+                            return self._not_modified_response(etag, validators)
+
+                    # Clients that request a byte range, or that don't accept gzip, get the uncompressed
+                    # version straight from disk. Otherwise the gzipped data is returned.
+                    if self._wants_uncompressed_wav():
+                        wav_filename = get_uncompressed_wav_filename(self)
+                        wav_file_data = None
+                    else:
+                        wav_file_data = get_wav_file(self)
+                    if validators is None:
+                        # Audio was just created so now can determine the validators
+                        validators = self._media_validators(cache_file_name, audio_cache_suffix, parsed_qs['s'][0])
+
+                    if wav_file_data is None:
+                        return self._wav_file_response(wav_filename, validators)
+                    return self._wav_response(wav_file_data, validators)
                 case '/eraseCache':
                     logger.info(f'Handling request {self.path}')
 
                     # Gets rid of all the *Cache.json files so that new data will be used
-                    cache.erase_cache()
-                    return self._json_response('Cache cleared')
+                    return self._json_response(json.dumps(cache.erase_cache()))
+                case '/invalidateSpecies':
+                    logger.info(f'Handling request {self.path}')
+
+                    # Removes cached data for species 's'. If 'media' is true then images and audio too.
+                    return self._json_response(json.dumps(
+                        cache.invalidate_species(parsed_qs['s'][0], self._query_flag(parsed_qs, 'media'))))
+                case '/invalidateGroup':
+                    logger.info(f'Handling request {self.path}')
+
+                    # Removes cached data for all species in group 'g'. If 'media' is true then images and audio too.
+                    group_name = parsed_qs['g'][0]
+                    species_names = json.loads(ebird.get_species_by_group_json()).get(group_name, [])
+                    return self._json_response(json.dumps(
+                        cache.invalidate_group(group_name, species_names, self._query_flag(parsed_qs, 'media'))))
+                case '/invalidateTaxonomy':
+                    logger.info(f'Handling request {self.path}')
+
+                    # Removes the cached taxonomy and the groups created from it
+                    return self._json_response(json.dumps(cache.invalidate_taxonomy()))
+                case '/invalidateKeys':
+                    logger.info(f'Handling request {self.path}')
+
+                    # Removes the cache files whose keys match the glob pattern 'glob', such as "Wood_Duck/*.png"
+                    return self._json_response(json.dumps(cache.invalidate(parsed_qs['glob'][0])))
+                case '/cacheStats':
+                    logger.info(f'Handling request {self.path}')
+
+                    # Returns in json the statistics for the in memory tier and for the files of the cache
+                    stats = {'memory': cache.memory_cache_stats(), 'disk': cache.disk_cache_stats(),
+                             'eviction': cacheEviction.evictor.stats(), 'snapshot': startupSnapshot.status()}
+                    return self._json_response(json.dumps(stats, indent=2))
+                case '/rebuildSnapshot':
+                    logger.info(f'Handling request {self.path}')
+
+                    # Rebuilds the startup snapshot in the background. If 'refresh' is true then the
+                    # taxonomy and groups are gotten from ebird again.
+                    started = startupSnapshot.rebuild_in_background(self._query_flag(parsed_qs, 'refresh'))
+                    return self._json_response(json.dumps({'started': started}))
                 case '/fillSpeciesCache':
                     logger.info(f'Handling request {self.path}')
 
-                    cache.fill_species_cache()
-                    return self._json_response('Species cache filled')
+                    # Starts warming up the cache in the background and returns the job id. If 'media'
+                    # is true then PNGs and WAVs are pre-rendered too. 'resume' resumes the specified job.
+                    resume_job_id = parsed_qs['resume'][0] if 'resume' in parsed_qs else None
+                    job_id = warmup_manager.start(self._query_flag(parsed_qs, 'media'), resume_job_id=resume_job_id)
+                    return self._json_response(json.dumps({'jobId': job_id}))
+                case '/warmupStatus':
+                    logger.info(f'Handling request {self.path}')
+
+                    # Returns the progress of warm-up job 'id', or of all jobs if not specified
+                    status = warmup_manager.status(parsed_qs['id'][0] if 'id' in parsed_qs else None)
+                    if status is None:
+                        return self._error_response(f'No such warm-up job {parsed_qs["id"][0]}')
+                    return self._json_response(json.dumps(status, indent=2))
                 case _:
                     # In case unknown command specified
                     msg = f'No such command {self.path}'
                     logger_bad_requests.warn(f'{self.client_address[0]} : {msg}')
                     return self._error_response(msg)
+        except PoolBusyError as e:
+            logger.warning(f'Too busy to handle request {self.path} so telling client to retry')
+            return self._busy_response(str(e))
         except Exception as e:
             msg = 'Exception for request ' + self.path + '\n' + traceback.format_exc()
             logger.error(msg)
@@ -91,7 +220,101 @@ class RequestHandler(BaseHTTPRequestHandler):
         finally:
             logger.debug(f'Done processing request {parsed_url.path}')
 
-    def _json_response(self, msg: str):
+    @staticmethod
+    def _query_flag(parsed_qs: dict, name: str) -> bool:
+        """
+        Returns true if the query string parameter is set to true, 1, or yes
+        :param parsed_qs: the parsed query string
+        :param name: name of the parameter
+        :return: true if the flag is set
+        """
+        return parsed_qs.get(name, ['false'])[0].lower() in ('true', '1', 'yes')
+
+    def _is_not_modified(self, etag: str, mtime: float = None) -> bool:
+        """
+        Determines if the client already has the current version, as indicated by the
+        If-None-Match header or, if that is not provided, by the If-Modified-Since header.
+        :param etag: ETag of the current version of the response
+        :param mtime: modification time of the current version, if known
+        :return: True if a 304 Not Modified response can be sent
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                # Weak comparison is used for If-None-Match
+                if tag == '*' or tag.removeprefix('W/') == etag:
+                    return True
+            return False
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None and mtime is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+
+        return False
+
+    def _send_validator_headers(self, etag: str, validators=None, cache_control: str = 'no-cache'):
+        """
+        Adds the ETag, Last-Modified, and Cache-Control headers
+        :param etag: the ETag for the response
+        :param validators: the _MediaValidators if the response is for a cached media file
+        :param cache_control: Cache-Control for when validators not specified
+        """
+        self.send_header('ETag', etag)
+        if validators is not None:
+            self.send_header('Last-Modified', validators.last_modified)
+            cache_control = validators.cache_control
+        self.send_header('Cache-Control', cache_control)
+
+    def _not_modified_response(self, etag: str, validators=None, cache_control: str = 'no-cache'):
+        """
+        Sends a 304 Not Modified response, which has no body
+        :param etag: the ETag for the response
+        :param validators: the _MediaValidators if the response is for a cached media file
+        :param cache_control: Cache-Control for when validators not specified
+        """
+        self.send_response(304)
+        self._send_validator_headers(etag, validators, cache_control)
+        self.end_headers()
+
+    def _media_validators(self, cache_file_name: str, suffix: str, species: str):
+        """
+        Determines the validators for a cached media file, using the size and modification time of the
+        cache file so that the file doesn't need to be read.
+        :param cache_file_name: name of the cache file
+        :param suffix: suffix of the cache file
+        :param species: the species, which is the subdirectory of the cache file
+        :return: the _MediaValidators, or None if the file isn't cached yet
+        """
+        stat = cache.file_stat(cache_file_name, suffix, species)
+        if stat is None:
+            return None
+        return _MediaValidators(cache_file_name, stat, self.date_time_string(stat.st_mtime))
+
+    def _negotiate_encoding(self, body_length: int):
+        """
+        Determines which content encoding, if any, to use for a text response. Small responses are
+        not compressed since doing so doesn't save enough to be worthwhile.
+        :param body_length: length of the uncompressed response body
+        :return: 'br', 'gzip', or None
+        """
+        if body_length < min_compress_bytes:
+            return None
+        return compression.negotiate_encoding(self.headers.get('Accept-Encoding'))
+
+    def _json_response(self, msg: str, cache_ref: tuple = None):
+        """
+        Sends a JSON response. If the client accepts compression and the response is not tiny then
+        the response is compressed.
+        :param msg: the JSON, as str or bytes
+        :param cache_ref: (filename, suffix, subdir) of the cache file that contains the JSON. If
+        specified then the compressed version is stored next to the cache file so that it only
+        needs to be compressed once.
+        """
         # If no msg then return error
         # if len(msg) == 0:
         # return error_response('No data for that query', start_response)
@@ -99,43 +322,217 @@ class RequestHandler(BaseHTTPRequestHandler):
         # If the msg is a string then convert to bytes
         response_body = bytes(msg, 'utf-8') if isinstance(msg, str) else msg
 
+        # If the client already has this exact data then don't need to send it again
+        content_hash = hashlib.sha1(response_body).hexdigest()
+        encoding = self._negotiate_encoding(len(response_body))
+        etag = f'"{content_hash}"' if encoding is None else f'"{content_hash}-{encoding}"'
+        if self._is_not_modified(etag):
+            return self._not_modified_response(etag)
+
+        # Compress the response if appropriate
+        if encoding is not None:
+            if cache_ref is not None and cache.file_exists(*cache_ref):
+                response_body = cache.read_encoded_from_cache(cache_ref[0], encoding, cache_ref[1], cache_ref[2])
+            else:
+                response_body = compression.compress(response_body, encoding)
+
         # Setup headers
         self.send_response(200)
         self.send_header('Content-Type', 'text/json')
+        self._send_validator_headers(etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
         self.send_header('Content-Length', str(len(response_body)))
         self.end_headers()
 
         # Add the body
         self.wfile.write(response_body)
 
-    def _image_response(self, image: Image):
+    def _prepared_response(self, prepared: PreparedResponse):
         """
-        Returns an http response for a png image.
-        :param image: Image object representing the PNG image
+        Writes out a response that was already fully prepared. Uses a compressed version if
+        the request accepts one.
+        :param prepared: the prepared response
         """
+        encoding = self._negotiate_encoding(len(prepared.body))
+        etag = prepared.etag if encoding is None else prepared.encoded_etags[encoding]
+        if self._is_not_modified(etag):
+            return self._not_modified_response(etag)
+
         self.send_response(200)
-        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Type', prepared.content_type)
+        self._send_validator_headers(etag)
+        self.send_header('Vary', 'Accept-Encoding')
+
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+            response_body = prepared.encoded_bodies[encoding]
+        else:
+            response_body = prepared.body
+
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
 
-        # Return object as a PNG (though should already be a PNG)
-        img_bytes_io = BytesIO()
-        image.save(img_bytes_io, 'PNG')
-        img_bytes_io.seek(0)
-        img_bytes = img_bytes_io.read()
+    def _image_response(self, png_data: bytes, validators=None):
+        """
+        Returns an http response for a png image. The data is already in PNG format, as it
+        was stored in the cache, so it is written out as is.
+        :param png_data: bytes of the PNG image
+        :param validators: the _MediaValidators for the cached PNG file
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        if validators is not None:
+            self._send_validator_headers(validators.etag, validators)
 
         # Finish up the response headers
-        content_length = len(img_bytes)
+        content_length = len(png_data)
         self.send_header('Content-Length', str(content_length))
         self.end_headers()
 
         # Write out the body
-        self.wfile.write(img_bytes)
+        self.wfile.write(png_data)
+
+    def _accepts_gzip(self) -> bool:
+        """
+        Returns true if the request accepts gzip content encoding
+        """
+        http_accept_encoding = self.headers.get('Accept-Encoding')
+        return http_accept_encoding is not None and 'gzip' in http_accept_encoding
+
+    def _wants_uncompressed_wav(self) -> bool:
+        """
+        Returns true if the uncompressed wav should be returned, which is the case if the client
+        doesn't accept gzip or if it requests a byte range. Ranges are always for the uncompressed
+        data so that clients can resume or stream the audio.
+        """
+        return self.headers.get('Range') is not None or not self._accepts_gzip()
+
+    def _wav_etag(self, validators) -> str:
+        """
+        Returns the ETag for the wav response. The gzipped and uncompressed versions are
+        different representations so they need different ETags.
+        :param validators: the _MediaValidators for the cached wav file
+        """
+        return validators.etag if self._wants_uncompressed_wav() else validators.gzip_etag
+
+    def _requested_range(self, file_size: int, etag: str):
+        """
+        Determines the byte range requested via the Range header. Only a single range is supported.
+        If an If-Range header is provided and it doesn't match the current ETag then the whole file
+        is to be returned since the client's partial data is out of date.
+        :param file_size: size of the complete data
+        :param etag: the current ETag
+        :return: None if whole file should be returned, (start, end) inclusive range if a partial
+        response should be returned, or 'unsatisfiable' if the range is not within the file
+        """
+        range_header = self.headers.get('Range')
+        if range_header is None or not range_header.startswith('bytes='):
+            return None
+
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != etag:
+            return None
+
+        range_spec = range_header[len('bytes='):].strip()
+        if ',' in range_spec:
+            # Multiple ranges not supported so just return the whole file
+            return None
 
-    def _wav_response(self, compressed_wav_data):
+        start_str, _, end_str = range_spec.partition('-')
+        try:
+            if start_str == '':
+                # Suffix range, like bytes=-500 for the last 500 bytes
+                suffix_length = int(end_str)
+                if suffix_length <= 0:
+                    return 'unsatisfiable'
+                start = max(0, file_size - suffix_length)
+                end = file_size - 1
+            else:
+                start = int(start_str)
+                end = int(end_str) if end_str != '' else file_size - 1
+                end = min(end, file_size - 1)
+        except ValueError:
+            # Invalid range header so ignore it
+            return None
+
+        if start >= file_size or start > end:
+            return 'unsatisfiable'
+        return start, end
+
+    def _send_file_body(self, file, offset: int, count: int):
+        """
+        Writes part of a file as the body of the response. Uses sendfile when writing directly
+        to a socket so that the data doesn't even need to be copied into the process.
+        :param file: the open file
+        :param offset: where in the file to start
+        :param count: number of bytes to write
+        """
+        if isinstance(self.connection, socket.socket):
+            self.connection.sendfile(file, offset, count)
+        else:
+            file.seek(offset)
+            remaining = count
+            while remaining > 0:
+                chunk = file.read(min(remaining, 64 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def _wav_file_response(self, wav_filename: str, validators=None):
         """
-        Creates a http response for a wav audio file. Can return either compressed
-        or uncompressed data, depending on the request Content-Encoding header.
+        Creates a http response for an uncompressed wav file that is served straight from the cache
+        file. Supports byte ranges so that clients can stream audio or resume an interrupted download.
+        :param wav_filename: full name of the uncompressed wav file
+        :param validators: the _MediaValidators for the cached wav file
+        """
+        try:
+            file = open(wav_filename, 'rb')
+        except FileNotFoundError:
+            # Removed since it was found in the cache, such as by eviction or because the gzipped
+            # version was rewritten, so create it again
+            logger.warning(f'Uncompressed wav file {wav_filename} was removed so creating it again')
+            file = open(get_uncompressed_wav_filename(self, missing=True), 'rb')
+
+        with file:
+            file_size = os.fstat(file.fileno()).st_size
+            etag = validators.etag if validators is not None else None
+            byte_range = self._requested_range(file_size, etag)
+
+            if byte_range == 'unsatisfiable':
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{file_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                self.send_response(200)
+                start, end = 0, file_size - 1
+            else:
+                self.send_response(206)
+                start, end = byte_range
+                self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Vary', 'Accept-Encoding')
+            if validators is not None:
+                self._send_validator_headers(etag, validators)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            self._send_file_body(file, start, end - start + 1)
+
+    def _wav_response(self, compressed_wav_data, validators=None):
+        """
+        Creates a http response for a wav audio file using the gzipped data, for clients that
+        accept gzip. Other clients get the uncompressed file via _wav_file_response().
         :param compressed_wav_data: bytes containing the data, in compressed format, to be returned
-        :return: IOBytes containing the data bytes for the full reply
+        :param validators: the _MediaValidators for the cached wav file
         """
         if compressed_wav_data is None:
             return self._error_response("Could not load image")
@@ -143,18 +540,14 @@ class RequestHandler(BaseHTTPRequestHandler):
         # Start the response
         self.send_response(200)
         self.send_header('Content-Type', 'audio/wav')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+        if validators is not None:
+            self._send_validator_headers(self._wav_etag(validators), validators)
 
-        # If gzip compression is accepted then send back already compressed wav data
-        http_accept_encoding = self.headers.get('Accept-Encoding')
-        if http_accept_encoding is not None and 'gzip' in http_accept_encoding:
-            # Using compression
-            self.send_header('Content-Encoding', 'gzip')
-            response_body = compressed_wav_data
-        else:
-            # Request not accepting compressed data so need to uncompress the compressed wav data
-            # and use it as return_data
-            uncompressed_bytes = gzip.decompress(compressed_wav_data)
-            response_body = uncompressed_bytes
+        # Send back the already compressed wav data
+        self.send_header('Content-Encoding', 'gzip')
+        response_body = compressed_wav_data
 
         # Finish up the response headers
         content_length = len(response_body)
@@ -164,6 +557,20 @@ class RequestHandler(BaseHTTPRequestHandler):
         # Write out the body
         self.wfile.write(response_body)
 
+    def _busy_response(self, msg):
+        """
+        For telling the client that the server is too busy right now and that it should retry
+        """
+        response_body = bytes(msg, 'utf-8')
+
+        self.send_response(503)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Retry-After', '5')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
     def _error_response(self, msg):
         """
         For sending back error message response
@@ -172,6 +579,7 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         self.send_response(404)
         self.send_header('Content-Type', 'text/plain')
+        self.send_header('Cache-Control', 'no-store')
         self.send_header('Content-Length', str(len(response_body)))
         self.end_headers()
         self.wfile.write(response_body)
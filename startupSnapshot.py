@@ -0,0 +1,372 @@
+#! /usr/bin/env python
+
+# Binary snapshot of the data that the server needs at startup: the taxonomy, the groups, the
+# species name list, and the supplemental species config. Without it the server has to parse
+# several JSON cache files at startup, and on a cold cache has to scrape the Macaulay track list
+# and download the full taxonomy before it can even listen on its port. The snapshot is a single
+# file that is memory mapped, so only the sections that are actually used get read from disk,
+# and each section is only decoded when it is first requested. If there is no valid snapshot
+# then the accessors return None and the data is loaded the original way.
+#
+# File format, all integers little endian:
+#   header:    8 byte magic, uint32 format version, uint32 number of sections
+#   directory: for each section a 16 byte name, uint64 offset, uint64 length, uint32 crc32, 4 pad bytes
+#   sections:  each starting at an 8 byte aligned offset
+#
+# The snapshot is rebuilt in the background when the taxonomy or groups are refreshed. It can
+# also be rebuilt while the server is running using:
+#   python3 startupSnapshot.py [--refresh]
+# where --refresh first gets the taxonomy and groups from ebird again instead of using the cache.
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import taxonomyStore
+
+logger = logging.getLogger()
+
+# Version of the file format. Snapshots with a different version are ignored and rebuilt.
+snapshot_version = 1
+
+_magic = b'IMGRSNAP'
+_header = struct.Struct('<8sII')
+_directory_entry = struct.Struct('<16sQQI4x')
+
+# For only doing one rebuild at a time
+_rebuild_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshotRebuild')
+_rebuild_future = None
+_rebuild_pending = None
+_last_rebuild = None
+_rebuild_lock = threading.Lock()
+
+
+class SnapshotError(Exception):
+    """
+    The snapshot file is corrupt or of a different version
+    """
+    pass
+
+
+class _Snapshot:
+    """
+    An opened snapshot file. Sections are located using the directory but are only checked and
+    decoded when they are requested.
+    """
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as file:
+            self.mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mapped) < _header.size:
+            raise SnapshotError('file is too short')
+        magic, version, num_sections = _header.unpack_from(self.mapped, 0)
+        if magic != _magic:
+            raise SnapshotError('file is not a startup snapshot')
+        if version != snapshot_version:
+            raise SnapshotError(f'version {version} is not the current version {snapshot_version}')
+
+        self.sections: dict[str, tuple[int, int, int]] = {}
+        for i in range(num_sections):
+            name, offset, length, crc = _directory_entry.unpack_from(self.mapped,
+                                                                     _header.size + i * _directory_entry.size)
+            if offset + length > len(self.mapped):
+                raise SnapshotError('file is truncated')
+            self.sections[name.rstrip(b'\0').decode('ascii')] = (offset, length, crc)
+
+        self.meta = json.loads(self.section('meta'))
+        self._supplemental_current = None
+
+    def section(self, name: str) -> bytes:
+        """
+        Returns the data of the section, after checking its CRC
+        :param name: name of the section
+        :return: the data
+        :raises SnapshotError: if there is no such section or it is corrupt
+        """
+        if name not in self.sections:
+            raise SnapshotError(f'no {name} section')
+        offset, length, crc = self.sections[name]
+        data = self.mapped[offset:offset + length]
+        if zlib.crc32(data) != crc:
+            raise SnapshotError(f'{name} section is corrupt')
+        return data
+
+    def supplemental_current(self) -> bool:
+        """
+        Returns true if the supplemental species config file hasn't changed since the snapshot was
+        built. If it has then the groups and supplemental config in the snapshot are out of date.
+        """
+        if self._supplemental_current is None:
+            self._supplemental_current = (_file_checksum(self.meta.get('supplementalFile'))
+                                          == self.meta.get('supplementalChecksum'))
+            if not self._supplemental_current:
+                logger.warning('Supplemental species config changed since startup snapshot was built so '
+                               'not using the snapshot groups')
+        return self._supplemental_current
+
+
+# The opened snapshot, and the identity of the file, so that a new snapshot written by another
+# process is noticed
+_current: _Snapshot = None
+_current_identity = None
+_current_lock = threading.Lock()
+
+
+def _file_checksum(filename: str):
+    """
+    Returns the crc32 of the file, or None if it doesn't exist
+    """
+    if filename is None:
+        return None
+    try:
+        with open(filename, 'rb') as file:
+            return zlib.crc32(file.read())
+    except FileNotFoundError:
+        return None
+
+
+def _snapshot():
+    """
+    Returns the opened snapshot, opening it if it hasn't been opened yet or the file has changed.
+    Only called when the memoized data needs to be loaded so checking the file each time is cheap.
+    :return: the _Snapshot, or None if there is no valid snapshot
+    """
+    global _current, _current_identity
+
+    try:
+        stat = os.stat(cache.startup_snapshot_filename)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        identity = None
+
+    with _current_lock:
+        if identity != _current_identity:
+            # Old mapping is closed when no longer referenced, since data might still be in use
+            _current = None
+            _current_identity = identity
+            if identity is not None:
+                try:
+                    _current = _Snapshot(cache.startup_snapshot_filename)
+                    logger.info(f'Opened startup snapshot {cache.startup_snapshot_filename}')
+                except (OSError, ValueError, SnapshotError) as e:
+                    logger.error(f'Not using startup snapshot {cache.startup_snapshot_filename}. {e}')
+        return _current
+
+
+def _load(name: str, decode, needs_supplemental: bool = False):
+    """
+    Decodes a section of the snapshot
+    :param name: name of the section
+    :param decode: function that converts the section data to the object
+    :param needs_supplemental: true if the section depends on the supplemental species config
+    :return: the decoded object, or None if there is no valid snapshot
+    """
+    snapshot = _snapshot()
+    if snapshot is None or (needs_supplemental and not snapshot.supplemental_current()):
+        return None
+    try:
+        return decode(snapshot.section(name))
+    except (SnapshotError, ValueError) as e:
+        logger.error(f'Could not use {name} from the startup snapshot. {e}')
+        return None
+
+
+def exists() -> bool:
+    """
+    Returns true if there is a valid snapshot
+    """
+    return _snapshot() is not None
+
+
+def taxonomy():
+    """
+    :return: the TaxonomyStore from the snapshot, or None if there is no valid snapshot
+    """
+    return _load('taxonomy', taxonomyStore.TaxonomyStore.from_snapshot)
+
+
+def groups():
+    """
+    :return: the groups dictionary from the snapshot, or None if there is no valid snapshot
+    """
+    return _load('groups', json.loads, needs_supplemental=True)
+
+
+def species_names():
+    """
+    :return: the sorted species name list from the snapshot, or None if there is no valid snapshot
+    """
+    return _load('speciesNames', json.loads)
+
+
+def supplemental_config():
+    """
+    :return: the supplemental species config from the snapshot, or None if there is no valid snapshot
+    """
+    return _load('supplemental', json.loads, needs_supplemental=True)
+
+
+def write(sections: dict[str, bytes]):
+    """
+    Writes the snapshot file atomically so that processes that have the old snapshot mapped
+    continue to use it until they notice the new one
+    :param sections: data for each section, keyed by section name
+    """
+    directory_end = _header.size + len(sections) * _directory_entry.size
+    directory = bytearray(_header.pack(_magic, snapshot_version, len(sections)))
+    body = bytearray()
+    for name, data in sections.items():
+        offset = directory_end + len(body)
+        padding = -offset % 8
+        body += b'\0' * padding
+        directory += _directory_entry.pack(name.encode('ascii'), offset + padding, len(data), zlib.crc32(data))
+        body += data
+    cache.atomic_write(cache.startup_snapshot_filename, bytes(directory + body))
+
+
+def discard():
+    """
+    Removes the snapshot so that the data is loaded from the cache files, or generated, instead.
+    Called when the data that it was built from is invalidated.
+    """
+    try:
+        os.remove(cache.startup_snapshot_filename)
+        logger.info(f'Removed startup snapshot {cache.startup_snapshot_filename}')
+    except FileNotFoundError:
+        pass
+
+
+def build(refresh: bool = False):
+    """
+    Rebuilds the snapshot. The old snapshot is discarded first so that the data is taken from the
+    cache files, or generated if they don't exist. If another process is already rebuilding the
+    snapshot then does nothing.
+    :param refresh: if True then the taxonomy and groups are first removed from the cache so that
+    they are gotten from ebird again
+    :return: dictionary describing the new snapshot, or None if another process was rebuilding it
+    """
+    from ebird import ebird, supplemental_file_name
+
+    with cache.cross_process_lock('startupSnapshot', blocking=False) as locked:
+        if not locked:
+            logger.info('Another process is rebuilding the startup snapshot')
+            return None
+
+        start = time.monotonic()
+        logger.info('Rebuilding the startup snapshot...')
+        if refresh:
+            # Also discards the snapshot
+            cache.invalidate_taxonomy()
+        else:
+            discard()
+            for name in ('EBird.__get_taxonomy_dictionary', 'EBird.__get_groups_dictionary',
+                         'EBird.get_species_name_list', 'EBird.__supplemental_species_config'):
+                cache.invalidate_memos(name)
+
+        meta = {'created': time.time(), 'supplementalFile': supplemental_file_name,
+                'supplementalChecksum': _file_checksum(supplemental_file_name)}
+        sections = {'meta': json.dumps(meta).encode('utf-8')}
+        sections.update(ebird.startup_snapshot_sections())
+        write(sections)
+
+        # Memos in this process, such as the prepared list responses, might have been created from
+        # the old snapshot. Other server processes are told to clear theirs and use the new snapshot.
+        cache.invalidate_memos()
+        cache.bump_generation()
+
+        result = {'bytes': os.path.getsize(cache.startup_snapshot_filename),
+                  'sections': {name: len(data) for name, data in sections.items()},
+                  'sec': round(time.monotonic() - start, 2)}
+        logger.info(f'Rebuilt the startup snapshot {result}')
+        return result
+
+
+def _build_in_background(refresh: bool, on_done):
+    global _last_rebuild
+
+    try:
+        result = build(refresh)
+        _last_rebuild = {'finished': time.time(), 'result': result}
+    except Exception as e:
+        logger.exception('Could not rebuild the startup snapshot')
+        _last_rebuild = {'finished': time.time(), 'error': str(e)}
+        return
+    if on_done is not None:
+        on_done()
+
+
+def _rebuild_done(_):
+    """
+    If another rebuild was requested while the last one was running then starts it, since the
+    data might have changed after the last one had already read it
+    """
+    global _rebuild_future, _rebuild_pending
+
+    with _rebuild_lock:
+        if _rebuild_pending is None:
+            return
+        refresh, on_done = _rebuild_pending
+        _rebuild_pending = None
+        _rebuild_future = _rebuild_executor.submit(_build_in_background, refresh, on_done)
+        _rebuild_future.add_done_callback(_rebuild_done)
+
+
+def rebuild_in_background(refresh: bool = False, on_done=None) -> bool:
+    """
+    Starts rebuilding the snapshot in the background. If it is already being rebuilt then
+    another rebuild is done once the current one has finished.
+    :param refresh: if True then the taxonomy and groups are gotten from ebird again
+    :param on_done: optional function called once the snapshot has been rebuilt
+    :return: true if the rebuild was started now, false if it will be done after the current one
+    """
+    global _rebuild_future, _rebuild_pending
+
+    with _rebuild_lock:
+        if _rebuild_future is not None and not _rebuild_future.done():
+            _rebuild_pending = (refresh, on_done)
+            return False
+        _rebuild_future = _rebuild_executor.submit(_build_in_background, refresh, on_done)
+        _rebuild_future.add_done_callback(_rebuild_done)
+        return True
+
+
+def status() -> dict:
+    """
+    Returns info on the snapshot, for the cacheStats endpoint
+    """
+    snapshot = _snapshot()
+    with _rebuild_lock:
+        rebuilding = (_rebuild_future is not None and not _rebuild_future.done()) or _rebuild_pending is not None
+    return {'exists': snapshot is not None,
+            'version': snapshot_version,
+            'created': snapshot.meta.get('created') if snapshot is not None else None,
+            'bytes': len(snapshot.mapped) if snapshot is not None else 0,
+            'sections': {name: length for name, (_, length, _) in snapshot.sections.items()}
+            if snapshot is not None else {},
+            'rebuilding': rebuilding,
+            'lastRebuild': _last_rebuild}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuilds the startup snapshot used by the imager server')
+    parser.add_argument('--refresh', action='store_true',
+                        help='get the taxonomy and groups from ebird again instead of using the cached data')
+    args = parser.parse_args()
+
+    result = build(args.refresh)
+    if result is None:
+        print('Another process is already rebuilding the startup snapshot')
+    else:
+        print(f'Wrote {cache.startup_snapshot_filename}: {json.dumps(result)}')
+
+
+if __name__ == '__main__':
+    main()
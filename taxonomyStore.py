@@ -0,0 +1,193 @@
+# Compact in memory store for the ebird taxonomy. The taxonomy has about 30k species but only
+# the species code, scientific name, and group (family) name are needed for each one. Instead of
+# a dictionary of dictionaries the data is stored in columns: a sorted list of the unified species
+# names, which is searched using bisect, and parallel lists of the other values. Group names are
+# shared by many species so each is stored just once. The store is created by stream parsing the
+# taxonomy from ebird one species at a time, and is saved as a marshal snapshot that loads in
+# milliseconds.
+import bisect
+import codecs
+import json
+import logging
+import marshal
+from array import array
+
+logger = logging.getLogger()
+
+# Version of the snapshot format. Snapshots with a different version are not used.
+snapshot_version = 1
+
+_decoder = json.JSONDecoder()
+
+
+class TaxonomyStore:
+    """
+    The taxonomy, keyed by unified species name. Can be used like a read only dictionary whose
+    values are dictionaries with speciesName, speciesCode, sciName, and groupName.
+    """
+    __slots__ = ('_keys', '_species_names', '_species_codes', '_sci_names', '_group_names', '_group_indexes')
+
+    def __init__(self, rows: list[tuple[str, str, str, str, str]]):
+        """
+        :param rows: list of tuples of unified species name, species name, species code, scientific
+        name, and group name. If a unified species name is listed more than once the last one is used.
+        """
+        rows_by_key = {row[0]: row for row in rows}
+        self._keys = sorted(rows_by_key)
+        self._species_names = []
+        self._species_codes = []
+        self._sci_names = []
+        self._group_names = []
+        self._group_indexes = array('H')
+
+        group_index_by_name = {}
+        for key in self._keys:
+            _, species_name, species_code, sci_name, group_name = rows_by_key[key]
+            self._species_names.append(species_name)
+            self._species_codes.append(species_code)
+            self._sci_names.append(sci_name)
+            group_index = group_index_by_name.get(group_name)
+            if group_index is None:
+                group_index = len(self._group_names)
+                group_index_by_name[group_name] = group_index
+                self._group_names.append(group_name)
+            self._group_indexes.append(group_index)
+
+    def _row(self, unified_species_name: str) -> int:
+        """
+        Returns the row for the unified species name, or -1 if it is not in the taxonomy
+        """
+        row = bisect.bisect_left(self._keys, unified_species_name)
+        if row < len(self._keys) and self._keys[row] == unified_species_name:
+            return row
+        return -1
+
+    def __contains__(self, unified_species_name: str) -> bool:
+        return self._row(unified_species_name) != -1
+
+    def __getitem__(self, unified_species_name: str) -> dict:
+        row = self._row(unified_species_name)
+        if row == -1:
+            raise KeyError(unified_species_name)
+        return {'speciesName': self._species_names[row],
+                'speciesCode': self._species_codes[row],
+                'sciName': self._sci_names[row],
+                'groupName': self._group_names[self._group_indexes[row]]}
+
+    def get(self, unified_species_name: str, default=None):
+        return self[unified_species_name] if unified_species_name in self else default
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def species_code(self, unified_species_name: str):
+        """
+        Returns just the species code, without creating a dictionary for the species
+        :return: the species code, or None if the species is not in the taxonomy
+        """
+        row = self._row(unified_species_name)
+        return self._species_codes[row] if row != -1 else None
+
+    def to_snapshot(self) -> bytes:
+        """
+        Returns the binary snapshot of the store, for caching
+        """
+        return marshal.dumps((snapshot_version, self._keys, self._species_names, self._species_codes,
+                              self._sci_names, self._group_names, self._group_indexes.tobytes()))
+
+    @classmethod
+    def from_snapshot(cls, data: bytes):
+        """
+        Creates the store from a binary snapshot created by to_snapshot()
+        :param data: the snapshot
+        :return: the TaxonomyStore, or None if the snapshot is corrupt or of a different version
+        """
+        try:
+            snapshot = marshal.loads(data)
+        except (EOFError, ValueError, TypeError) as e:
+            logger.error(f'Taxonomy snapshot is corrupt. {e}')
+            return None
+        if not isinstance(snapshot, tuple) or len(snapshot) != 7 or snapshot[0] != snapshot_version:
+            logger.warning('Taxonomy snapshot is for a different version so not using it')
+            return None
+
+        store = cls.__new__(cls)
+        (_, store._keys, store._species_names, store._species_codes, store._sci_names, store._group_names,
+         group_indexes) = snapshot
+        store._group_indexes = array('H')
+        store._group_indexes.frombytes(group_indexes)
+        return store
+
+
+def iter_json_array(chunks, encoding: str = 'utf-8'):
+    """
+    Incrementally parses a JSON array, yielding each element as soon as it has been received.
+    This way the whole array never needs to be in memory as Python objects at the same time.
+    :param chunks: iterable of bytes, such as response.iter_content()
+    :param encoding: encoding of the bytes
+    :return: yields the elements of the array
+    """
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buffer = ''
+    position = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while True:
+            # Skip whitespace and the commas between elements
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position >= len(buffer):
+                break
+            if not started:
+                # Only the start of the array itself is skipped, not the start of an element that is an array
+                if buffer[position] != '[':
+                    raise ValueError('Taxonomy data is not a JSON array')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                break
+            try:
+                element, end = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Element not completely received yet
+                break
+            if isinstance(element, (int, float)) and buffer[end:].lstrip()[:1] not in (',', ']'):
+                # The rest of the number, such as more digits or the exponent, might still be coming
+                break
+            position = end
+            yield element
+
+    # Anything other than the end of the array left over means that the data was truncated
+    remaining = buffer[position:].strip()
+    if remaining != ']':
+        raise ValueError(f'Taxonomy data ended unexpectedly: {remaining[:80]!r}')
+
+
+def parse_taxonomy(chunks, unified_name) -> TaxonomyStore:
+    """
+    Stream parses the full ebird taxonomy into a TaxonomyStore. Only the needed fields are kept.
+    :param chunks: iterable of bytes of the taxonomy JSON, such as response.iter_content()
+    :param unified_name: function that converts a species name to its unified name
+    :return: the TaxonomyStore
+    """
+    rows = []
+    for full_species in iter_json_array(chunks):
+        # If species missing any important data then skip it
+        if ('comName' not in full_species or
+                'speciesCode' not in full_species or
+                'sciName' not in full_species or
+                'familyComName' not in full_species):
+            continue
+
+        species_name = full_species['comName']
+        rows.append((unified_name(species_name), species_name, full_species['speciesCode'],
+                     full_species['sciName'], full_species['familyComName']))
+
+    logger.info(f'Parsed taxonomy with {len(rows)} species')
+    return TaxonomyStore(rows)
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The modules are in the top level directory of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+
+
+@pytest.fixture
+def cache_directory(tmp_path):
+    """
+    Switches the cache to a temporary directory, and back to the original one afterwards
+    :return: the temporary cache directory, ending with '/'
+    """
+    original_directory = cache.cache_directory
+    cache.use_cache_directory(str(tmp_path))
+    cache.invalidate_memos()
+    yield cache.cache_directory
+    cache.use_cache_directory(original_directory)
+    cache.invalidate_memos()
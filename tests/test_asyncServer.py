@@ -0,0 +1,106 @@
+# Checks that the async server streams responses and handles request timeouts and failed requests
+import http.client
+import socket
+import threading
+import time
+
+import pytest
+
+# requestHandler needs the scraping and image processing dependencies
+for module_name in ('bs4', 'requests', 'PIL', 'pydub'):
+    pytest.importorskip(module_name)
+
+import asyncServer
+from requestHandler import RequestHandler
+
+_chunk = b'x' * (64 * 1024)
+_num_chunks = 64
+
+
+def _start_server(request_timeout_sec: float = 5) -> int:
+    """
+    Starts an AsyncHTTPServer in a daemon thread
+    :return: the port it listens on
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen()
+    server = asyncServer.AsyncHTTPServer(request_timeout_sec=request_timeout_sec)
+    threading.Thread(target=server.serve_forever, args=(sock,), daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def test_response_is_streamed_while_handler_runs(monkeypatch):
+    first_chunk_read = threading.Event()
+    handler_done = []
+
+    def do_GET(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Length', str(len(_chunk) * _num_chunks))
+        handler.end_headers()
+        for i in range(_num_chunks):
+            handler.wfile.write(_chunk)
+            if i == 0:
+                # The client must get data before the handler finishes
+                assert first_chunk_read.wait(5)
+        handler_done.append(True)
+
+    monkeypatch.setattr(RequestHandler, 'do_GET', do_GET)
+    connection = http.client.HTTPConnection('127.0.0.1', _start_server(), timeout=5)
+    connection.request('GET', '/wavFile')
+    response = connection.getresponse()
+    assert response.status == 200
+    first = response.read(len(_chunk))
+    assert not handler_done
+    first_chunk_read.set()
+    assert len(first) + len(response.read()) == len(_chunk) * _num_chunks
+    connection.close()
+
+
+def test_timeout_before_writing_returns_504(monkeypatch):
+    monkeypatch.setattr(RequestHandler, 'do_GET', lambda handler: time.sleep(0.5))
+    connection = http.client.HTTPConnection('127.0.0.1', _start_server(request_timeout_sec=0.1), timeout=5)
+    connection.request('GET', '/allSpeciesList')
+    assert connection.getresponse().status == 504
+    connection.close()
+
+
+def test_writes_after_timeout_fail(monkeypatch):
+    write_errors = []
+    timed_out = threading.Event()
+
+    def do_GET(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Length', '10')
+        handler.end_headers()
+        time.sleep(0.3)
+        try:
+            handler.wfile.write(b'0123456789')
+        except ConnectionError as e:
+            write_errors.append(e)
+        timed_out.set()
+
+    monkeypatch.setattr(RequestHandler, 'do_GET', do_GET)
+    connection = http.client.HTTPConnection('127.0.0.1', _start_server(request_timeout_sec=0.1), timeout=5)
+    connection.request('GET', '/allSpeciesList')
+    response = connection.getresponse()
+    assert response.status == 200
+    with pytest.raises(http.client.IncompleteRead):
+        response.read()
+    assert timed_out.wait(5)
+    assert write_errors
+    connection.close()
+
+
+def test_failed_refresh_returns_error_response(monkeypatch):
+    import requestHandler
+
+    def failing_refresh():
+        raise RuntimeError('ebird is down')
+
+    monkeypatch.setattr(requestHandler.ebird, 'refresh_stale_data', failing_refresh)
+    connection = http.client.HTTPConnection('127.0.0.1', _start_server(), timeout=5)
+    connection.request('GET', '/noSuchCommand')
+    response = connection.getresponse()
+    assert response.status == 404 and b'ebird is down' in response.read()
+    connection.close()
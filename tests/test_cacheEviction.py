@@ -0,0 +1,78 @@
+# Checks the order in which the eviction policies evict files, and that pinned files are kept
+import os
+
+import pytest
+
+import cache
+import cacheEviction
+from cacheIndex import CacheEntry, entry_kind
+
+
+def _entry(key: str, size: int, last_access: float, hits: int) -> CacheEntry:
+    return CacheEntry(key, '/nonexistent/' + key, size, 0, last_access, entry_kind(key), hits)
+
+
+# (key, size, last access time, hits)
+_entries = [_entry('A/old_popular.png', 100, 1.0, 50),
+            _entry('B/recent_rare.png', 100, 3.0, 1),
+            _entry('C/middle_unused.png', 100, 2.0, 0),
+            _entry('D/big_popular.wav.gz', 10000, 4.0, 50)]
+
+
+@pytest.mark.parametrize('policy, expected_order', [
+    ('lru', ['A/old_popular.png', 'C/middle_unused.png', 'B/recent_rare.png', 'D/big_popular.wav.gz']),
+    ('lfu', ['C/middle_unused.png', 'B/recent_rare.png', 'A/old_popular.png', 'D/big_popular.wav.gz']),
+    ('gdsf', ['D/big_popular.wav.gz', 'C/middle_unused.png', 'B/recent_rare.png', 'A/old_popular.png'])])
+def test_policy_order(monkeypatch, policy, expected_order):
+    monkeypatch.setattr(cacheEviction, 'eviction_policy', policy)
+    evictor = cacheEviction.CacheEvictor()
+    selected = evictor._select(_entries, sum(entry.size for entry in _entries))
+    assert [entry.key for entry in selected] == expected_order
+
+
+def test_select_stops_once_enough_is_freed(monkeypatch):
+    monkeypatch.setattr(cacheEviction, 'eviction_policy', 'lru')
+    selected = cacheEviction.CacheEvictor()._select(_entries, 150)
+    assert [entry.key for entry in selected] == ['A/old_popular.png', 'C/middle_unused.png']
+
+
+def test_gdsf_ages_files_popular_long_ago(monkeypatch):
+    monkeypatch.setattr(cacheEviction, 'eviction_policy', 'gdsf')
+    evictor = cacheEviction.CacheEvictor()
+    old_popular = _entry('A/image.png', 100, 1.0, 50)
+    new_rare = _entry('B/image.png', 100, 3.0, 0)
+    assert evictor._select([old_popular, new_rare], 1)[0] is new_rare
+
+    # After an eviction pass at time 2 the inflation value is raised, so files accessed after
+    # that pass rank above files that were only popular before it
+    evictor._inflation_history.append((2.0, 1.0))
+    assert evictor._select([old_popular, new_rare], 1)[0] is old_popular
+
+
+def test_pinned_species_dirs(monkeypatch):
+    monkeypatch.setattr(cacheEviction, 'pinned_species', {'Wood Duck'})
+    monkeypatch.setattr(cacheEviction, 'pinned_top_species', 1)
+    entries = [_entry('Barn_Owl/image.png', 100, 1.0, 10), _entry('Barn_Owl/audio.wav.gz', 100, 1.0, 5),
+               _entry('Mallard/image.png', 100, 1.0, 12), _entry('Crow/image.png', 100, 1.0, 0),
+               _entry('groupsCache.json', 100, 1.0, 100)]
+    assert cacheEviction.CacheEvictor._pinned_species_dirs(entries) == {'Barn_Owl', 'Wood_Duck'}
+
+
+def test_evict_keeps_pinned_and_global_files(cache_directory, monkeypatch):
+    monkeypatch.setattr(cacheEviction, 'eviction_policy', 'lru')
+    monkeypatch.setattr(cacheEviction, 'pinned_species', {'Wood Duck'})
+    monkeypatch.setattr(cacheEviction, 'pinned_top_species', 0)
+    monkeypatch.setattr(cacheEviction, 'kind_quota_bytes', {})
+    monkeypatch.setattr(cacheEviction, 'disk_budget_bytes', 1000)
+    monkeypatch.setattr(cacheEviction, 'low_water_fraction', 1.0)
+
+    cache.write_to_cache(b'x' * 400, 'groupsCache.json')
+    for species in ('Wood Duck', 'Barn Owl', 'Mallard'):
+        cache.write_to_cache(b'x' * 400, 'image_ML1.png', subdir=species)
+
+    evicted_files, evicted_bytes = cacheEviction.CacheEvictor().evict()
+    assert (evicted_files, evicted_bytes) == (2, 800)
+    assert cache.file_exists('groupsCache.json')
+    assert cache.file_exists('image_ML1.png', subdir='Wood Duck')
+    assert not cache.file_exists('image_ML1.png', subdir='Barn Owl')
+    assert not os.path.exists(cache.get_full_filename('image_ML1.png', subdir='Mallard'))
@@ -0,0 +1,179 @@
+# Checks that truncated cache files are detected and quarantined, and that out of date derived files are removed
+import builtins
+import gzip
+import os
+
+import pytest
+
+import cache
+
+_png = b'\x89PNG\r\n\x1a\n' + b'\0' * 100 + b'IEND\xaeB`\x82'
+
+
+def _forget_checks(full_filename: str):
+    """
+    Makes the cache treat the file as if this process had never seen it, like after a restart
+    """
+    cache._memory_tier.remove(full_filename)
+    cache._validated_files.pop(full_filename, None)
+
+
+def _quarantined() -> list[str]:
+    return os.listdir(cache.quarantine_directory) if os.path.isdir(cache.quarantine_directory) else []
+
+
+def test_file_exists_checks_size_without_reading(cache_directory, monkeypatch):
+    cache.write_to_cache(_png, 'image_ML1.png', subdir='Wood Duck')
+    full_filename = cache.get_full_filename('image_ML1.png', subdir='Wood Duck')
+    _forget_checks(full_filename)
+
+    monkeypatch.setattr(builtins, 'open', lambda *args, **kwargs: pytest.fail(f'file opened {args}'))
+    assert cache.file_exists('image_ML1.png', subdir='Wood Duck')
+    assert cache.file_exists('image_ML1.png', subdir='Wood Duck')
+
+
+def test_file_exists_quarantines_file_with_wrong_size(cache_directory):
+    cache.write_to_cache(_png, 'image_ML1.png', subdir='Wood Duck')
+    full_filename = cache.get_full_filename('image_ML1.png', subdir='Wood Duck')
+    _forget_checks(full_filename)
+
+    # Truncate it while keeping the modification time, like a crash of an older non-atomic version
+    stat = os.stat(full_filename)
+    with open(full_filename, 'r+b') as file:
+        file.truncate(20)
+    os.utime(full_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert not cache.file_exists('image_ML1.png', subdir='Wood Duck')
+    assert not os.path.exists(full_filename)
+    assert len(_quarantined()) == 1
+
+
+def test_file_exists_accepts_file_replaced_by_other_process(cache_directory):
+    cache.write_to_cache(b'{"a": 1}', 'speciesDataCache.json', subdir='Wood Duck')
+    full_filename = cache.get_full_filename('speciesDataCache.json', subdir='Wood Duck')
+    _forget_checks(full_filename)
+
+    stat = os.stat(full_filename)
+    with open(full_filename, 'wb') as file:
+        file.write(b'{"a": 1, "b": 2}')
+    os.utime(full_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert cache.file_exists('speciesDataCache.json', subdir='Wood Duck')
+    assert cache.file_stat('speciesDataCache.json', subdir='Wood Duck').st_size == os.path.getsize(full_filename)
+    assert cache.read_from_cache('speciesDataCache.json', subdir='Wood Duck') == b'{"a": 1, "b": 2}'
+
+
+def test_read_quarantines_truncated_contents(cache_directory):
+    data = gzip.compress(os.urandom(10000))
+    cache.write_to_cache(data, 'audio_ML2.wav.gz', subdir='Wood Duck')
+    full_filename = cache.get_full_filename('audio_ML2.wav.gz', subdir='Wood Duck')
+    _forget_checks(full_filename)
+    with open(full_filename, 'r+b') as file:
+        file.truncate(len(data) // 2)
+    cache.index().record(cache.cache_key('audio_ML2.wav.gz', subdir='Wood Duck'), full_filename,
+                         os.path.getsize(full_filename), os.stat(full_filename).st_mtime_ns)
+
+    # Same size as in the index so only reading the contents shows that it is truncated
+    assert cache.file_exists('audio_ML2.wav.gz', subdir='Wood Duck')
+    with pytest.raises(cache.CorruptCacheFileError):
+        cache.read_from_cache('audio_ML2.wav.gz', subdir='Wood Duck')
+    assert not cache.file_exists('audio_ML2.wav.gz', subdir='Wood Duck')
+    assert len(_quarantined()) == 1
+
+
+def test_validate_files_quarantines_truncated_files(cache_directory, monkeypatch):
+    monkeypatch.setattr(cache, 'validation_pause_sec', 0)
+    cache.write_to_cache(_png, 'image_ML1.png', subdir='Wood Duck')
+    cache.write_to_cache(_png, 'image_ML3.png', subdir='Wood Duck')
+    truncated_filename = cache.get_full_filename('image_ML3.png', subdir='Wood Duck')
+    _forget_checks(truncated_filename)
+    with open(truncated_filename, 'r+b') as file:
+        file.truncate(50)
+    cache.index().record(cache.cache_key('image_ML3.png', subdir='Wood Duck'), truncated_filename, 50,
+                         os.stat(truncated_filename).st_mtime_ns)
+
+    assert cache.validate_files() == 1
+    assert cache.file_exists('image_ML1.png', subdir='Wood Duck')
+    assert not cache.file_exists('image_ML3.png', subdir='Wood Duck')
+
+
+def test_atomic_write_replaces_whole_file(cache_directory):
+    full_filename = cache.get_full_filename('speciesDataCache.json', subdir='Wood Duck')
+    cache.atomic_write(full_filename, b'{"version": 1}')
+    cache.atomic_write(full_filename, b'{"version": 2}')
+    with open(full_filename, 'rb') as file:
+        assert file.read() == b'{"version": 2}'
+    assert os.listdir(os.path.dirname(full_filename)) == [os.path.basename(full_filename)]
+
+
+def test_failed_atomic_write_keeps_old_file(cache_directory, monkeypatch):
+    full_filename = cache.get_full_filename('speciesDataCache.json', subdir='Wood Duck')
+    cache.atomic_write(full_filename, b'{"version": 1}')
+
+    def failing_replace(src, dst):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(os, 'replace', failing_replace)
+    with pytest.raises(OSError):
+        cache.atomic_write(full_filename, b'{"version": 2}')
+    monkeypatch.undo()
+
+    with open(full_filename, 'rb') as file:
+        assert file.read() == b'{"version": 1}'
+    # The temporary file was removed
+    assert os.listdir(os.path.dirname(full_filename)) == [os.path.basename(full_filename)]
+
+
+def test_quarantined_file_is_recreated(cache_directory):
+    cache.write_to_cache(_png, 'image_ML1.png', subdir='Wood Duck')
+    full_filename = cache.get_full_filename('image_ML1.png', subdir='Wood Duck')
+    _forget_checks(full_filename)
+    with open(full_filename, 'r+b') as file:
+        file.truncate(50)
+    cache.index().record(cache.cache_key('image_ML1.png', subdir='Wood Duck'), full_filename, 50,
+                         os.stat(full_filename).st_mtime_ns)
+    with pytest.raises(cache.CorruptCacheFileError):
+        cache.read_from_cache('image_ML1.png', subdir='Wood Duck')
+
+    # The quarantined file keeps its contents so that it can be looked at
+    quarantined = _quarantined()
+    assert len(quarantined) == 1 and quarantined[0].endswith('Wood_Duck__image_ML1.png')
+    with open(cache.quarantine_directory + quarantined[0], 'rb') as file:
+        assert file.read() == _png[:50]
+
+    cache.write_to_cache(_png, 'image_ML1.png', subdir='Wood Duck')
+    _forget_checks(full_filename)
+    assert cache.read_from_cache('image_ML1.png', subdir='Wood Duck') == _png
+
+
+def test_writing_uncompressed_wav_keeps_gzipped_version(cache_directory):
+    cache.write_to_cache(gzip.compress(b'RIFF wav'), 'audio_ML2.wav.gz', subdir='Wood Duck')
+    cache.write_to_cache(b'RIFF wav', 'audio_ML2.wav', subdir='Wood Duck')
+    assert cache.file_exists('audio_ML2.wav.gz', subdir='Wood Duck')
+    assert cache.file_exists('audio_ML2.wav', subdir='Wood Duck')
+
+
+def test_rewriting_gzipped_wav_removes_uncompressed_version(cache_directory):
+    cache.write_to_cache(gzip.compress(b'RIFF wav'), 'audio_ML2.wav.gz', subdir='Wood Duck')
+    cache.write_to_cache(b'RIFF wav', 'audio_ML2.wav', subdir='Wood Duck')
+    cache.write_to_cache(gzip.compress(b'RIFF new wav'), 'audio_ML2.wav.gz', subdir='Wood Duck')
+    assert not cache.file_exists('audio_ML2.wav', subdir='Wood Duck')
+    assert not os.path.exists(cache.get_full_filename('audio_ML2.wav', subdir='Wood Duck'))
+
+
+def test_rewriting_json_removes_encoded_versions(cache_directory):
+    cache.write_to_cache(b'{"a": 1}', 'speciesDataCache.json', subdir='Wood Duck')
+    cache.read_encoded_from_cache('speciesDataCache.json', 'gzip', subdir='Wood Duck')
+    assert cache.file_exists('speciesDataCache.json.gz', subdir='Wood Duck')
+
+    cache.write_to_cache(b'{"a": 2}', 'speciesDataCache.json', subdir='Wood Duck')
+    assert not cache.file_exists('speciesDataCache.json.gz', subdir='Wood Duck')
+    assert gzip.decompress(cache.read_encoded_from_cache('speciesDataCache.json', 'gzip',
+                                                         subdir='Wood Duck')) == b'{"a": 2}'
+
+
+def test_resync_forgets_removed_file(cache_directory):
+    cache.write_to_cache(b'RIFF wav', 'audio_ML2.wav', subdir='Wood Duck')
+    os.remove(cache.get_full_filename('audio_ML2.wav', subdir='Wood Duck'))
+    cache.resync('audio_ML2.wav', subdir='Wood Duck')
+    assert not cache.file_exists('audio_ML2.wav', subdir='Wood Duck')
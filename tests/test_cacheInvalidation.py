@@ -0,0 +1,56 @@
+# Checks that invalidation removes the matching cache files and only counts files that were really removed
+import os
+
+import cache
+
+
+def _write_species_files(*species_names: str):
+    for species_name in species_names:
+        cache.write_to_cache(b'{}', 'speciesDataCache.json', subdir=species_name)
+        cache.write_to_cache(b'png', 'image_ML1.png', subdir=species_name)
+
+
+def test_invalidate_group_removes_species_in_one_pass(cache_directory, monkeypatch):
+    _write_species_files('Wood Duck', 'Mallard', 'Barn Owl')
+    entries_from_db = cache.index().entries_from_db
+    passes = []
+    monkeypatch.setattr(cache.index(), 'entries_from_db', lambda: passes.append(1) or entries_from_db())
+    bump_generation = cache.bump_generation
+    bumps = []
+    monkeypatch.setattr(cache, 'bump_generation', lambda: bumps.append(1) or bump_generation())
+
+    result = cache.invalidate_group('Ducks', ['Wood Duck', 'Mallard'])
+    assert result == {'group': 'Ducks', 'species': 2, 'files': 2, 'bytes': 4}
+    assert (len(passes), len(bumps)) == (1, 1)
+    assert not cache.file_exists('speciesDataCache.json', subdir='Mallard')
+    assert cache.file_exists('image_ML1.png', subdir='Mallard')
+    assert cache.file_exists('speciesDataCache.json', subdir='Barn Owl')
+
+
+def test_invalidate_group_with_media(cache_directory):
+    _write_species_files('Wood Duck', 'Barn Owl')
+    assert cache.invalidate_group('Ducks', ['Wood Duck'], include_media=True)['files'] == 2
+    assert not cache.file_exists('image_ML1.png', subdir='Wood Duck')
+    assert cache.file_exists('image_ML1.png', subdir='Barn Owl')
+
+
+def test_invalidate_empty_group_removes_nothing(cache_directory):
+    _write_species_files('Wood Duck')
+    assert cache.invalidate_group('Unknown', [])['files'] == 0
+    assert cache.file_exists('speciesDataCache.json', subdir='Wood Duck')
+
+
+def test_invalidate_does_not_count_files_already_removed(cache_directory):
+    _write_species_files('Wood Duck')
+    os.remove(cache.get_full_filename('image_ML1.png', subdir='Wood Duck'))
+
+    # Removed by another process, so it is still in the index but no longer on disk
+    result = cache.invalidate('Wood_Duck/*')
+    assert (result['files'], result['bytes']) == (1, 2)
+    assert cache.index().entries_from_db() == []
+
+
+def test_species_pattern_escapes_glob_characters(cache_directory):
+    _write_species_files('Wood Duck', '[Wood Duck]')
+    assert cache.invalidate_species('[Wood Duck]', include_media=True)['files'] == 2
+    assert cache.file_exists('speciesDataCache.json', subdir='Wood Duck')
@@ -0,0 +1,109 @@
+# Checks the layout of the cache directory: the derived paths, the sharded files, and the index
+import os
+
+import cache
+import cacheMigrate
+from cacheIndex import CacheIndex
+
+
+def test_use_cache_directory_moves_all_paths(cache_directory):
+    paths = [cache.objects_directory, cache.index_filename, cache.quarantine_directory, cache.lock_directory,
+             cache.generation_filename, cache.index_generation_filename, cache.warmup_directory,
+             cache.startup_snapshot_filename]
+    assert all(path.startswith(cache_directory) for path in paths)
+    assert cache.index().db_filename == cache.index_filename
+    assert {os.path.basename(path.rstrip('/')) for path in paths} <= cache.reserved_names()
+    assert 'logs' in cache.reserved_names()
+
+
+def test_files_are_sharded_by_key_hash(cache_directory):
+    cache.write_to_cache(b'{}', 'speciesDataCache.json', subdir="Cooper's Hawk")
+    key = cache.cache_key('speciesDataCache.json', subdir="Cooper's Hawk")
+    full_filename = cache.path_for_key(key)
+
+    relative_parts = full_filename[len(cache.objects_directory):].split('/')
+    assert len(relative_parts) == 3
+    assert [len(part) for part in relative_parts[:2]] == [2, 2]
+    assert relative_parts[2].startswith(relative_parts[0] + relative_parts[1])
+    assert relative_parts[2].endswith('.json')
+    assert os.path.isfile(full_filename)
+    assert full_filename == cache.get_full_filename('speciesDataCache.json', subdir="Cooper's Hawk")
+
+
+def test_index_records_files_and_survives_reload(cache_directory):
+    cache.write_to_cache(b'x' * 10, 'image_ML1.png', subdir='Wood Duck')
+    cache.write_to_cache(b'y' * 20, 'audio_ML2.wav.gz', subdir='Wood Duck')
+    key = cache.cache_key('image_ML1.png', subdir='Wood Duck')
+    entry = cache.index().get(key)
+    assert (entry.size, entry.kind, entry.path) == (10, 'png', cache.path_for_key(key))
+
+    # A new index on the same database, like another process or a restart, sees the same files
+    reloaded = CacheIndex(cache.index_filename)
+    assert {entry.key: (entry.size, entry.kind) for entry in reloaded.entries()} == {
+        key: (10, 'png'), cache.cache_key('audio_ML2.wav.gz', subdir='Wood Duck'): (20, 'wav.gz')}
+
+    cache.index().remove(key)
+    assert not cache.file_exists('image_ML1.png', subdir='Wood Duck')
+    assert CacheIndex(cache.index_filename).get(key) is None
+
+
+def test_index_counts_hits_from_all_processes(cache_directory):
+    cache.write_to_cache(b'x' * 10, 'image_ML1.png', subdir='Wood Duck')
+    key = cache.cache_key('image_ML1.png', subdir='Wood Duck')
+    other_process_index = CacheIndex(cache.index_filename)
+    for index in (cache.index(), other_process_index, other_process_index):
+        assert index.get(key) is not None
+        index.touch(key)
+        index.flush()
+    assert {entry.key: entry.hits for entry in cache.all_entries()}[key] == 3
+
+
+def _write_old_layout(cache_directory: str):
+    """
+    Creates a cache in the original layout, with a directory per species
+    :return: dictionary of the files, keyed by cache key, with their contents
+    """
+    files = {'Wood_Duck/image_ML1.png': b'png data', 'Wood_Duck/speciesDataCache.json': b'{}',
+             'Barn_Owl/audio_ML2.wav.gz': b'wav data', 'groupsCache.json': b'{"Ducks": []}'}
+    for key, data in files.items():
+        os.makedirs(os.path.dirname(cache_directory + key), exist_ok=True)
+        with open(cache_directory + key, 'wb') as file:
+            file.write(data)
+
+    # Files that are not cache entries, and a temporary file left by an interrupted write
+    os.makedirs(cache.warmup_directory)
+    with open(cache.warmup_directory + '0123456789ab.json', 'w') as file:
+        file.write('{}')
+    with open(cache.startup_snapshot_filename, 'wb') as file:
+        file.write(b'snapshot')
+    with open(cache_directory + 'Wood_Duck/.image_ML3.png.x.tmp', 'wb') as file:
+        file.write(b'partial')
+    return files
+
+
+def test_migrate_dry_run_changes_nothing(cache_directory, capsys):
+    files = _write_old_layout(cache_directory)
+    before = sorted(os.walk(cache_directory))
+
+    assert cacheMigrate.migrate(dry_run=True) == (len(files), sum(len(data) for data in files.values()))
+    assert sorted(os.walk(cache_directory)) == before
+    assert cache.index().entries() == []
+    output = capsys.readouterr().out
+    assert all(key in output for key in files)
+    assert 'warmup' not in output and 'startupSnapshot' not in output and '.tmp' not in output
+
+
+def test_migrate_moves_files_into_sharded_layout(cache_directory):
+    files = _write_old_layout(cache_directory)
+
+    assert cacheMigrate.migrate() == (len(files), sum(len(data) for data in files.values()))
+    for key, data in files.items():
+        with open(cache.path_for_key(key), 'rb') as file:
+            assert file.read() == data
+        assert cache.index().get(key).size == len(data)
+    assert not os.path.exists(cache_directory + 'Barn_Owl')
+    assert os.path.exists(cache.warmup_directory + '0123456789ab.json')
+    assert os.path.exists(cache.startup_snapshot_filename)
+
+    # Running it again does nothing since the files were already moved
+    assert cacheMigrate.migrate() == (0, 0)
@@ -0,0 +1,53 @@
+# Checks which computations take cross process locks when the cache is shared by multiple processes
+import os
+
+import pytest
+
+import cache
+
+
+@pytest.fixture
+def lock_directory(tmp_path, monkeypatch):
+    """
+    Turns on the cross process locks, with the lock files in a temporary directory
+    :return: the lock directory
+    """
+    directory = str(tmp_path / 'locks') + '/'
+    monkeypatch.setattr(cache, 'lock_directory', directory)
+    monkeypatch.setattr(cache, 'use_cross_process_locks', True)
+    cache.invalidate_memos()
+    yield directory
+    cache.invalidate_memos()
+
+
+def _lock_files(directory: str) -> list[str]:
+    return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+
+def test_memo_without_cache_file_takes_no_lock(lock_directory):
+    @cache.memoized
+    def derived(name):
+        return name.upper()
+
+    for i in range(10):
+        assert derived(f'client string {i}') == f'CLIENT STRING {i}'
+    assert _lock_files(lock_directory) == []
+
+
+def test_memo_with_cache_file_locks_the_cache_file(lock_directory):
+    @cache.memoized(cache_file=lambda name: ('someCache.json', '', name) if name != 'unknown' else None)
+    def created(name):
+        return name.upper()
+
+    assert created('Wood Duck') == 'WOOD DUCK'
+    assert created('Wood Duck') == 'WOOD DUCK'
+    assert created('unknown') == 'UNKNOWN'
+    lock_key = cache.get_full_filename('someCache.json', '', 'Wood Duck')
+    assert _lock_files(lock_directory) == [cache.stable_hash_str(lock_key) + '.lock']
+
+
+def test_single_flight_locks_only_cross_process_keys(lock_directory):
+    assert cache.single_flight('memo key', lambda: 1, cross_process=False) == 1
+    assert _lock_files(lock_directory) == []
+    assert cache.single_flight('/cache/file.png', lambda: 2) == 2
+    assert _lock_files(lock_directory) == [cache.stable_hash_str('/cache/file.png') + '.lock']
@@ -0,0 +1,80 @@
+# Checks the scanning of the ResultsList entries of the ebird catalog pages
+import os
+
+import pytest
+
+pytest.importorskip('bs4')
+
+import catalogParser
+
+_fixtures_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data',
+                                   'catalogFixtures')
+
+
+def _ids(html: str) -> list[str]:
+    return [li.get('id') for li in catalogParser.results_list_items(html)]
+
+
+@pytest.fixture(params=['html.parser', 'lxml'])
+def backend(request, monkeypatch):
+    if request.param == 'lxml' and catalogParser.lxml is None:
+        pytest.skip('lxml is not installed')
+    monkeypatch.setattr(catalogParser, 'parser_backend', request.param)
+
+
+def test_items_of_nested_lists_are_skipped(backend):
+    html = ('<ul><li id="nav">Nav</li></ul>'
+            '<ol class="ResultsList">'
+            '<li id="a"><ol><li id="a1">x</li><li id="a2">y</li></ol><ul><li id="a3">z</li></ul></li>'
+            '<li id="b">b</li>'
+            '</ol>'
+            '<ul><li id="footer">Footer</li></ul>')
+    assert _ids(html) == ['a', 'b']
+
+
+def test_unclosed_items(backend):
+    html = '<ol class="Other ResultsList"><li id="a">a<li id="b">b<li id="c">c</ol><li id="after">'
+    assert _ids(html) == ['a', 'b', 'c']
+
+
+def test_empty_results_list(backend):
+    assert _ids('<ol class="ResultsList"></ol>') == []
+
+
+def test_missing_results_list_raises(backend):
+    with pytest.raises(catalogParser.MissingResultsListError):
+        _ids('<html><body><ol class="Other"><li>Not a result</li></ol></body></html>')
+    with pytest.raises(catalogParser.MissingResultsListError):
+        catalogParser.parse_image_list('<html><body>Something went wrong</body></html>')
+
+
+def test_stops_parsing_at_max_entries(backend, monkeypatch):
+    monkeypatch.setattr(catalogParser, 'max_entries', 2)
+    parsed = []
+    parse_item = catalogParser._parse_item
+
+    def counting_parse_item(fragment, features):
+        parsed.append(fragment)
+        return parse_item(fragment, features)
+
+    monkeypatch.setattr(catalogParser, '_parse_item', counting_parse_item)
+    with open(os.path.join(_fixtures_directory, 'wooduc_photo.html'), encoding='utf-8') as file:
+        html = file.read()
+    assert len(catalogParser.parse_image_list(html)) == 2
+    assert len(parsed) == 2
+
+
+@pytest.mark.parametrize('filename', ['wooduc_photo.html', 'barowl_photo.html'])
+def test_parse_image_list(backend, filename):
+    with open(os.path.join(_fixtures_directory, filename), encoding='utf-8') as file:
+        image_info_list = catalogParser.parse_image_list(file.read())
+    assert image_info_list
+    assert all(info['catalog'].startswith('ML') and info['imageUrl'] for info in image_info_list)
+
+
+@pytest.mark.parametrize('filename', ['wooduc_audio.html', 'barowl_audio.html'])
+def test_parse_audio_list(backend, filename):
+    with open(os.path.join(_fixtures_directory, filename), encoding='utf-8') as file:
+        audio_info_list = catalogParser.parse_audio_list(file.read())
+    assert audio_info_list
+    assert all(info['audioUrl'].endswith('/mp3') for info in audio_info_list)
@@ -0,0 +1,108 @@
+# Checks that the memoized EBird accessors only read their cache files once
+import builtins
+import importlib
+import json
+import os
+
+import pytest
+
+# ebird needs the scraping and image processing dependencies
+for module_name in ('bs4', 'requests', 'PIL', 'pydub'):
+    pytest.importorskip(module_name)
+
+import cache
+import taxonomyStore
+import upstream
+
+_taxonomy = taxonomyStore.TaxonomyStore([('wood duck', 'Wood Duck', 'wooduc', 'Aix sponsa', 'Ducks'),
+                                         ('barn owl', 'Barn Owl', 'brnowl', 'Tyto alba', 'Owls')])
+_groups = {'Ducks': ['Wood Duck'], 'Owls': ['Barn Owl']}
+_cache_files = {
+    ('ebirdTaxonomyCache.marshal', ''): _taxonomy.to_snapshot(),
+    ('groupsCache.json', ''): json.dumps(_groups).encode('utf-8'),
+    ('speciesNamesListCache.json', ''): b'["Barn Owl","Wood Duck"]',
+    ('groupNamesListCache.json', ''): b'["Ducks","Owls"]',
+    ('speciesDataCache.json', 'Wood Duck'): b'{"speciesName":"Wood Duck","imageDataList":[],"audioDataList":[]}',
+}
+
+
+@pytest.fixture
+def disk_reads(monkeypatch):
+    """
+    Serves the cache files from memory, without a startup snapshot, and records each read. ebird
+    is imported here, after the cache has been patched, since it loads data when it is imported.
+    :return: tuple of the list of the names of the files that were read, and the EBird object
+    """
+    reads = []
+
+    def read_from_cache(filename, suffix='', subdir=''):
+        reads.append(filename)
+        return _cache_files[(filename, subdir)]
+
+    monkeypatch.setattr(cache, 'startup_snapshot_filename', '/nonexistent/startupSnapshot.bin')
+    monkeypatch.setattr(cache, 'file_exists', lambda filename, suffix='', subdir='': (filename, subdir) in _cache_files)
+    monkeypatch.setattr(cache, 'read_from_cache', read_from_cache)
+    cache.invalidate_memos()
+    yield reads, importlib.import_module('ebird').ebird
+    cache.invalidate_memos()
+
+
+@pytest.mark.parametrize('accessor', [lambda ebird: ebird.get_species_list_json(),
+                                      lambda ebird: ebird.get_group_list_json(),
+                                      lambda ebird: ebird.get_species_by_group_json(),
+                                      lambda ebird: ebird.get_species_for_group_json('Ducks'),
+                                      lambda ebird: ebird.get_species_info('Wood Duck'),
+                                      lambda ebird: ebird._EBird__get_species_code('Wood Duck')])
+def test_repeated_calls_do_no_disk_reads(disk_reads, monkeypatch, accessor):
+    reads, ebird = disk_reads
+    first = accessor(ebird)
+    assert reads
+
+    reads_after_first_call = list(reads)
+    monkeypatch.setattr(builtins, 'open', lambda *args, **kwargs: pytest.fail(f'file opened {args}'))
+    assert accessor(ebird) == first
+    assert reads == reads_after_first_call
+
+
+def test_invalidate_memos_reads_again(disk_reads):
+    reads, ebird = disk_reads
+    ebird.get_species_list_json()
+    cache.invalidate_memos('EBird.get_species_list_json')
+    ebird.get_species_list_json()
+    assert reads.count('speciesNamesListCache.json') == 2
+
+
+def test_unknown_group_is_not_memoized(disk_reads):
+    reads, ebird = disk_reads
+    for i in range(3):
+        assert ebird.get_species_for_group_json(f'No such group {i}').startswith('Error')
+    assert cache.invalidate_memos('EBird.get_species_for_group_json') == 0
+
+
+def test_catalog_page_without_results_list_is_partial_and_not_cached(disk_reads, monkeypatch):
+    reads, ebird = disk_reads
+    writes = []
+
+    class ErrorPage:
+        text = '<html><body>Something went wrong</body></html>'
+
+    monkeypatch.setattr(upstream, 'get', lambda url, headers=None, deadline=None: ErrorPage())
+    monkeypatch.setattr(cache, 'write_to_cache', lambda data, filename, suffix='', subdir='': writes.append(filename))
+    species_info = json.loads(ebird.get_species_info('Barn Owl'))
+    assert species_info['partial']
+    assert sorted(species_info['missing']) == ['audioDataList', 'imageDataList']
+    assert not writes
+    assert cache.invalidate_memos('EBird.__get_species_info') == 0
+
+
+def test_unknown_species_creates_no_lock_file(disk_reads, monkeypatch, tmp_path):
+    reads, ebird = disk_reads
+    monkeypatch.setattr(cache, 'lock_directory', str(tmp_path) + '/')
+    monkeypatch.setattr(cache, 'use_cross_process_locks', True)
+    monkeypatch.setattr(ebird, '_EBird__supplemental_species_config', lambda: {})
+    assert json.loads(ebird.get_species_info('Wood Duck'))['speciesName'] == 'Wood Duck'
+    lock_files = os.listdir(tmp_path)
+    assert cache.stable_hash_str(cache.get_full_filename('speciesDataCache.json', '', 'Wood Duck')) + '.lock' in lock_files
+
+    assert ebird.get_species_info('No such species') is None
+    assert os.listdir(tmp_path) == lock_files
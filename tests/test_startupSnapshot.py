@@ -0,0 +1,108 @@
+# Checks writing and reading the startup snapshot, and that corrupt snapshots are not used
+import json
+import os
+import zlib
+
+import pytest
+
+import cache
+import startupSnapshot
+import taxonomyStore
+
+_taxonomy = taxonomyStore.TaxonomyStore([('wood duck', 'Wood Duck', 'wooduc', 'Aix sponsa', 'Ducks'),
+                                         ('barn owl', 'Barn Owl', 'brnowl', 'Tyto alba', 'Owls')])
+_groups = {'Ducks': ['Wood Duck'], 'Owls': ['Barn Owl']}
+_species_names = ['Barn Owl', 'Wood Duck']
+_supplemental = {'Bird Of Paradise': {'speciesName': 'Bird Of Paradise', 'groupName': 'Paradise'}}
+
+
+@pytest.fixture
+def snapshot_sections(cache_directory, tmp_path):
+    """
+    Sections for a snapshot in the temporary cache directory, built from a supplemental config file
+    :return: the sections, keyed by name
+    """
+    supplemental_filename = str(tmp_path / 'supplementalSpeciesConfig.json')
+    with open(supplemental_filename, 'wb') as file:
+        file.write(json.dumps(_supplemental).encode('utf-8'))
+    with open(supplemental_filename, 'rb') as file:
+        meta = {'supplementalFile': supplemental_filename, 'supplementalChecksum': zlib.crc32(file.read())}
+
+    _reopen()
+    yield {'meta': json.dumps(meta).encode('utf-8'),
+           'taxonomy': _taxonomy.to_snapshot(),
+           'groups': json.dumps(_groups).encode('utf-8'),
+           'speciesNames': json.dumps(_species_names).encode('utf-8'),
+           'supplemental': json.dumps(_supplemental).encode('utf-8')}
+    _reopen()
+
+
+def _reopen():
+    """
+    Makes the next access open the snapshot file again, like a newly started process
+    """
+    startupSnapshot._current = None
+    startupSnapshot._current_identity = None
+
+
+def test_round_trip(snapshot_sections):
+    assert not startupSnapshot.exists()
+    startupSnapshot.write(snapshot_sections)
+    assert startupSnapshot.exists()
+
+    store = startupSnapshot.taxonomy()
+    assert list(store) == list(_taxonomy) and store['wood duck'] == _taxonomy['wood duck']
+    assert startupSnapshot.groups() == _groups
+    assert startupSnapshot.species_names() == _species_names
+    assert startupSnapshot.supplemental_config() == _supplemental
+
+    # Sections start at 8 byte aligned offsets
+    assert all(offset % 8 == 0 for offset, _, _ in startupSnapshot._snapshot().sections.values())
+
+
+def test_crc_mismatch_only_rejects_the_corrupt_section(snapshot_sections):
+    startupSnapshot.write(snapshot_sections)
+    offset, length, _ = startupSnapshot._snapshot().sections['groups']
+    _reopen()
+    with open(cache.startup_snapshot_filename, 'r+b') as file:
+        file.seek(offset + length // 2)
+        byte = file.read(1)
+        file.seek(offset + length // 2)
+        file.write(bytes([byte[0] ^ 0xFF]))
+
+    assert startupSnapshot.groups() is None
+    assert startupSnapshot.species_names() == _species_names
+    with pytest.raises(startupSnapshot.SnapshotError):
+        startupSnapshot._snapshot().section('groups')
+
+
+@pytest.mark.parametrize('keep_fraction', [0, 0.1, 0.5, 0.99])
+def test_truncated_file_is_not_used(snapshot_sections, keep_fraction):
+    startupSnapshot.write(snapshot_sections)
+    _reopen()
+    size = os.path.getsize(cache.startup_snapshot_filename)
+    with open(cache.startup_snapshot_filename, 'r+b') as file:
+        file.truncate(int(size * keep_fraction))
+
+    assert not startupSnapshot.exists()
+    assert startupSnapshot.taxonomy() is None
+    assert startupSnapshot.species_names() is None
+
+
+def test_other_version_is_not_used(snapshot_sections, monkeypatch):
+    startupSnapshot.write(snapshot_sections)
+    _reopen()
+    monkeypatch.setattr(startupSnapshot, 'snapshot_version', startupSnapshot.snapshot_version + 1)
+    assert not startupSnapshot.exists()
+
+
+def test_changed_supplemental_config_only_rejects_dependent_sections(snapshot_sections):
+    startupSnapshot.write(snapshot_sections)
+    supplemental_filename = json.loads(snapshot_sections['meta'])['supplementalFile']
+    with open(supplemental_filename, 'w') as file:
+        file.write('{}')
+    _reopen()
+
+    assert startupSnapshot.groups() is None
+    assert startupSnapshot.supplemental_config() is None
+    assert startupSnapshot.species_names() == _species_names
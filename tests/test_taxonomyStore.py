@@ -0,0 +1,85 @@
+# Checks the stream parsing of the taxonomy and the snapshot of the TaxonomyStore
+import json
+import marshal
+
+import pytest
+
+import taxonomyStore
+
+_taxonomy = [{'comName': 'Wood Duck', 'speciesCode': 'wooduc', 'sciName': 'Aix sponsa', 'familyComName': 'Ducks'},
+             {'comName': 'Barn Owl', 'speciesCode': 'brnowl', 'sciName': 'Tyto alba', 'familyComName': 'Owls'},
+             {'comName': 'Šmall “Bird”', 'speciesCode': 'smabir', 'sciName': 'Avis', 'familyComName': 'Birds'},
+             {'comName': 'No family', 'speciesCode': 'nofam', 'sciName': 'Incerta'}]
+
+
+def _chunks(data: bytes, size: int) -> list[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 100000])
+def test_iter_json_array_with_elements_split_across_chunks(chunk_size):
+    data = json.dumps(_taxonomy, ensure_ascii=False, indent=1).encode('utf-8')
+    assert list(taxonomyStore.iter_json_array(_chunks(data, chunk_size))) == _taxonomy
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3])
+def test_iter_json_array_with_numbers_split_across_chunks(chunk_size):
+    elements = [12345, -6.5e10, 'text', None, True, [1, 22], {'n': 333}]
+    data = json.dumps(elements).encode('utf-8')
+    assert list(taxonomyStore.iter_json_array(_chunks(data, chunk_size))) == elements
+
+
+def test_iter_json_array_empty():
+    assert list(taxonomyStore.iter_json_array([b' [ ', b'] '])) == []
+
+
+@pytest.mark.parametrize('data', [b'[{"comName": "Wood Duck"}, {"comName": "Barn',
+                                  b'[{"comName": "Wood Duck"}, ',
+                                  b'[{"comName": "Wood Duck"}'])
+def test_iter_json_array_truncated(data):
+    with pytest.raises(ValueError):
+        list(taxonomyStore.iter_json_array(_chunks(data, 5)))
+
+
+def test_iter_json_array_not_an_array():
+    with pytest.raises(ValueError):
+        list(taxonomyStore.iter_json_array([b'{"comName": "Wood Duck"}']))
+
+
+def test_parse_taxonomy_skips_incomplete_species():
+    data = json.dumps(_taxonomy).encode('utf-8')
+    store = taxonomyStore.parse_taxonomy(_chunks(data, 10), lambda name: name.lower())
+    assert len(store) == 3
+    assert 'no family' not in store
+    assert store['wood duck'] == {'speciesName': 'Wood Duck', 'speciesCode': 'wooduc', 'sciName': 'Aix sponsa',
+                                  'groupName': 'Ducks'}
+    assert store.species_code('barn owl') == 'brnowl'
+    assert store.species_code('no such bird') is None
+    assert store.get('no such bird') is None
+    assert list(store) == sorted(['wood duck', 'barn owl', 'šmall “bird”'])
+
+
+def _store() -> taxonomyStore.TaxonomyStore:
+    return taxonomyStore.TaxonomyStore([('wood duck', 'Wood Duck', 'wooduc', 'Aix sponsa', 'Ducks'),
+                                        ('mallard', 'Mallard', 'mallar3', 'Anas platyrhynchos', 'Ducks'),
+                                        ('barn owl', 'Barn Owl', 'brnowl', 'Tyto alba', 'Owls')])
+
+
+def test_snapshot_round_trip():
+    store = _store()
+    loaded = taxonomyStore.TaxonomyStore.from_snapshot(store.to_snapshot())
+    assert list(loaded) == list(store)
+    assert all(loaded[key] == store[key] for key in store)
+
+
+def test_truncated_snapshot_is_not_used():
+    data = _store().to_snapshot()
+    for length in (0, 1, len(data) // 2, len(data) - 1):
+        assert taxonomyStore.TaxonomyStore.from_snapshot(data[:length]) is None
+
+
+def test_snapshot_of_other_version_is_not_used():
+    snapshot = list(marshal.loads(_store().to_snapshot()))
+    snapshot[0] = taxonomyStore.snapshot_version + 1
+    assert taxonomyStore.TaxonomyStore.from_snapshot(marshal.dumps(tuple(snapshot))) is None
+    assert taxonomyStore.TaxonomyStore.from_snapshot(marshal.dumps(['not', 'a', 'snapshot'])) is None
@@ -0,0 +1,63 @@
+# Checks the per-host concurrency limit of the upstream requests
+import threading
+import time
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+import upstream
+
+_url = 'https://upstream.test/species'
+
+
+@pytest.fixture
+def saturated_host(monkeypatch):
+    """
+    A host whose concurrency slots are all in use, and whose session returns 200 without any network access
+    :return: the _Host
+    """
+    monkeypatch.setattr(upstream, '_hosts', {})
+    host = upstream._host_for(_url)
+
+    def session_get(url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = b'ok'
+        return response
+
+    monkeypatch.setattr(host.session, 'get', session_get)
+    for i in range(upstream.max_concurrent_per_host):
+        host.semaphore.acquire()
+    yield host
+    for i in range(upstream.max_concurrent_per_host):
+        host.semaphore.release()
+
+
+def test_get_without_deadline_waits_for_a_slot(saturated_host):
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(upstream.get(_url)))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    saturated_host.semaphore.release()
+    thread.join(5)
+    saturated_host.semaphore.acquire()
+    assert not thread.is_alive()
+    assert responses[0].content == b'ok'
+
+
+def test_get_with_deadline_waits_until_the_deadline(saturated_host):
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        upstream.get(_url, deadline=start + 0.2)
+    assert time.monotonic() - start >= 0.2
+
+
+def test_get_with_deadline_gets_a_slot_released_before_the_deadline(saturated_host):
+    threading.Timer(0.1, saturated_host.semaphore.release).start()
+    response = upstream.get(_url, deadline=time.monotonic() + 5)
+    saturated_host.semaphore.acquire()
+    assert response.content == b'ok'
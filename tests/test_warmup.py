@@ -0,0 +1,33 @@
+# Checks that warm-up jobs are checkpointed and that only valid job ids are used for checkpoint files
+import json
+import os
+
+import pytest
+
+import cache
+import warmup
+
+
+def test_checkpoint_round_trip(cache_directory):
+    job = warmup.WarmupJob('0123456789ab', ['Wood Duck', 'Barn Owl'], True, {'Wood Duck'})
+    job.write_checkpoint()
+    assert os.listdir(cache.warmup_directory) == ['0123456789ab.json']
+
+    resumed = warmup.WarmupJob.from_checkpoint('0123456789ab')
+    assert (resumed.species_names, resumed.include_media, resumed.completed) == (['Wood Duck', 'Barn Owl'], True,
+                                                                                {'Wood Duck'})
+    assert resumed.state == 'interrupted'
+
+
+@pytest.mark.parametrize('job_id', ['../cacheIndex', '../../etc/passwd', '0123456789AB', '0123456789a',
+                                    '0123456789ab\n', '0123456789ab.json', ''])
+def test_invalid_job_id_is_not_used(cache_directory, job_id):
+    # A file that a path traversal would find
+    with open(os.path.join(cache_directory, 'cacheIndex.json'), 'w') as file:
+        json.dump({'jobId': '0123456789ab', 'speciesNames': [], 'includeMedia': False, 'completed': [],
+                   'state': 'done'}, file)
+
+    assert warmup.WarmupJob.from_checkpoint(job_id) is None
+    assert warmup.warmup_manager.status(job_id) is None
+    with pytest.raises(ValueError):
+        warmup.warmup_manager.start(resume_job_id=job_id)
@@ -0,0 +1,221 @@
+# For all requests to upstream servers, such as ebird.org, media.ebird.org, and the Cornell
+# cdn. A pooled requests.Session is kept for each host so that connections, along with their
+# TLS sessions, are kept alive and reused instead of doing a new handshake for every request.
+# Requests have connect and read timeouts, failed requests are retried with jittered exponential
+# backoff, and the number of concurrent requests to each host is limited so that a burst of
+# cache misses doesn't overwhelm a host. Each request, including each retry, also takes a token
+# from the token bucket of its host so that the sustained request rate to each host is limited,
+# no matter whether the request is for a client, a background refresh, or a warm-up job.
+import contextlib
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger()
+
+# Timeouts for connecting to a host and for each read of the response
+connect_timeout_sec = 5.0
+read_timeout_sec = 30.0
+
+# Retries for connection errors, timeouts, and the statuses that indicate a temporary problem.
+# The backoff before retry n is random between 0 and min(backoff_max_sec, backoff_base_sec * 2^n).
+max_retries = 3
+backoff_base_sec = 0.5
+backoff_max_sec = 8.0
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Max number of concurrent requests to each host. Also the number of pooled connections per host.
+max_concurrent_per_host = 4
+
+# Max sustained requests per second to each host, and how many can be done in a burst
+host_requests_per_sec = 4.0
+host_burst = 10
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens are added at rate_per_sec up to burst tokens, and each
+    request uses one token, waiting if none are available.
+    """
+
+    def __init__(self, rate_per_sec: float, burst: int):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: float = None) -> bool:
+        """
+        Takes a token, waiting until one is available
+        :param deadline: time.monotonic() time after which to give up. None means wait as long as needed.
+        :return: True if a token was taken, False if one would not be available before the deadline
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate_per_sec)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait_sec = (1 - self._tokens) / self.rate_per_sec
+            if deadline is not None and now + wait_sec > deadline:
+                return False
+            time.sleep(wait_sec)
+
+
+class _Host:
+    """
+    The pooled session, the concurrency limit, and the rate limit for a single host
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_per_host)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.semaphore = threading.BoundedSemaphore(max_concurrent_per_host)
+        self.bucket = TokenBucket(host_requests_per_sec, host_burst)
+
+
+_hosts: dict[str, _Host] = {}
+_hosts_lock = threading.Lock()
+
+# Connections can't be shared with forked processes, so the sessions are for this process only
+_hosts_pid = os.getpid()
+
+
+def _host_for(url: str) -> _Host:
+    """
+    Returns the _Host for the host of the url, creating it if needed
+    """
+    global _hosts, _hosts_pid
+
+    host_name = urlparse(url).netloc
+    with _hosts_lock:
+        if _hosts_pid != os.getpid():
+            # In a forked process so start with new sessions
+            _hosts = {}
+            _hosts_pid = os.getpid()
+        host = _hosts.get(host_name)
+        if host is None:
+            host = _Host()
+            _hosts[host_name] = host
+        return host
+
+
+def _backoff_sec(attempt: int, response: requests.Response = None) -> float:
+    """
+    Returns how long to wait before the next retry. Uses the Retry-After header if the host specified it.
+    :param attempt: the number of the attempt that just failed, starting at 0
+    :param response: the failed response, if there was one
+    :return: seconds to wait
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), backoff_max_sec)
+    return random.uniform(0, min(backoff_max_sec, backoff_base_sec * 2 ** attempt))
+
+
+def _remaining_sec(url: str, deadline: float):
+    """
+    Returns how much time is left before the deadline
+    :param deadline: time.monotonic() time, or None if there is no deadline
+    :return: seconds remaining, or None if there is no deadline
+    :raises requests.Timeout: if the deadline has passed
+    """
+    if deadline is None:
+        return None
+    remaining_sec = deadline - time.monotonic()
+    if remaining_sec <= 0:
+        raise requests.Timeout(f'Deadline passed for url={url}')
+    return remaining_sec
+
+
+def _request(host: _Host, url: str, headers: dict, stream: bool, deadline: float = None) -> requests.Response:
+    """
+    Does the GET request, retrying if it fails in a way that might be temporary. The caller must
+    hold the host semaphore.
+    :param deadline: time.monotonic() time by which the request, including retries, must be done.
+    The timeouts are shortened, and retries are not done, so that it doesn't go past the deadline.
+    :return: the successful response
+    :raises requests.RequestException: if the request still failed after the retries
+    """
+    for attempt in range(max_retries + 1):
+        response = None
+        if not host.bucket.acquire(deadline):
+            raise requests.Timeout(f'Deadline would pass while waiting for rate limit for url={url}')
+        remaining_sec = _remaining_sec(url, deadline)
+        timeout = ((connect_timeout_sec, read_timeout_sec) if remaining_sec is None else
+                   (min(connect_timeout_sec, remaining_sec), min(read_timeout_sec, remaining_sec)))
+        try:
+            response = host.session.get(url, headers=headers, stream=stream, timeout=timeout)
+            if response.status_code not in retry_statuses:
+                response.raise_for_status()
+                return response
+            if attempt == max_retries:
+                response.raise_for_status()
+            response.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f'Request to url={url} failed so will retry. {e}')
+
+        backoff_sec = _backoff_sec(attempt, response)
+        remaining_sec = _remaining_sec(url, deadline)
+        if remaining_sec is not None and backoff_sec >= remaining_sec:
+            raise requests.Timeout(f'Deadline would pass before retrying url={url}')
+        logger.info(f'Retrying url={url} in {backoff_sec:.1f} seconds, attempt {attempt + 2} of {max_retries + 1}')
+        time.sleep(backoff_sec)
+
+
+def get(url: str, headers: dict = None, deadline: float = None) -> requests.Response:
+    """
+    Gets the url using the pooled session for its host. The whole response is read before
+    returning so that the connection is returned to the pool.
+    :param url: what to get
+    :param headers: optional headers for the request
+    :param deadline: optional time.monotonic() time by which the request must be done, including
+    waiting for the host and retrying. Since the timeouts apply to each read this is not exact, but
+    the request doesn't keep going long after the deadline.
+    :return: the response, with status 2xx
+    :raises requests.RequestException: if the request failed, even after retries, or the deadline passed
+    """
+    host = _host_for(url)
+    remaining_sec = _remaining_sec(url, deadline)
+    if remaining_sec is None:
+        host.semaphore.acquire()
+    elif not host.semaphore.acquire(timeout=remaining_sec):
+        raise requests.Timeout(f'Deadline passed while waiting for host for url={url}')
+    try:
+        return _request(host, url, headers, stream=False, deadline=deadline)
+    finally:
+        host.semaphore.release()
+
+
+@contextlib.contextmanager
+def stream(url: str, headers: dict = None):
+    """
+    Context manager for streaming the response for the url, such as via response.iter_content().
+    The concurrency slot for the host is held, and the connection is returned to the pool,
+    when the context exits.
+    :param url: what to get
+    :param headers: optional headers for the request
+    :return: yields the response, with status 2xx
+    :raises requests.RequestException: if the request failed, even after retries
+    """
+    host = _host_for(url)
+    with host.semaphore:
+        response = _request(host, url, headers, stream=True)
+        try:
+            yield response
+        finally:
+            response.close()
@@ -0,0 +1,260 @@
+# Background warm-up of the cache. A warm-up job determines the data for each species, and
+# optionally pre-renders the PNGs and WAVs for the species, so that clients don't have to wait
+# for ebird to be scraped. The species are processed by a bounded number of threads, and the
+# requests to each upstream host are rate limited by upstream.py so that the hosts are not
+# overwhelmed. Progress is checkpointed to a file so that an interrupted job can be resumed.
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import audio
+import cache
+import imageProcessor
+from ebird import ebird
+from workerPool import PoolBusyError
+
+logger = logging.getLogger()
+
+# Number of species that are warmed up at the same time
+warmup_concurrency = 3
+
+# If the image or audio worker pool is busy then wait this long before trying again
+busy_retry_sec = 5.0
+busy_max_retries = 5
+
+# Job ids are 12 hex digits. Ids from requests are checked against this before being used in a file
+# name so that they cannot refer to files outside of the warm-up directory.
+job_id_pattern = re.compile(r'^[0-9a-f]{12}$')
+
+
+class WarmupJob:
+    """
+    A single warm-up job. Its progress is checkpointed after each species so that it can be resumed.
+    """
+
+    def __init__(self, job_id: str, species_names: list[str], include_media: bool, completed: set[str] = None):
+        """
+        :param job_id: identifies the job
+        :param species_names: the species to warm up
+        :param include_media: if True then the PNGs and WAVs for each species are pre-rendered too
+        :param completed: species that were already warmed up, when resuming a job
+        """
+        self.job_id = job_id
+        self.species_names = species_names
+        self.include_media = include_media
+        self.completed = set(completed or ())
+        self.failed: dict[str, str] = {}
+        self.state = 'queued'
+        self.started = None
+        self.finished = None
+        self.media_rendered = 0
+        self._lock = threading.Lock()
+
+        # So that only one thread at a time writes the checkpoint file
+        self._checkpoint_lock = threading.Lock()
+
+    def checkpoint_filename(self) -> str:
+        return f'{cache.warmup_directory}{self.job_id}.json'
+
+    def write_checkpoint(self):
+        """
+        Writes the progress of the job to its checkpoint file, atomically so that an interrupted
+        write doesn't lose the progress
+        """
+        with self._lock:
+            checkpoint = {'jobId': self.job_id, 'speciesNames': self.species_names,
+                          'includeMedia': self.include_media, 'completed': sorted(self.completed),
+                          'state': self.state}
+        with self._checkpoint_lock:
+            cache.atomic_write(self.checkpoint_filename(), json.dumps(checkpoint).encode('utf-8'))
+
+    @classmethod
+    def from_checkpoint(cls, job_id: str):
+        """
+        Creates the job from its checkpoint file so that it can be resumed
+        :param job_id: identifies the job
+        :return: the WarmupJob, or None if there is no checkpoint for the job or the job id is invalid
+        """
+        if not job_id_pattern.fullmatch(job_id):
+            logger.warning(f'Invalid warm-up job id {job_id!r}')
+            return None
+        try:
+            with open(f'{cache.warmup_directory}{job_id}.json') as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            return None
+        job = cls(checkpoint['jobId'], checkpoint['speciesNames'], checkpoint['includeMedia'],
+                  set(checkpoint['completed']))
+
+        # If the job was not finished then the process must have been stopped while running it
+        job.state = checkpoint['state'] if checkpoint['state'] in ('done', 'failed') else 'interrupted'
+        return job
+
+    def status(self) -> dict:
+        """
+        Returns the status of the job, for the status endpoint
+        :return: dictionary describing the progress of the job
+        """
+        with self._lock:
+            return {'jobId': self.job_id, 'state': self.state, 'includeMedia': self.include_media,
+                    'total': len(self.species_names), 'completed': len(self.completed),
+                    'failed': dict(self.failed), 'mediaRendered': self.media_rendered,
+                    'started': self.started, 'finished': self.finished}
+
+    def run(self):
+        """
+        Warms up all of the species that have not yet been completed. Blocks until done.
+        """
+        with self._lock:
+            self.state = 'running'
+            self.started = time.time()
+        remaining = [species_name for species_name in self.species_names if species_name not in self.completed]
+        logger.info(f'Warm-up job {self.job_id} starting for {len(remaining)} of {len(self.species_names)} species')
+
+        with ThreadPoolExecutor(max_workers=warmup_concurrency, thread_name_prefix=f'warmup-{self.job_id}') as executor:
+            for _ in executor.map(self._warm_up_species, remaining):
+                pass
+
+        with self._lock:
+            self.state = 'done'
+            self.finished = time.time()
+        self.write_checkpoint()
+        logger.info(f'Warm-up job {self.job_id} done. {len(self.completed)} species completed and '
+                    f'{len(self.failed)} failed')
+
+    def _warm_up_species(self, species_name: str):
+        """
+        Warms up a single species and then checkpoints the progress
+        """
+        try:
+            species_info = ebird.get_species_info(species_name)
+            if species_info is None:
+                raise ValueError('species not found')
+
+            species_data = json.loads(species_info)
+            if species_data.get('partial'):
+                raise ValueError(f'only got partial data, missing {species_data.get("missing")}')
+
+            if self.include_media:
+                self._render_media(species_name, species_data)
+
+            with self._lock:
+                self.completed.add(species_name)
+                self.failed.pop(species_name, None)
+        except Exception as e:
+            logger.error(f'Warm-up job {self.job_id} could not warm up species={species_name}. {e}')
+            with self._lock:
+                self.failed[species_name] = str(e)
+
+        self.write_checkpoint()
+
+    def _render_media(self, species_name: str, species_data: dict):
+        """
+        Pre-renders the PNGs and the WAVs for the species
+        :param species_name: name of the species
+        :param species_data: the species info, containing the imageDataList and audioDataList
+        """
+        for image_data in species_data.get('imageDataList', []):
+            url = image_data['imageUrl']
+            if not cache.file_exists(imageProcessor.cache_file_name_for_url(url), imageProcessor.image_cache_suffix,
+                                     species_name):
+                self._retry_if_busy(imageProcessor.load_and_process_image_for_url, url, species_name)
+                with self._lock:
+                    self.media_rendered += 1
+
+        for audio_data in species_data.get('audioDataList', []):
+            url = audio_data['audioUrl']
+            if not cache.file_exists(audio.cache_file_name_for_url(url), audio.audio_cache_suffix, species_name):
+                self._retry_if_busy(audio.get_wav_file_for_url, url, species_name)
+                with self._lock:
+                    self.media_rendered += 1
+
+    @staticmethod
+    def _retry_if_busy(fn, *args):
+        """
+        Calls fn, retrying if the worker pool is busy. Warm-up is not urgent so it waits instead
+        of failing when clients are keeping the pools busy.
+        """
+        for attempt in range(busy_max_retries):
+            try:
+                return fn(*args)
+            except PoolBusyError:
+                if attempt == busy_max_retries - 1:
+                    raise
+                time.sleep(busy_retry_sec)
+
+
+class WarmupManager:
+    """
+    Runs warm-up jobs in the background, one at a time, and keeps track of them so that their
+    status can be looked up
+    """
+
+    def __init__(self):
+        self._jobs: dict[str, WarmupJob] = {}
+        self._lock = threading.Lock()
+
+        # Only one job runs at a time since each job already uses multiple threads
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='warmupJob')
+
+    def start(self, include_media: bool = False, species_names: list[str] = None, resume_job_id: str = None) -> str:
+        """
+        Starts a warm-up job in the background
+        :param include_media: if True then the PNGs and WAVs for each species are pre-rendered too
+        :param species_names: species to warm up. If None then all species.
+        :param resume_job_id: if specified then resumes that job, skipping the species it already completed
+        :return: the job id
+        """
+        job = None
+        if resume_job_id is not None:
+            with self._lock:
+                job = self._jobs.get(resume_job_id)
+            if job is not None and job.state in ('queued', 'running'):
+                return job.job_id
+            job = WarmupJob.from_checkpoint(resume_job_id)
+            if job is None:
+                raise ValueError(f'No warm-up job {resume_job_id} to resume')
+        if job is None:
+            if species_names is None:
+                species_names = ebird.get_species_name_list()
+            job = WarmupJob(uuid.uuid4().hex[:12], list(species_names), include_media)
+
+        job.write_checkpoint()
+        with self._lock:
+            self._jobs[job.job_id] = job
+        self._executor.submit(self._run_job, job)
+        return job.job_id
+
+    @staticmethod
+    def _run_job(job: WarmupJob):
+        try:
+            job.run()
+        except Exception:
+            logger.exception(f'Warm-up job {job.job_id} failed')
+            job.state = 'failed'
+            job.write_checkpoint()
+
+    def status(self, job_id: str = None):
+        """
+        Returns the status of a job, or of all the jobs known to this process
+        :param job_id: identifies the job. If None then the status of all jobs is returned.
+        :return: status dictionary, list of them, or None if there is no such job
+        """
+        with self._lock:
+            if job_id is None:
+                return [job.status() for job in self._jobs.values()]
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.status()
+
+        # Might be a job that was run before a restart
+        job = WarmupJob.from_checkpoint(job_id)
+        return job.status() if job is not None else None
+
+
+# The warm-up manager for this process
+warmup_manager = WarmupManager()
@@ -0,0 +1,145 @@
+# For running CPU heavy work, like audio transcoding and image processing, in separate
+# processes so that the GIL doesn't slow down handling of all the other requests
+import logging
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger()
+
+
+def _limit_worker_memory(memory_limit_mb: int):
+    """
+    Initializer for worker processes. Limits the address space of the worker so that a job that
+    uses way too much memory fails with a MemoryError in the worker instead of the whole host
+    running out of memory.
+    :param memory_limit_mb: max memory in megabytes for the worker process
+    """
+    try:
+        import resource
+        limit_bytes = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+    except (ImportError, ValueError, OSError) as e:
+        # The resource module is not available on all platforms
+        logger.warning(f'Could not limit worker memory to {memory_limit_mb}MB. {e}')
+
+
+class PoolBusyError(Exception):
+    """
+    Raised when a job is submitted to a WorkerPool that already has its maximum number
+    of jobs running or waiting. The client should simply retry a bit later.
+    """
+    pass
+
+
+class WorkerPool:
+    """
+    A bounded pool of workers. At most max_workers jobs run at once and at most
+    max_queued additional jobs wait for a worker. If even more jobs are submitted then
+    PoolBusyError is raised right away instead of making the request wait a long time.
+    By default the workers are processes, but threads or a custom executor can be used instead.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queued: int, kind: str = 'process',
+                 memory_limit_mb: int = None, executor_factory=None):
+        """
+        :param name: name of the pool, for logging
+        :param max_workers: number of workers
+        :param max_queued: number of jobs that can be waiting for a worker before the pool is considered busy
+        :param kind: 'process' for worker processes or 'thread' for worker threads
+        :param memory_limit_mb: if set then each worker process is limited to this much memory. Only
+        applies to process workers.
+        :param executor_factory: optional function that takes max_workers and returns a
+        concurrent.futures.Executor. For when neither processes nor threads are appropriate.
+        """
+        if kind not in ('process', 'thread'):
+            raise ValueError(f'Invalid kind={kind} for worker pool {name}')
+
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.kind = kind
+        self.memory_limit_mb = memory_limit_mb
+        self._executor_factory = executor_factory
+
+        # Slots for jobs that are either running or waiting to run
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+
+        # The executor is created lazily so that worker processes are only started if actually needed
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _create_executor(self) -> Executor:
+        """
+        Creates the executor for the configured kind of worker
+        """
+        if self._executor_factory is not None:
+            logger.info(f'Starting custom executor with {self.max_workers} workers for the {self.name} pool')
+            return self._executor_factory(self.max_workers)
+
+        if self.kind == 'thread':
+            if self.memory_limit_mb is not None:
+                logger.warning(f'Memory limit cannot be applied to the thread workers of the {self.name} pool')
+            logger.info(f'Starting {self.max_workers} worker threads for the {self.name} pool')
+            return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+
+        logger.info(f'Starting {self.max_workers} worker processes for the {self.name} pool')
+        if self.memory_limit_mb is not None:
+            return ProcessPoolExecutor(max_workers=self.max_workers,
+                                       initializer=_limit_worker_memory,
+                                       initargs=(self.memory_limit_mb,))
+        return ProcessPoolExecutor(max_workers=self.max_workers)
+
+    def _get_executor(self) -> Executor:
+        """
+        Returns the executor, creating it if needed
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+            return self._executor
+
+    def _discard_executor(self, executor: Executor):
+        """
+        Discards a broken executor, such as when a worker process was killed, so that a new one will be
+        created for the next job
+        """
+        with self._executor_lock:
+            if self._executor is executor:
+                logger.error(f'Worker process for the {self.name} pool died so restarting the pool')
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args, timeout: float = None):
+        """
+        Runs fn(*args) in a worker and waits for the result. For process workers fn and args need
+        to be picklable, so fn needs to be a module level function.
+        :param fn: the function to run
+        :param args: arguments for the function
+        :param timeout: max seconds to wait for the result. None means wait as long as it takes.
+        :return: the value returned by fn
+        :raises PoolBusyError: if too many jobs are already running or queued
+        """
+        if not self._slots.acquire(blocking=False):
+            logger.warning(f'The {self.name} pool is busy so not accepting another job')
+            raise PoolBusyError(f'The {self.name} pool is busy. Please retry.')
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._discard_executor(executor)
+            raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # Free up the slot as soon as the job finishes, even if the caller times out
+        future.add_done_callback(lambda f: self._slots.release())
+
+        try:
+            return future.result(timeout)
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            raise